@@ -4,12 +4,21 @@ import sys
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dedicated", dest="dedicated", action='store_true')
+    # with --dedicated, more than 0 starts a launcher with this many server processes behind it
+    parser.add_argument("--workers", dest="workers", type=int, default=0)
+    parser.add_argument("--maps", dest="maps", type=str, default="out")
+    parser.add_argument("--port", dest="port", type=int, default=27070)
+    parser.add_argument("--capacity", dest="capacity", type=int, default=32)
     parser.add_argument("commands", type=str, nargs="+")
     args = parser.parse_args(sys.argv)
-    if args.dedicated:
+    if args.dedicated and args.workers > 0:
+        from tremor import server_launcher
+
+        server_launcher.main(args.workers, args.maps.split(","), args.port, args.capacity)
+    elif args.dedicated:
         from tremor import server_main
 
-        server_main.main()
+        server_main.main(args.maps.split(",")[0], args.port)
     else:
         from tremor import client_main
 
@@ -0,0 +1,71 @@
+import argparse
+import os
+
+import numpy as np
+import pytest
+
+from tremor.loader.scene import binloader
+from tremor.loader.scene.scene_types import *
+from tremor.util.tools import map_compiler
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# v1 chunks in directory order, with the Raw* record type behind each one (None for the entity text)
+V1_CHUNKS = [
+    (VertexChunk, RawVertex),
+    (ModelVertexChunk, RawModelVertex),
+    (FaceChunk, RawFace),
+    (ModelChunk, RawModel),
+    (EntityChunk, None),
+    (TextureChunk, RawTexture),
+    (PlaneChunk, RawPlane),
+    (BrushSideChunk, RawBrushSide),
+    (BrushChunk, RawBrush),
+]
+
+
+@pytest.fixture(scope="module")
+def compiled_map(tmp_path_factory):
+    # cool.map through the compiler, which builds every chunk with RecordBuilder
+    output = str(tmp_path_factory.mktemp("maps") / "cool.tmb")
+    cwd = os.getcwd()
+    os.chdir(REPO_ROOT)
+    try:
+        map_compiler.main(argparse.Namespace(datadir="data", map="data/scenes/cool.map", output=output,
+                                             verbose=False))
+    finally:
+        os.chdir(cwd)
+    with open(output, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("index", range(0, len(V1_CHUNKS)))
+def test_chunks_match_per_record_serializer(compiled_map, index):
+    chunk_type, raw_type = V1_CHUNKS[index]
+    entry = binloader.read_directory(compiled_map, len(compiled_map))[index]
+    written = compiled_map[entry.start:entry.start + entry.length]
+    if raw_type is None:
+        assert bytes(chunk_type.from_directory(compiled_map, entry).serialize()) == written
+        return
+    # a plain list of Raw* objects goes through the old one record at a time serialize
+    records = list(RecordList.from_buffer(raw_type, written))
+    assert len(records) > 0
+    assert all(type(record) is raw_type for record in records)
+    assert bytes(chunk_type(records).serialize()) == written
+
+
+def test_builder_matches_raw_records():
+    vertices = RecordBuilder(RawVertex, capacity=1)
+    raw = []
+    for i in range(0, 5):
+        point = np.array([i, -i * 0.5, 1e6 + i], dtype='float32')
+        normal = np.array([0, 1, 0], dtype='float32')
+        texcoord = np.array([i / 3, 2.5], dtype='float32')
+        vertices.append(point, normal, texcoord)
+        raw.append(RawVertex(point, normal, texcoord))
+    assert len(vertices) == 5
+    assert bytes(VertexChunk(vertices.records()).serialize()) == bytes(VertexChunk(raw).serialize())
+    faces = RecordBuilder(RawFace)
+    faces.append(3, 10, 4, 20, 6, np.array([0, 0, -1], dtype='float32'))
+    assert bytes(FaceChunk(faces.records()).serialize()) == \
+           bytes(FaceChunk([RawFace(3, 10, 4, 20, 6, np.array([0, 0, -1], dtype='float32'))]).serialize())
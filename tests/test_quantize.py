@@ -0,0 +1,79 @@
+import numpy as np
+
+from tremor.math.geometry import AABB
+from tremor.net import quantize
+from tremor.net.quantize import PositionQuantizer
+
+
+def random_quaternions(rng, count):
+    q = rng.normal(size=(count, 4))
+    return q / np.linalg.norm(q, axis=1)[:, None]
+
+
+def angle_between(a, b):
+    # q and -q are the same rotation
+    dots = np.clip(np.abs(np.sum(a * b, axis=1)), 0, 1)
+    return np.degrees(2 * np.arccos(dots))
+
+
+def test_position_error_within_half_step():
+    rng = np.random.default_rng(1)
+    quantizer = PositionQuantizer(AABB(np.array([-1000.0, -200.0, 0.0]), np.array([3000.0, 200.0, 512.0])))
+    positions = rng.uniform(quantizer.origin, quantizer.origin + quantizer.step * quantizer.max_value,
+                            size=(10000, 3))
+    decoded = quantizer.decode(quantizer.encode(positions))
+    # decode rounds to float32, allow for that on top of the half step
+    assert np.all(np.abs(decoded - positions) <= quantizer.step / 2 + 1e-3)
+
+
+def test_position_clamped_to_bounds():
+    quantizer = PositionQuantizer()
+    values = quantizer.encode(np.array([[-1e9, 0, 1e9]]))
+    assert values[0, 0] == 0
+    assert values[0, 2] == quantizer.max_value
+    assert np.all((values >= 0) & (values <= quantizer.max_value))
+
+
+def test_rotation_error_under_quarter_degree():
+    rng = np.random.default_rng(2)
+    rotations = random_quaternions(rng, 100000)
+    decoded = quantize.decode_rotations(quantize.encode_rotations(rotations))
+    assert np.max(angle_between(rotations, decoded.astype('float64'))) < 0.25
+
+
+def test_rotation_identity_exact():
+    identity = np.array([[0, 0, 0, 1], [0, 0, 0, -1]], dtype='float32')
+    decoded = quantize.decode_rotations(quantize.encode_rotations(identity))
+    assert np.array_equal(decoded, np.array([[0, 0, 0, 1], [0, 0, 0, 1]], dtype='float32'))
+
+
+def test_rotation_fits_packed_bits():
+    rng = np.random.default_rng(3)
+    packed = quantize.encode_rotations(random_quaternions(rng, 1000))
+    assert np.all((packed >= 0) & (packed < 1 << (2 + 3 * quantize.ROTATION_BITS)))
+
+
+def test_velocity_round_trip():
+    rng = np.random.default_rng(4)
+    velocities = rng.uniform(-4000, 4000, size=(10000, 3))
+    decoded = quantize.decode_velocities(quantize.encode_velocities(velocities))
+    assert np.all(np.abs(decoded - velocities) <= 0.5 / quantize.VELOCITY_SCALE + 1e-3)
+
+
+def test_velocity_clamped():
+    values = quantize.encode_velocities(np.array([1e7, -1e7, 0]))
+    assert list(values) == [32767, -32767, 0]
+    assert np.all(quantize.decode_velocities(values)[:2] == [32767 / quantize.VELOCITY_SCALE,
+                                                              -32767 / quantize.VELOCITY_SCALE])
+
+
+def test_scale_round_trip():
+    rng = np.random.default_rng(5)
+    scales = rng.uniform(-100, 100, size=(10000, 3))
+    decoded = quantize.decode_scales(quantize.encode_scales(scales))
+    assert np.all(np.abs(decoded - scales) <= 0.5 / quantize.SCALE_SCALE + 1e-5)
+
+
+def test_scale_clamped():
+    values = quantize.encode_scales(np.array([1000.0, -1000.0, 1.0]))
+    assert list(values) == [32767, -32767, quantize.SCALE_SCALE]
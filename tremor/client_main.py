@@ -2,6 +2,7 @@ import time
 
 from tremor.core import console
 from tremor.core.entity import Entity
+from tremor.core.player_move import ACTION_JUMP
 from tremor.core.scene import Scene
 from tremor.graphics import graphics_subsystem
 from tremor.graphics.ui.state import UIState
@@ -12,11 +13,73 @@ from tremor.math import matrix
 from tremor.math.geometry import AABB
 from tremor.math.vertex_math import magnitude_vec3
 from tremor.net.client import client_net
+from tremor.net.client.interpolation import InterpolationBuffer, SnapshotClock
+from tremor.net.client.prediction import Prediction
 from tremor.net.command import *
 from tremor.net.common import ConnectionState
+from tremor.net import quantize
+from tremor.net.snapshot import SnapshotHistory, dequantize_states
 
 current_scene: Scene = None
+snapshots: SnapshotHistory = None
+quantizer: quantize.PositionQuantizer = None
+prediction: Prediction = None
+predicted = None  # (position, velocity) of the local player after its newest input
+interpolation: InterpolationBuffer = None
+snapshot_clock: SnapshotClock = None
+player_slot = -1
 viewangles = np.array([0, 0], dtype='float32')
+buttons = {"forward": False, "back": False, "moveleft": False, "moveright": False, "jump": False}
+
+
+def _button_cmd(name, down):
+    def set_button(*args):
+        buttons[name] = down
+
+    return set_button
+
+
+for _name in buttons.keys():
+    console.CCmd("+" + _name)(_button_cmd(_name, True))
+    console.CCmd("-" + _name)(_button_cmd(_name, False))
+
+
+# seconds remote entities are drawn behind the newest snapshot, a bit over two server ticks rides out one lost
+@console.CVar("cl_interp", flags=0, default_value="0.1")
+def _cl_interp_set(value):
+    try:
+        return str(min(max(float(value), 0.0), 1.0))
+    except ValueError:
+        return console.get_cvar_value("cl_interp")
+
+
+# inputs per second, frames in between are folded into the next one
+@console.CVar("cl_cmdrate", flags=0, default_value="60")
+def _cl_cmdrate_set(value):
+    try:
+        return str(min(max(int(value), 10), 250))
+    except ValueError:
+        return console.get_cvar_value("cl_cmdrate")
+
+
+# how many of the newest unacked inputs every input packet repeats, to ride out lost packets
+@console.CVar("cl_cmdbackup", flags=0, default_value="4")
+def _cl_cmdbackup_set(value):
+    try:
+        return str(min(max(int(value), 1), 16))
+    except ValueError:
+        return console.get_cvar_value("cl_cmdbackup")
+
+
+# most bytes per second the server should send us, when everything doesn't fit it sends what matters most
+@console.CVar("rate", flags=0, default_value="25000")
+def _rate_set(value):
+    try:
+        rate = min(max(int(value), 1000), 1000000)
+    except ValueError:
+        return console.get_cvar_value("rate")
+    client_net.set_rate(rate)
+    return str(rate)
 
 
 def handle(cmd):
@@ -27,43 +90,58 @@ def handle(cmd):
         handle_map(cmd)
     if cmd_type is MessageCommand:
         console.conprint(cmd.sender_name + ": " + cmd.text)
-    if cmd_type is EntityCreateCommand:
-        handle_ent_create(cmd)
-    if cmd_type is EntityUpdateCommand:
-        handle_ent_update(cmd)
+    if cmd_type is CompactEntityCreateCommand:
+        handle_compact_ent_create(cmd)
+    if cmd_type is EntitySnapshotBatchCommand:
+        handle_ent_snapshot_batch(cmd)
     if cmd_type is EntityDeleteCommand:
         handle_ent_delete(cmd)
     if cmd_type is PlayerEntityAssignCommand:
         handle_player_ent_assign(cmd)
+    if cmd_type is PlayerStateCommand:
+        prediction.server_state(cmd)
 
 
-def handle_ent_create(cmd: EntityCreateCommand):
-    global current_scene
+def handle_compact_ent_create(cmd: CompactEntityCreateCommand):
+    create_ent(cmd.entity_id, quantizer.decode(np.array(cmd.pos)), quantize.decode_rotations(cmd.rotation)[0],
+               quantize.decode_scales(np.array(cmd.scale)), quantize.decode_velocities(np.array(cmd.velocity)),
+               cmd.mins, cmd.maxs, cmd.classname, cmd.flags)
+
+
+def create_ent(entity_id, pos, rotation, scale, velocity, mins, maxs, classname, flags):
     entity = Entity()
-    entity.transform.set_translation(cmd.pos)
-    entity.transform.set_rotation(cmd.rotation)
-    entity.transform.set_scale(cmd.pos)
-    entity.classname = cmd.classname
-    entity.flags = cmd.flags
-    entity.velocity = cmd.velocity
-    entity.boundingbox = AABB(cmd.mins, cmd.maxs)
+    entity.transform.set_translation(pos)
+    entity.transform.set_rotation(rotation)
+    entity.transform.set_scale(scale)
+    entity.classname = classname
+    entity.flags = flags
+    entity.velocity = velocity
+    entity.boundingbox = AABB(mins, maxs)
     entity.mesh = gltf_loader.load_gltf("data/gltf/trisout.glb")
     # todo check if existing entity with that id?
-    current_scene.entities[cmd.entity_id] = entity
+    current_scene.set_ent(entity_id, entity)
+    interpolation.clear(entity_id)
+    if snapshot_clock.newest_tick > 0 and entity_id != player_slot:
+        # snapshots move it from here
+        interpolation.push(snapshot_clock.newest_tick, np.array([entity_id]), np.array([pos], dtype='float32'),
+                           np.array([rotation], dtype='float32'))
 
 
-def handle_ent_update(cmd: EntityUpdateCommand):
-    entity = current_scene.entities[cmd.entity_id]
-    if entity is None:
-        # todo trigger some sort of negotiation mechanism ?
-        return
-    # if np.abs(magnitude_vec3(cmd.pos - entity.transform.get_translation())) > 1:
-    #     print("Bad predict!")
-    entity.transform.set_translation(cmd.pos)
-    if not entity == current_scene.current_player_ent:
-        entity.transform.set_rotation(cmd.rotation)
-    entity.transform.set_scale(cmd.scale)
-    entity.velocity = cmd.velocity
+def handle_ent_snapshot_batch(cmd: EntitySnapshotBatchCommand):
+    slots, states = snapshots.decode_batch(cmd)
+    phys = current_scene.physics
+    # entities are bound to the physics arrays, write every state in one go
+    created = phys.active[slots]
+    slots = slots[created]
+    pos, rotation, velocity, scale = dequantize_states(quantizer, states[created])
+    phys.scales[slots] = scale
+    # the local player is predicted, only PlayerStateCommands move it
+    # everything else is drawn from the interpolation buffer
+    others = slots != player_slot
+    phys.velocities[slots[others]] = velocity[others]
+    hold_tick = snapshot_clock.newest_tick
+    snapshot_clock.received(cmd.tick, time.perf_counter())
+    interpolation.push(cmd.tick, slots[others], pos[others], rotation[others], hold_tick)
 
 
 def handle_ent_delete(cmd: EntityDeleteCommand):
@@ -72,11 +150,17 @@ def handle_ent_delete(cmd: EntityDeleteCommand):
         return
         # entity.destroy()
     # todo what if the entity being destroyed is the player?
-    current_scene[cmd.entity_id] = None
+    current_scene.remove_ent(cmd.entity_id)
+    interpolation.clear(cmd.entity_id)
 
 
 def handle_player_ent_assign(cmd: PlayerEntityAssignCommand):
-    current_scene.current_player_ent = current_scene.entities[cmd.entity_id]
+    global player_slot, predicted
+    player_slot = cmd.entity_id
+    interpolation.clear(player_slot)
+    player = current_scene.entities[cmd.entity_id]
+    current_scene.current_player_ent = player
+    predicted = (np.array(player.transform.get_translation()), np.array(player.velocity))
 
 
 def handle_response(cmd):
@@ -85,7 +169,7 @@ def handle_response(cmd):
         client_net.set_connection_state(ConnectionState.CONNECTED)
     elif cmd.response_code == ResponseCommand.CONNECTION_TERMINATED or \
             cmd.response_code == ResponseCommand.CONNECTION_REJECTED:
-        client_net.set_connection_state(ConnectionState.DISCONNECTED)
+        client_net.disconnect()
         if current_scene is not None:
             unload_map()
             current_scene = None
@@ -109,8 +193,45 @@ def unload_map():
 
 
 def load_map(map_name):
-    global current_scene
+    global current_scene, snapshots, quantizer, prediction, interpolation, snapshot_clock
     current_scene = binloader.load_scene_file(map_name, "data/scenes/" + map_name + ".tmb", True)
+    snapshots = SnapshotHistory(Scene.MAX_ENTS)
+    prediction = Prediction()
+    interpolation = InterpolationBuffer(Scene.MAX_ENTS)
+    snapshot_clock = SnapshotClock()
+    quantizer = quantize.PositionQuantizer(current_scene.bounds)
+
+
+def interpolate_entities(dt):
+    render_tick = snapshot_clock.advance(dt, float(console.get_cvar_value("cl_interp")), time.perf_counter())
+    slots, pos, rotation = interpolation.sample(render_tick)
+    phys = current_scene.physics
+    shown = phys.active[slots] & (slots != player_slot)
+    phys.positions[slots[shown]] = pos[shown]
+    phys.rotations[slots[shown]] = rotation[shown]
+
+
+def predict_player(dt):
+    # inputs at cl_cmdrate, sent to the server and applied to the local player right away
+    # everything else only moves when the server says so
+    global predicted
+    player = current_scene.current_player_ent
+    forward_move = 127 * (buttons["forward"] - buttons["back"])
+    side_move = 127 * (buttons["moveright"] - buttons["moveleft"])
+    actions = ACTION_JUMP if buttons["jump"] else 0
+    # the server rewinds to what we drew for anything these inputs do to other entities
+    view_tick = snapshot_clock.render_tick if snapshot_clock.render_tick is not None else 0.0
+    if prediction.sample(dt, actions, viewangles, forward_move, side_move, int(console.get_cvar_value("cl_cmdrate")),
+                         view_tick=view_tick) is not None:
+        # the server skips the ones it already has
+        for cmd in prediction.unacked(int(console.get_cvar_value("cl_cmdbackup"))):
+            client_net.queue_input(cmd)
+    predicted = prediction.predict(*predicted, player.boundingbox)
+    # drawn with the frames since the last input on top, those aren't part of predicted until they're sent
+    pos, velocity = prediction.pending(*predicted, viewangles, forward_move, side_move, player.boundingbox)
+    player.transform.set_translation(pos)
+    player.velocity = velocity
+    player.transform.set_rotation(matrix.quat_from_viewangles(viewangles))
 
 
 def main():
@@ -119,18 +240,19 @@ def main():
     input_subsystem.init()
     console.load_startup("startup.rc")
     client_net.init()
+    client_net.set_rate(int(console.get_cvar_value("rate")))
     dt = 1 / 60.0
     while not graphics_subsystem.window_close_requested():
         start_time = time.time()
         input_subsystem.poll_events()
-        client_net.handle_events()
+        for cmd in client_net.poll_commands():
+            handle(cmd)
         # todo console buffer here
         if current_scene is not None:
-            if current_scene.current_player_ent is not None:
-                current_scene.current_player_ent.transform.set_rotation(matrix.quat_from_viewangles(viewangles))
-            current_scene.move_entities(dt)  # prediction
-        if client_net._socket.connection_state == ConnectionState.CONNECTED:
-            client_net.queue_update_cmd(viewangles)
+            interpolate_entities(dt)
+            if current_scene.current_player_ent is not None and \
+                    client_net._socket.connection_state == ConnectionState.CONNECTED:
+                predict_player(dt)
         client_net.write_outbound()
         graphics_subsystem.draw_scene(current_scene)
         graphics_subsystem.draw_ui()
@@ -16,18 +16,84 @@ class Entity:
     FLAG_BOUNCY = 64
     FLAG_INVINCIBLE = 128
     FLAG_NO_TRANSMIT = 256
+    FLAG_PREDICTED = 512  # moved by its client's inputs, not by Scene.move_entities
 
     def __init__(self):
+        self._physics = None
+        self._slot = -1
         self.transform = Transform(self)
         self.mesh = None
         self._node_idx = -1
         self.children: List[Entity] = []
         self.parent: Entity = None
         self.classname = ""
-        self.velocity = np.array([0, 0, 0], dtype='float32')
-        self.boundingbox: AABB = AABB.cube(1)
-        self.flags = 0
-        self.needs_update = False
+        self._velocity = np.array([0, 0, 0], dtype='float32')
+        self._boundingbox: AABB = AABB.cube(1)
+        self._flags = 0
+        self._needs_update = False
 
     def is_renderable(self):
         return self.mesh is not None
+
+    # once a scene binds the entity to its PhysicsState, the physics fields live in the state's arrays
+    def bind_physics(self, physics, slot: int):
+        self._physics = physics
+        self._slot = slot
+        self._velocity = physics.velocities[slot]
+        self.transform.bind_state(physics.positions[slot], physics.rotations[slot], physics.scales[slot])
+
+    def unbind_physics(self):
+        if self._physics is None:
+            return
+        self._velocity = self._velocity.copy()
+        self._flags = int(self._physics.flags[self._slot])
+        self._needs_update = bool(self._physics.dirty[self._slot])
+        self.transform.unbind_state()
+        self._physics = None
+        self._slot = -1
+
+    @property
+    def velocity(self) -> np.ndarray:
+        return self._velocity
+
+    @velocity.setter
+    def velocity(self, velocity: np.ndarray):
+        if self._physics is None:
+            self._velocity = velocity
+        else:
+            self._velocity[:] = velocity
+
+    @property
+    def flags(self) -> int:
+        if self._physics is None:
+            return self._flags
+        return int(self._physics.flags[self._slot])
+
+    @flags.setter
+    def flags(self, flags: int):
+        self._flags = flags
+        if self._physics is not None:
+            self._physics.flags[self._slot] = flags
+
+    @property
+    def boundingbox(self) -> AABB:
+        return self._boundingbox
+
+    @boundingbox.setter
+    def boundingbox(self, boundingbox: AABB):
+        self._boundingbox = boundingbox
+        if self._physics is not None:
+            self._physics.mins[self._slot] = boundingbox.min_extent
+            self._physics.maxs[self._slot] = boundingbox.max_extent
+
+    @property
+    def needs_update(self) -> bool:
+        if self._physics is None:
+            return self._needs_update
+        return bool(self._physics.dirty[self._slot])
+
+    @needs_update.setter
+    def needs_update(self, needs_update: bool):
+        self._needs_update = needs_update
+        if self._physics is not None:
+            self._physics.dirty[self._slot] = needs_update
@@ -43,3 +43,67 @@ class FPSController(Stopwatch):
         self.update()
         while self.average_fps > fps:
             self.update()
+
+
+# fixed timestep: ticks are due every 1 / tick_rate seconds on the monotonic clock, whatever the last one cost
+# falling behind runs up to max_catchup ticks back to back, anything past that is dropped so one long stall
+# doesn't turn into a burst of catch-up ticks that each fall behind again
+class TickScheduler:
+    # coarse waits wake up this early and spin the rest, sleeps and selects overshoot by up to a timer slice
+    SPIN_MARGIN = 0.002
+
+    def __init__(self, tick_rate: float, max_catchup: int = 5):
+        self.dt = 1 / tick_rate
+        self.max_catchup = max_catchup
+        self.next_tick = time.monotonic()
+        # overrun accounting since the last take_stats()
+        self.ticks = 0
+        self.overruns = 0  # ticks that took longer than dt
+        self.dropped = 0  # due ticks skipped because we were more than max_catchup behind
+        self.worst = 0.0  # longest tick, seconds
+        self.wakeups = 0  # ticks_due() calls that had something due
+        self.lateness = 0.0  # summed time between the first due tick being due and ticks_due() finding it
+
+    def ticks_due(self) -> int:
+        now = time.monotonic()
+        if now < self.next_tick:
+            return 0
+        due = int((now - self.next_tick) / self.dt) + 1
+        if due > self.max_catchup:
+            self.dropped += due - self.max_catchup
+            # pretend the oldest tick we still run was due just now, so the one after the catch-up lands dt later
+            due = self.max_catchup
+            self.next_tick = now - (due - 1) * self.dt
+        self.wakeups += 1
+        self.lateness += now - self.next_tick
+        return due
+
+    def tick_done(self, start: float) -> float:
+        # start is a time.monotonic() from before the tick, returns how long it took
+        elapsed = time.monotonic() - start
+        self.next_tick += self.dt
+        self.ticks += 1
+        if elapsed > self.dt:
+            self.overruns += 1
+        self.worst = max(self.worst, elapsed)
+        return elapsed
+
+    def wait(self, idle=time.sleep):
+        # idle(seconds) does the coarse part of the wait, the server handles datagrams in it
+        remaining = self.next_tick - time.monotonic()
+        if remaining > self.SPIN_MARGIN:
+            idle(remaining - self.SPIN_MARGIN)
+        while time.monotonic() < self.next_tick:
+            pass
+
+    def take_stats(self):
+        # (ticks, overruns, dropped, worst seconds, mean lateness seconds), then starts counting again
+        stats = (self.ticks, self.overruns, self.dropped, self.worst,
+                 self.lateness / self.wakeups if self.wakeups > 0 else 0.0)
+        self.ticks = 0
+        self.wakeups = 0
+        self.overruns = 0
+        self.dropped = 0
+        self.worst = 0.0
+        self.lateness = 0.0
+        return stats
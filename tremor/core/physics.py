@@ -0,0 +1,39 @@
+import numpy as np
+
+
+# structure of arrays copy of every entity's physics fields, indexed by entity slot
+# entities in a scene are bound to a row, so their transform/velocity/flags/bbox read and write these arrays
+class PhysicsState:
+    def __init__(self, size: int):
+        self.positions = np.zeros((size, 3), dtype='float32')
+        self.rotations = np.zeros((size, 4), dtype='float32')
+        self.scales = np.ones((size, 3), dtype='float32')
+        self.velocities = np.zeros((size, 3), dtype='float32')
+        self.flags = np.zeros(size, dtype='int32')
+        self.mins = np.zeros((size, 3), dtype='float32')
+        self.maxs = np.zeros((size, 3), dtype='float32')
+        self.dirty = np.zeros(size, dtype='bool')
+        self.active = np.zeros(size, dtype='bool')
+
+    def attach(self, slot: int, ent):
+        self.velocities[slot] = ent.velocity
+        self.flags[slot] = ent.flags
+        self.mins[slot] = ent.boundingbox.min_extent
+        self.maxs[slot] = ent.boundingbox.max_extent
+        self.dirty[slot] = ent.needs_update
+        self.active[slot] = True
+        ent.bind_physics(self, slot)
+
+    def detach(self, slot: int, ent):
+        ent.unbind_physics()
+        self.active[slot] = False
+        self.dirty[slot] = False
+        self.velocities[slot] = 0
+
+    def live_slots(self) -> np.ndarray:
+        return np.flatnonzero(self.active)
+
+    def box_offsets(self, slots: np.ndarray):
+        # bbox extents relative to the box center, traces put the box center at the entity position
+        center = (self.mins[slots] + self.maxs[slots]) / 2
+        return self.mins[slots] - center, self.maxs[slots] - center
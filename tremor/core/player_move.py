@@ -0,0 +1,76 @@
+import numpy as np
+
+from tremor.math import collision_testing
+from tremor.math.geometry import AABB
+
+# player movement from one frame of input, run by the server for the real thing and by the client to predict
+# it, so the two only agree if this depends on nothing but its arguments and the world brushes
+ACTION_JUMP = 1
+MOVE_SPEED = 320.0
+GROUND_ACCELERATION = 10.0
+AIR_ACCELERATION = 1.0
+FRICTION = 6.0
+# slow movers stop as if they were going this fast, so friction doesn't take forever at the end
+STOP_SPEED = 100.0
+# players fall a lot faster than other entities do in Scene.move_entities, otherwise every jump is a moon jump
+GRAVITY = 800.0
+JUMP_SPEED = 270.0
+# floors are surfaces facing up at least this much, anything steeper is a wall
+MIN_FLOOR_NORMAL = 0.7
+GROUND_CHECK = 0.25
+MAX_BUMPS = 4
+# longest frame a single input may move for, anything more is a stall (or a cheat) and gets cut
+MAX_FRAME_TIME = 0.1
+
+
+def view_vectors(look_angles):
+    # horizontal forward and right for the yaw in look_angles, the camera looks down local +x
+    yaw = np.radians(look_angles[0])
+    return np.array([np.cos(yaw), 0, -np.sin(yaw)]), np.array([np.sin(yaw), 0, np.cos(yaw)])
+
+
+def on_ground(position: np.ndarray, box: AABB) -> bool:
+    res = collision_testing.trace(position, position - np.array([0, GROUND_CHECK, 0]), box)
+    return res.collided and res.surface_normal[1] >= MIN_FLOOR_NORMAL
+
+
+def _accelerate(velocity, wish_dir, wish_speed, acceleration, dt):
+    add = wish_speed - velocity.dot(wish_dir)
+    if add <= 0:
+        return velocity
+    return velocity + min(acceleration * wish_speed * dt, add) * wish_dir
+
+
+def player_move(position: np.ndarray, velocity: np.ndarray, look_angles: np.ndarray, actions: int,
+                forward_move: int, side_move: int, dt: float, box: AABB):
+    # returns the new (position, velocity), both float32 like the physics arrays they're stored in
+    dt = min(max(float(dt), 0.0), MAX_FRAME_TIME)
+    position = np.array(position, dtype='float64')
+    velocity = np.array(velocity, dtype='float64')
+    forward, right = view_vectors(look_angles)
+    wish = forward * (forward_move / 127) + right * (side_move / 127)
+    wish_len = np.linalg.norm(wish)
+    wish_dir = wish / wish_len if wish_len > 0 else wish
+    wish_speed = MOVE_SPEED * min(wish_len, 1.0)
+    grounded = on_ground(position, box)
+    if grounded:
+        speed = np.linalg.norm(velocity[[0, 2]])
+        if speed > 0:
+            velocity[[0, 2]] *= max(speed - max(speed, STOP_SPEED) * FRICTION * dt, 0) / speed
+        velocity = _accelerate(velocity, wish_dir, wish_speed, GROUND_ACCELERATION, dt)
+        velocity[1] = JUMP_SPEED if actions & ACTION_JUMP else max(velocity[1], 0)
+    else:
+        velocity = _accelerate(velocity, wish_dir, wish_speed, AIR_ACCELERATION, dt)
+        velocity[1] -= GRAVITY * dt
+    # slide along whatever is in the way
+    remaining = dt
+    for bump in range(0, MAX_BUMPS):
+        if remaining <= 0 or not np.any(velocity):
+            break
+        res = collision_testing.trace(position, position + velocity * remaining, box)
+        position = res.end_point
+        if not res.collided:
+            break
+        velocity = collision_testing.clamp_velocity(velocity, res, 0)
+        remaining *= 1 - res.path_frac
+    return position.astype('float32'), velocity.astype('float32')
@@ -1,7 +1,10 @@
-from typing import List, Optional, Tuple
+from typing import Dict, ItemsView, List, Optional, Tuple
 
 from tremor.core.entity import Entity
+from tremor.core.physics import PhysicsState
 from tremor.math import collision_testing
+from tremor.math.geometry import AABB
+from tremor.math.visibility import CellVisibility
 from tremor.math.vertex_math import magnitude_vec3
 import numpy as np
 
@@ -12,6 +15,13 @@ class Scene:
         self.name = name
         self.current_player_ent: Entity = None
         self.entities: List[Optional[Entity]] = [None] * Scene.MAX_ENTS
+        self.physics = PhysicsState(Scene.MAX_ENTS)
+        # stack of free slots, lowest on top, slots filled directly through set_ent are left in and skipped on pop
+        self._free_slots = list(range(Scene.MAX_ENTS - 1, -1, -1))
+        self._slot_in_free_list = [True] * Scene.MAX_ENTS
+        self._live: Dict[int, Entity] = {}
+        self.bounds: AABB = None
+        self.visibility: CellVisibility = None  # None for maps compiled without it, everything counts as visible
         self.faces: List = None
         self.vao = None
         self.faceVBO = None
@@ -19,18 +29,42 @@ class Scene:
         self.has_geometry = False
 
     def _get_free_ent_slot(self) -> int:
-        idx = 0
-        for ent in self.entities:
-            if ent is None:
-                return idx
-            idx += 1
+        while len(self._free_slots) > 0:
+            slot = self._free_slots.pop()
+            self._slot_in_free_list[slot] = False
+            if self.entities[slot] is None:
+                return slot
         return -1
 
     def allocate_new_ent(self) -> Tuple[int, Entity]:
         slot = self._get_free_ent_slot()
-        self.entities[slot] = Entity()
+        if slot == -1:
+            raise Exception("Out of entity slots!")
+        self.set_ent(slot, Entity())
         return slot, self.entities[slot]
 
+    def set_ent(self, slot: int, ent: Entity):
+        self.remove_ent(slot)
+        self.entities[slot] = ent
+        self._live[slot] = ent
+        self.physics.attach(slot, ent)
+
+    def remove_ent(self, slot: int):
+        # releases the slot back to allocate_new_ent
+        ent = self.entities[slot]
+        if ent is None:
+            return
+        self.physics.detach(slot, ent)
+        self.entities[slot] = None
+        del self._live[slot]
+        if not self._slot_in_free_list[slot]:
+            self._free_slots.append(slot)
+            self._slot_in_free_list[slot] = True
+
+    def live_entities(self) -> ItemsView[int, Entity]:
+        # (slot, entity) for every occupied slot
+        return self._live.items()
+
     def setup_scene_geometry(self, vertex_data, index_data, faces):
         self.has_geometry = True
         from tremor.graphics.vbo import VertexBufferObject
@@ -63,21 +97,36 @@ class Scene:
         glBindVertexArray(0)
 
     def move_entities(self, dt):
-        for ent in self.entities:
-            if ent is None:
-                continue
-            if ent.flags & Entity.FLAG_GRAVITY:
-                ent.velocity[1] -= 64.0 * dt
+        phys = self.physics
+        live = phys.live_slots()
+        live = live[(phys.flags[live] & Entity.FLAG_PREDICTED) == 0]
+        gravity = live[(phys.flags[live] & Entity.FLAG_GRAVITY) != 0]
+        phys.velocities[gravity, 1] -= 64.0 * dt
+        velocities = phys.velocities[live]
+        moving = live[np.einsum('ij,ij->i', velocities, velocities) >= 0.000001 ** 2]
+        if len(moving) == 0:
+            return
+        start = phys.positions[moving]
+        end = start + phys.velocities[moving] * dt
+        box_mins, box_maxs = phys.box_offsets(moving)
+        touching = collision_testing.sweeps_touch_world(np.minimum(start, end) + box_mins,
+                                                        np.maximum(start, end) + box_maxs)
+        # nothing in the way, integrate in one go
+        free = ~touching
+        moved = free & (np.linalg.norm(end - start, axis=1) > 0.001)
+        phys.positions[moving[moved]] = end[moved]
+        phys.dirty[moving[moved]] = True
+        # only the boxes near geometry take the precise path
+        for slot in moving[touching].tolist():
+            ent = self.entities[slot]
             bb = ent.boundingbox
-            if magnitude_vec3(ent.velocity) >= 0.000001:
-                next_frame_pos = ent.transform.get_translation() + ent.velocity * dt
-                trace_res = collision_testing.trace(ent.transform.get_translation(), next_frame_pos, bb)
-                if trace_res.collided:
-                    ent.velocity = collision_testing.clamp_velocity(ent.velocity, trace_res, ent.flags & Entity.FLAG_BOUNCY)
-                if np.abs(magnitude_vec3(trace_res.end_point - ent.transform.get_translation())) > 0.001:
-                    ent.transform.set_translation(trace_res.end_point)
-                    ent.needs_update = True
-        pass
+            next_frame_pos = ent.transform.get_translation() + ent.velocity * dt
+            trace_res = collision_testing.trace(ent.transform.get_translation(), next_frame_pos, bb)
+            if trace_res.collided:
+                ent.velocity = collision_testing.clamp_velocity(ent.velocity, trace_res, ent.flags & Entity.FLAG_BOUNCY)
+            if np.abs(magnitude_vec3(trace_res.end_point - ent.transform.get_translation())) > 0.001:
+                ent.transform.set_translation(trace_res.end_point)
+                ent.needs_update = True
 
     def destroy(self):
         #todo deallocate resources
@@ -1,6 +1,8 @@
+import itertools
+
 import numpy as np
 
-from tremor.math.geometry import Plane
+from tremor.math.geometry import Plane, AABB
 from tremor.math.vertex_math import norm_vec3
 
 
@@ -28,33 +30,71 @@ class Brush:
 
     def __init__(self, planes):
         self.planes = planes
+        # plane i is normals[i] . x = dists[i], kept contiguous for batched point tests
+        self.normals = np.array([p.normal for p in planes], dtype='float64').reshape(-1, 3)
+        self.dists = np.einsum('ij,ij->i', self.normals,
+                               np.array([p.point for p in planes], dtype='float64').reshape(-1, 3))
+        self._bounds = None
+        self._clip_planes = None
+
+    def points_in_brush(self, points: np.ndarray, epsilon=0.00001) -> np.ndarray:
+        # points is (M, 3), returns (M,) bools
+        return np.all(np.dot(points, self.normals.T) - self.dists <= epsilon, axis=1)
 
     def point_in_brush(self, point):
-        for p in self.planes:
-            if p.point_dist(point) > 0.00001:
-                return False
-        return True
+        return bool(np.all(self.normals.dot(point) - self.dists <= 0.00001))
+
+    def _intersections(self, a, b):
+        # a is (T, 3, 3) plane normals, b is (T, 3) plane distances, returns the single point intersections
+        single = np.abs(np.linalg.det(a)) >= 0.0000002
+        return np.linalg.solve(a[single], b[single][..., None])[..., 0]
+
+    def get_corner_points(self) -> np.ndarray:
+        # every 3-plane intersection that lies inside the brush, solved in one batch
+        if len(self.planes) < 3:
+            return np.empty((0, 3), dtype='float64')
+        i, j, k = np.array(list(itertools.combinations(range(len(self.planes)), 3))).T
+        a = np.stack((self.normals[i], self.normals[j], self.normals[k]), axis=1)
+        b = np.stack((self.dists[i], self.dists[j], self.dists[k]), axis=1)
+        points = self._intersections(a, b)
+        return points[self.points_in_brush(points, 0.001)]
+
+    def get_bounds(self):
+        if self._bounds is None:
+            points = self.get_corner_points()
+            if len(points) == 0:
+                return None
+            self._bounds = AABB(points.min(axis=0), points.max(axis=0))
+        return self._bounds
+
+    def get_clip_planes(self):
+        # brush planes plus axial bevels at the bounds, without them a box clipped against
+        # the expanded planes of a sloped brush collides well past the brush's corners
+        if self._clip_planes is None:
+            planes = list(self.planes)
+            bounds = self.get_bounds()
+            if bounds is not None:
+                for axis in range(0, 3):
+                    for sign, extent in ((1, bounds.max_extent), (-1, bounds.min_extent)):
+                        normal = np.zeros(3, dtype='float32')
+                        normal[axis] = sign
+                        if not np.any(np.all(np.abs(self.normals - normal) < 0.00001, axis=1)):
+                            planes.append(Plane(extent, normal))
+            normals = np.array([p.normal for p in planes], dtype='float64').reshape(-1, 3)
+            dists = np.einsum('ij,ij->i', normals, np.array([p.point for p in planes], dtype='float64').reshape(-1, 3))
+            self._clip_planes = (planes, normals, dists)
+        return self._clip_planes
 
     def get_vertices(self):
         all_points = []
-        i = 0
-        for p1 in self.planes:
-            i += 1
-            p1_points = []
-            j = 0
-            for p2 in self.planes:
-                j += 1
-                # if i > j:
-                #    continue
-                k = 0
-                for p3 in self.planes:
-                    k += 1
-                    if j > k:
-                        continue
-                    point = p1.intersect_point(p2, p3)
-                    if point is not None and self.point_in_brush(point):
-                        # print(i,j,k)
-                        p1_points.append(point)
+        # same pair order as walking p2, p3 over the planes with p3 never before p2
+        j, k = np.triu_indices(len(self.planes))
+        for plane_idx, p1 in enumerate(self.planes):
+            a = np.stack((np.broadcast_to(self.normals[plane_idx], (len(j), 3)), self.normals[j], self.normals[k]),
+                         axis=1)
+            b = np.stack((np.full(len(j), self.dists[plane_idx]), self.dists[j], self.dists[k]), axis=1)
+            points = self._intersections(a, b)
+            p1_points = list(points[self.points_in_brush(points)])
             if len(p1_points) < 3:
                 continue
             com = center_of_mass(p1_points)
@@ -134,15 +134,11 @@ def draw_scene(scene):
     update_all_uniform('light_pos', light_pos)
 
     scene.bind_scene_vao()
-    for element in scene.entities:
-        if element is None:
-            continue
+    for idx, element in scene.live_entities():
         if element.is_renderable() and element.mesh.is_scene_mesh:
             element.mesh.render_scene_mesh(scene, element.transform)
 
-    for element in scene.entities:
-        if element is None:
-            continue
+    for idx, element in scene.live_entities():
         if element.is_renderable():
             if not element.mesh.is_scene_mesh:
                 element.mesh.render(element.transform)
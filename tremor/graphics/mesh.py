@@ -65,15 +65,18 @@ class Mesh:
         bound_tex = -1
         # list of (texture_to_bind, start[], count[])
         drawcalls = {}
-        for i in range(self.scene_model.face_start, self.scene_model.face_start + self.scene_model.face_count):
-            face = scene.faces[i]
-            tex = TEXTURE_TABLE[face.textureidx]
+        faces = scene.faces.array[self.scene_model.face_start:
+                                  self.scene_model.face_start + self.scene_model.face_count]
+        for textureidx, meshvertstart, meshvertcount in zip(faces['textureidx'].tolist(),
+                                                            faces['meshvertstart'].tolist(),
+                                                            faces['meshvertcount'].tolist()):
+            tex = TEXTURE_TABLE[textureidx]
             if tex in drawcalls:
-                drawcalls[tex][0].append((face.meshvertstart * 4))
-                drawcalls[tex][1].append(face.meshvertcount)
+                drawcalls[tex][0].append((meshvertstart * 4))
+                drawcalls[tex][1].append(meshvertcount)
                 drawcalls[tex][2][0] = drawcalls[tex][2][0] + 1
             else:
-                drawcalls[tex] = ([(face.meshvertstart * 4)], [face.meshvertcount], [1])
+                drawcalls[tex] = ([(meshvertstart * 4)], [meshvertcount], [1])
         for tex, call in drawcalls.items():
             tex.bind()
             GL.glMultiDrawElements(GL.GL_TRIANGLES,
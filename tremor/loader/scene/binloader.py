@@ -6,6 +6,7 @@ from tremor.core.scene_geometry import Brush
 from tremor.loader.scene.scene_types import *
 from tremor.math import collision_testing
 from tremor.math.geometry import Plane
+from tremor.math.visibility import CellVisibility
 
 
 def parse_keyvalue(string):
@@ -34,35 +35,53 @@ def parse_ents(ent_str):
 
 
 def make_brushes_from_chunks(brush_chunk: BrushChunk, brush_side_chunk: BrushSideChunk, plane_chunk: PlaneChunk):
-    planes = []
+    plane_array = plane_chunk.items.array
+    brush_array = brush_chunk.items.array
+    side_planes = brush_side_chunk.items.array['plane_index'].tolist()
+    planes = [Plane(point, normal) for point, normal in zip(plane_array['point'], plane_array['normal'])]
     brushes = []
-    for raw_plane in plane_chunk.items:
-        planes.append(Plane(raw_plane.point, raw_plane.normal))
-    for raw_brush in brush_chunk.items:
-        brushes.append(Brush([planes[raw_side.plane_index]
-                              for raw_side in
-                              brush_side_chunk.items[raw_brush.first_brush_side:
-                                                     raw_brush.first_brush_side + raw_brush.brush_side_count]]))
+    for first_side, side_count in zip(brush_array['first_brush_side'].tolist(),
+                                      brush_array['brush_side_count'].tolist()):
+        brushes.append(Brush([planes[plane_index] for plane_index in side_planes[first_side:first_side + side_count]]))
     return brushes
 
 
-def load_scene_file(mapname, filename, make_geometry) -> Scene:
-    global TEXTURE_TABLE
-    TEXTURE_TABLE = {}
-    file = open(filename, "rb")
-    contents = np.frombuffer(file.read(-1), dtype='byte')
-    file_length = file.seek(0, io.SEEK_END)
-    file = None
+def read_directory(contents, file_length) -> List[RawChunkDirectoryEntry]:
     stuf = struct.unpack_from("<4s", contents)
     if stuf[0] != b'TMF\b':
         raise Exception("Invalid format")
-    directory = []
-    for i in range(0, NUMBER_OF_CHUNKS):
-        a = RawChunkDirectoryEntry.size() * i + HEADER_SIZE
-        directory.append(RawChunkDirectoryEntry.deserialize(contents[a:a + RawChunkDirectoryEntry.size()]))
+    chunk_count = NUMBER_OF_CHUNKS if int(contents[4]) >= 2 else VISIBILITY_CHUNK_INDEX
+    directory = list(RecordList.from_buffer(RawChunkDirectoryEntry, contents, HEADER_SIZE,
+                                            RawChunkDirectoryEntry.size() * chunk_count))
     for dir_ent in directory:
         if dir_ent.start + dir_ent.length > file_length:
             raise Exception("Malformed directory!")
+    return directory
+
+
+def map_scene_file(filename):
+    # read-only shared mapping, every process mapping the same file shares the page cache copy
+    # and pages are only faulted in when a chunk view is actually touched
+    contents = np.memmap(filename, dtype='byte', mode='r')
+    return contents, len(contents)
+
+
+def read_scene_file(filename):
+    file = open(filename, "rb")
+    contents = np.frombuffer(file.read(-1), dtype='byte')
+    file_length = file.seek(0, io.SEEK_END)
+    file.close()
+    return contents, file_length
+
+
+def load_scene_file(mapname, filename, make_geometry, use_mmap=False) -> Scene:
+    global TEXTURE_TABLE
+    TEXTURE_TABLE = {}
+    if use_mmap:
+        contents, file_length = map_scene_file(filename)
+    else:
+        contents, file_length = read_scene_file(filename)
+    directory = read_directory(contents, file_length)
     print("loaded directory entries")
     # vertex_chunk = VertexChunk.from_directory(contents, directory[VERTEX_CHUNK_INDEX])
     vertex_entry = directory[VERTEX_CHUNK_INDEX]
@@ -76,7 +95,7 @@ def load_scene_file(mapname, filename, make_geometry) -> Scene:
     brush_side_chunk = BrushSideChunk.from_directory(contents, directory[BRUSH_SIDE_CHUNK_INDEX])
     brush_chunk = BrushChunk.from_directory(contents, directory[BRUSH_CHUNK_INDEX])
     static_brushes_oh_god_please_dont_move = make_brushes_from_chunks(brush_chunk, brush_side_chunk, plane_chunk)
-    collision_testing.world = static_brushes_oh_god_please_dont_move
+    collision_testing.set_world(static_brushes_oh_god_please_dont_move)
     i = 0
     if make_geometry:
         from tremor.loader.texture_loading import load_texture_by_name
@@ -84,6 +103,12 @@ def load_scene_file(mapname, filename, make_geometry) -> Scene:
             load_texture_by_name(str(texture.name, 'utf-8').strip('\0'), i)
             i += 1
     scene = Scene(filename)
+    scene.bounds = collision_testing.world_bounds()
+    if len(directory) > VISIBILITY_CHUNK_INDEX:
+        vis_chunk = VisibilityChunk.from_directory(contents, directory[VISIBILITY_CHUNK_INDEX])
+        if vis_chunk.bits is not None:
+            scene.visibility = CellVisibility.from_packed(vis_chunk.origin, vis_chunk.cell_size, vis_chunk.dims,
+                                                          vis_chunk.bits)
     if make_geometry:
         scene.setup_scene_geometry(contents[vertex_entry.start:vertex_entry.start + vertex_entry.length],
                                    contents[
@@ -136,7 +161,7 @@ def load_scene_file(mapname, filename, make_geometry) -> Scene:
                     entity.mesh.is_scene_mesh = False
         for k, v in ent.items():
             setattr(entity, k, v)
-        scene.entities[j] = entity
+        scene.set_ent(j, entity)
         j += 1
     scene.name = mapname
     return scene
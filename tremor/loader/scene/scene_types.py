@@ -1,10 +1,12 @@
 import struct
-from typing import List
+from typing import List, Sequence
 
 import numpy as np
 
 
 class RawModelVertex:
+    DTYPE = np.dtype([('index', '<i4')])
+
     def __init__(self, index: int):
         self.index = index
 
@@ -19,8 +21,14 @@ class RawModelVertex:
     def deserialize(contents):
         return RawModelVertex(*struct.unpack('<i', contents))
 
+    @staticmethod
+    def from_record(record):
+        return RawModelVertex(int(record['index']))
+
 
 class RawVertex:
+    DTYPE = np.dtype([('point', '<f4', (3,)), ('normal', '<f4', (3,)), ('texcoord', '<f4', (2,))])
+
     def __init__(self, point: np.ndarray, normal: np.ndarray, texcoord: np.ndarray):
         self.point = point
         self.normal = normal
@@ -39,8 +47,14 @@ class RawVertex:
         return RawVertex(np.array(stuf[0:3], dtype='float32'), np.array(stuf[3:6], dtype='float32'),
                          np.array(stuf[6:8], dtype='float32'))
 
+    @staticmethod
+    def from_record(record):
+        return RawVertex(record['point'], record['normal'], record['texcoord'])
+
 
 class RawPlane:
+    DTYPE = np.dtype([('point', '<f4', (3,)), ('normal', '<f4', (3,))])
+
     def __init__(self, point: np.ndarray, normal: np.ndarray):
         self.point = point
         self.normal = normal
@@ -58,8 +72,15 @@ class RawPlane:
     def size():
         return struct.calcsize("<ffffff")
 
+    @staticmethod
+    def from_record(record):
+        return RawPlane(record['point'], record['normal'])
+
 
 class RawFace:
+    DTYPE = np.dtype([('textureidx', '<i4'), ('vertstart', '<i4'), ('vertcount', '<i4'), ('meshvertstart', '<u4'),
+                      ('meshvertcount', '<u4'), ('normal', '<f4', (3,))])
+
     def __init__(self, textureidx: int, vertstart: int, vertcount: int, meshvertstart: int, meshvertcount: int,
                  normal: np.ndarray):
         self.textureidx = textureidx
@@ -82,8 +103,15 @@ class RawFace:
     def size():
         return struct.calcsize("<iiiIIfff")
 
+    @staticmethod
+    def from_record(record):
+        return RawFace(int(record['textureidx']), int(record['vertstart']), int(record['vertcount']),
+                       int(record['meshvertstart']), int(record['meshvertcount']), record['normal'])
+
 
 class RawTexture:
+    DTYPE = np.dtype([('name', 'S64')])
+
     def __init__(self, name: bytes):
         if len(name) > 64:
             name = name[0:64]  # :)
@@ -101,8 +129,14 @@ class RawTexture:
     def size():
         return struct.calcsize("<64s")
 
+    @staticmethod
+    def from_record(record):
+        return RawTexture(bytes(record['name']))
+
 
 class RawBrush:
+    DTYPE = np.dtype([('content_flags', '<i4'), ('first_brush_side', '<i4'), ('brush_side_count', '<i4')])
+
     def __init__(self, content_flags: int, first_brush_side: int, brush_side_count: int):
         self.content_flags = content_flags
         self.first_brush_side = first_brush_side
@@ -119,8 +153,15 @@ class RawBrush:
     def deserialize(contents):
         return RawBrush(*struct.unpack("<iii", contents))
 
+    @staticmethod
+    def from_record(record):
+        return RawBrush(int(record['content_flags']), int(record['first_brush_side']),
+                        int(record['brush_side_count']))
+
 
 class RawBrushSide:
+    DTYPE = np.dtype([('plane_index', '<i4'), ('surface_flags', '<i4')])
+
     def __init__(self, plane_index: int, surface_flags: int):
         self.plane_index = plane_index
         self.surface_flags = surface_flags
@@ -136,9 +177,15 @@ class RawBrushSide:
     def deserialize(contents):
         return RawBrushSide(*struct.unpack("<ii", contents))
 
+    @staticmethod
+    def from_record(record):
+        return RawBrushSide(int(record['plane_index']), int(record['surface_flags']))
+
 
 class RawModel:
     # todo brushes
+    DTYPE = np.dtype([('face_start', '<i4'), ('face_count', '<i4')])
+
     def __init__(self, face_start: int, face_count: int):
         self.face_start = face_start
         self.face_count = face_count
@@ -155,8 +202,15 @@ class RawModel:
         stuf = struct.unpack("<ii", contents)
         return RawModel(*stuf)
 
+    @staticmethod
+    def from_record(record):
+        return RawModel(int(record['face_start']), int(record['face_count']))
+
 
 class RawChunkDirectoryEntry:
+    DTYPE = np.dtype([('type', '<i4'), ('version', '<i4'), ('compression', '<i4'), ('start', '<i4'),
+                      ('length', '<i4')])
+
     def __init__(self, type: int, version: int, compression: int, start: int, length: int):
         self.type = type
         self.version = version
@@ -176,15 +230,87 @@ class RawChunkDirectoryEntry:
         stuf = struct.unpack("<iiiii", contents)
         return RawChunkDirectoryEntry(*stuf)
 
+    @staticmethod
+    def from_record(record):
+        return RawChunkDirectoryEntry(int(record['type']), int(record['version']), int(record['compression']),
+                                      int(record['start']), int(record['length']))
+
+
+# read-only view of a chunk as a structured array, Raw* row objects are only built on access
+# use .array (or a column, e.g. .array['normal']) for bulk access
+class RecordList(Sequence):
+    def __init__(self, raw_type, array: np.ndarray):
+        self.raw_type = raw_type
+        self.array = array
+
+    @staticmethod
+    def from_buffer(raw_type, buf, offset=0, length=None):
+        if length is None:
+            length = len(buf) - offset
+        count = length // raw_type.DTYPE.itemsize
+        return RecordList(raw_type, np.frombuffer(buf, dtype=raw_type.DTYPE, count=count, offset=offset))
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return RecordList(self.raw_type, self.array[idx])
+        return self.raw_type.from_record(self.array[idx])
+
+    def __iter__(self):
+        for record in self.array:
+            yield self.raw_type.from_record(record)
+
+
+# growable structured array of Raw* records, used by the map compiler to build chunks column-wise
+# append takes the record fields in DTYPE order
+class RecordBuilder:
+    def __init__(self, raw_type, capacity=256):
+        self.raw_type = raw_type
+        self._array = np.zeros(capacity, dtype=raw_type.DTYPE)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _reserve(self, count):
+        if self._count + count <= len(self._array):
+            return
+        capacity = max(len(self._array) * 2, self._count + count)
+        grown = np.zeros(capacity, dtype=self.raw_type.DTYPE)
+        grown[:self._count] = self._array[:self._count]
+        self._array = grown
+
+    def append(self, *fields):
+        self._reserve(1)
+        self._array[self._count] = fields
+        self._count += 1
+        return self._count - 1
+
+    def extend(self, records: np.ndarray):
+        self._reserve(len(records))
+        self._array[self._count:self._count + len(records)] = records
+        self._count += len(records)
+
+    @property
+    def array(self) -> np.ndarray:
+        return self._array[:self._count]
+
+    def records(self) -> "RecordList":
+        return RecordList(self.raw_type, self.array)
+
 
 class VertexChunk:
-    def __init__(self, vertexlist: List[RawVertex]):
+    def __init__(self, vertexlist: Sequence[RawVertex]):
         self.vertexlist = vertexlist
 
     def length_bytes(self):
         return len(self.vertexlist) * RawVertex.size()
 
     def serialize(self):
+        if isinstance(self.vertexlist, RecordList):
+            return self.vertexlist.array.tobytes()
         single_length = RawVertex.size()
         length = len(self.vertexlist) * single_length
         buffer = bytearray(length)
@@ -196,26 +322,23 @@ class VertexChunk:
 
     @staticmethod
     def deserialize(chunk):
-        single_length = RawVertex.size()
-        chunk_len_elem = len(chunk) // single_length
-        verts = []
-        for c in range(0, chunk_len_elem):
-            verts.append(RawVertex.deserialize(chunk[c * single_length:c * single_length + single_length]))
-        return VertexChunk(verts)
+        return VertexChunk(RecordList.from_buffer(RawVertex, chunk))
 
     @staticmethod
     def from_directory(buf, dir: RawChunkDirectoryEntry):
-        return VertexChunk.deserialize(buf[dir.start:dir.start + dir.length])
+        return VertexChunk(RecordList.from_buffer(RawVertex, buf, dir.start, dir.length))
 
 
 class ModelVertexChunk:
-    def __init__(self, items: List[RawModelVertex]):
+    def __init__(self, items: Sequence[RawModelVertex]):
         self.items = items
 
     def length_bytes(self):
         return len(self.items) * RawModelVertex.size()
 
     def serialize(self):
+        if isinstance(self.items, RecordList):
+            return self.items.array.tobytes()
         single_length = RawModelVertex.size()
         length = len(self.items) * single_length
         buffer = bytearray(length)
@@ -225,26 +348,23 @@ class ModelVertexChunk:
 
     @staticmethod
     def deserialize(chunk):
-        single_length = RawModelVertex.size()
-        length = len(chunk) // single_length
-        mverts = []
-        for i in range(0, length):
-            mverts.append(RawModelVertex.deserialize(chunk[i * single_length: i * single_length + single_length]))
-        return ModelVertexChunk(mverts)
+        return ModelVertexChunk(RecordList.from_buffer(RawModelVertex, chunk))
 
     @staticmethod
     def from_directory(buf, dir: RawChunkDirectoryEntry):
-        return ModelVertexChunk.deserialize(buf[dir.start:dir.start + dir.length])
+        return ModelVertexChunk(RecordList.from_buffer(RawModelVertex, buf, dir.start, dir.length))
 
 
 class FaceChunk:
-    def __init__(self, items: List[RawFace]):
+    def __init__(self, items: Sequence[RawFace]):
         self.items = items
 
     def length_bytes(self):
         return len(self.items) * RawFace.size()
 
     def serialize(self):
+        if isinstance(self.items, RecordList):
+            return self.items.array.tobytes()
         single_length = RawFace.size()
         length = len(self.items) * single_length
         buffer = bytearray(length)
@@ -256,26 +376,23 @@ class FaceChunk:
 
     @staticmethod
     def deserialize(chunk):
-        single_length = RawFace.size()
-        chunk_len_elem = len(chunk) // single_length
-        faces = []
-        for c in range(0, chunk_len_elem):
-            faces.append(RawFace.deserialize(chunk[c * single_length: c * single_length + single_length]))
-        return FaceChunk(faces)
+        return FaceChunk(RecordList.from_buffer(RawFace, chunk))
 
     @staticmethod
     def from_directory(buf, dir: RawChunkDirectoryEntry):
-        return FaceChunk.deserialize(buf[dir.start:dir.start + dir.length])
+        return FaceChunk(RecordList.from_buffer(RawFace, buf, dir.start, dir.length))
 
 
 class ModelChunk:
-    def __init__(self, items: List[RawModel]):
+    def __init__(self, items: Sequence[RawModel]):
         self.items = items
 
     def length_bytes(self):
         return len(self.items) * RawModel.size()
 
     def serialize(self):
+        if isinstance(self.items, RecordList):
+            return self.items.array.tobytes()
         single_length = RawModel.size()
         length = len(self.items) * single_length
         buffer = bytearray(length)
@@ -287,26 +404,23 @@ class ModelChunk:
 
     @staticmethod
     def deserialize(chunk):
-        single_length = RawModel.size()
-        chunk_len_elem = len(chunk) // single_length
-        models = []
-        for c in range(0, chunk_len_elem):
-            models.append(RawModel.deserialize(chunk[c * single_length:c * single_length + single_length]))
-        return ModelChunk(models)
+        return ModelChunk(RecordList.from_buffer(RawModel, chunk))
 
     @staticmethod
     def from_directory(buf, dir: RawChunkDirectoryEntry):
-        return ModelChunk.deserialize(buf[dir.start:dir.start + dir.length])
+        return ModelChunk(RecordList.from_buffer(RawModel, buf, dir.start, dir.length))
 
 
 class TextureChunk:
-    def __init__(self, items: List[RawTexture]):
+    def __init__(self, items: Sequence[RawTexture]):
         self.items = items
 
     def length_bytes(self):
         return len(self.items) * RawTexture.size()
 
     def serialize(self):
+        if isinstance(self.items, RecordList):
+            return self.items.array.tobytes()
         single_length = RawTexture.size()
         length = len(self.items) * single_length
         buffer = bytearray(length)
@@ -318,26 +432,23 @@ class TextureChunk:
 
     @staticmethod
     def deserialize(chunk):
-        single_length = RawTexture.size()
-        chunk_len_elem = len(chunk) // single_length
-        models = []
-        for c in range(0, chunk_len_elem):
-            models.append(RawTexture.deserialize(chunk[c * single_length:c * single_length + single_length]))
-        return TextureChunk(models)
+        return TextureChunk(RecordList.from_buffer(RawTexture, chunk))
 
     @staticmethod
     def from_directory(buf, dir: RawChunkDirectoryEntry):
-        return TextureChunk.deserialize(buf[dir.start:dir.start + dir.length])
+        return TextureChunk(RecordList.from_buffer(RawTexture, buf, dir.start, dir.length))
 
 
 class PlaneChunk:
-    def __init__(self, items: List[RawPlane]):
+    def __init__(self, items: Sequence[RawPlane]):
         self.items = items
 
     def length_bytes(self):
         return len(self.items) * RawPlane.size()
 
     def serialize(self):
+        if isinstance(self.items, RecordList):
+            return self.items.array.tobytes()
         buf = bytearray(self.length_bytes())
         for i in range(0, len(self.items)):
             buf[i * RawPlane.size():(i + 1) * RawPlane.size()] = self.items[i].serialize()
@@ -345,26 +456,23 @@ class PlaneChunk:
 
     @staticmethod
     def deserialize(contents):
-        single_length = RawPlane.size()
-        chunk_len_elem = len(contents) // single_length
-        item = []
-        for c in range(0, chunk_len_elem):
-            item.append(RawPlane.deserialize(contents[c * single_length:c * single_length + single_length]))
-        return PlaneChunk(item)
+        return PlaneChunk(RecordList.from_buffer(RawPlane, contents))
 
     @staticmethod
     def from_directory(buf, dir: RawChunkDirectoryEntry):
-        return PlaneChunk.deserialize(buf[dir.start:dir.start + dir.length])
+        return PlaneChunk(RecordList.from_buffer(RawPlane, buf, dir.start, dir.length))
 
 
 class BrushChunk:
-    def __init__(self, items: List[RawBrush]):
+    def __init__(self, items: Sequence[RawBrush]):
         self.items = items
 
     def length_bytes(self):
         return len(self.items) * RawBrush.size()
 
     def serialize(self):
+        if isinstance(self.items, RecordList):
+            return self.items.array.tobytes()
         buf = bytearray(self.length_bytes())
         for i in range(0, len(self.items)):
             buf[i * RawBrush.size():(i + 1) * RawBrush.size()] = self.items[i].serialize()
@@ -372,26 +480,23 @@ class BrushChunk:
 
     @staticmethod
     def deserialize(contents):
-        single_length = RawBrush.size()
-        chunk_len_elem = len(contents) // single_length
-        item = []
-        for c in range(0, chunk_len_elem):
-            item.append(RawBrush.deserialize(contents[c * single_length:c * single_length + single_length]))
-        return BrushChunk(item)
+        return BrushChunk(RecordList.from_buffer(RawBrush, contents))
 
     @staticmethod
     def from_directory(buf, directory: RawChunkDirectoryEntry):
-        return BrushChunk.deserialize(buf[directory.start:directory.start + directory.length])
+        return BrushChunk(RecordList.from_buffer(RawBrush, buf, directory.start, directory.length))
 
 
 class BrushSideChunk:
-    def __init__(self, items: List[RawBrushSide]):
+    def __init__(self, items: Sequence[RawBrushSide]):
         self.items = items
 
     def length_bytes(self):
         return len(self.items) * RawBrushSide.size()
 
     def serialize(self):
+        if isinstance(self.items, RecordList):
+            return self.items.array.tobytes()
         buf = bytearray(self.length_bytes())
         for i in range(0, len(self.items)):
             buf[i * RawBrushSide.size():(i + 1) * RawBrushSide.size()] = self.items[i].serialize()
@@ -399,16 +504,11 @@ class BrushSideChunk:
 
     @staticmethod
     def deserialize(contents):
-        single_length = RawBrushSide.size()
-        chunk_len_elem = len(contents) // single_length
-        item = []
-        for c in range(0, chunk_len_elem):
-            item.append(RawBrushSide.deserialize(contents[c * single_length:c * single_length + single_length]))
-        return BrushSideChunk(item)
+        return BrushSideChunk(RecordList.from_buffer(RawBrushSide, contents))
 
     @staticmethod
     def from_directory(buf, directory: RawChunkDirectoryEntry):
-        return BrushSideChunk.deserialize(buf[directory.start:directory.start + directory.length])
+        return BrushSideChunk(RecordList.from_buffer(RawBrushSide, buf, directory.start, directory.length))
 
 
 class EntityChunk:
@@ -430,6 +530,39 @@ class EntityChunk:
         return EntityChunk.deserialize(buf[dir.start:dir.start + dir.length])
 
 
+# CellVisibility of the map, empty when the map has no bounded brushes
+class VisibilityChunk:
+    HEADER = struct.Struct("<ffffiii")  # origin xyz, cell size, cell counts xyz
+
+    def __init__(self, origin, cell_size: float, dims, bits: np.ndarray):
+        self.origin = origin
+        self.cell_size = cell_size
+        self.dims = dims
+        self.bits = bits  # packed rows of the cells x cells matrix, None if there's no visibility data
+
+    def length_bytes(self):
+        if self.bits is None:
+            return 0
+        return VisibilityChunk.HEADER.size + self.bits.nbytes
+
+    def serialize(self):
+        if self.bits is None:
+            return b""
+        return VisibilityChunk.HEADER.pack(*self.origin, self.cell_size, *self.dims) + self.bits.tobytes()
+
+    @staticmethod
+    def deserialize(contents):
+        if len(contents) < VisibilityChunk.HEADER.size:
+            return VisibilityChunk(None, 0, None, None)
+        stuf = VisibilityChunk.HEADER.unpack_from(contents)
+        bits = np.frombuffer(contents, dtype='uint8', offset=VisibilityChunk.HEADER.size)
+        return VisibilityChunk(stuf[0:3], stuf[3], stuf[4:7], bits)
+
+    @staticmethod
+    def from_directory(buf, dir: RawChunkDirectoryEntry):
+        return VisibilityChunk.deserialize(buf[dir.start:dir.start + dir.length])
+
+
 ENTITY_CHUNK_TYPE = b"ENTY"
 VERTEX_CHUNK_TYPE = b"VERT"
 MESH_VERTEX_CHUNK_TYPE = b"MVER"
@@ -439,8 +572,9 @@ PLANE_CHUNK_TYPE = b"PLAN"
 BRUSH_CHUNK_TYPE = b"BRUS"
 BRUSH_SIDE_CHUNK_TYPE = b"BSID"
 MODEL_CHUNK_TYPE = b"MODL"
+VISIBILITY_CHUNK_TYPE = b"VISI"
 
-NUMBER_OF_CHUNKS = 9
+NUMBER_OF_CHUNKS = 10
 VERTEX_CHUNK_INDEX = 0
 MODEL_VERTEX_CHUNK_INDEX = 1
 FACE_CHUNK_INDEX = 2
@@ -450,6 +584,8 @@ TEXTURE_CHUNK_INDEX = 5
 PLANE_CHUNK_INDEX = 6
 BRUSH_SIDE_CHUNK_INDEX = 7
 BRUSH_CHUNK_INDEX = 8
+VISIBILITY_CHUNK_INDEX = 9
 
-HEADER = b'TMF\b\1\0\0\0'
+# 5th byte is the format version, version 1 files stop at BRUSH_CHUNK_INDEX
+HEADER = b'TMF\b\2\0\0\0'
 HEADER_SIZE = len(HEADER)
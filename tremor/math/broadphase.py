@@ -0,0 +1,116 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from tremor.core.scene_geometry import Brush
+
+GRID_CELL_SIZE = 256.0
+BOUNDS_EPSILON = 0.01
+
+
+# static uniform grid over world brush bounds, built once per map
+# a query returns only the brushes whose bounds overlap the query box
+class BrushGrid:
+    def __init__(self, brushes: List[Brush], cell_size: float = GRID_CELL_SIZE):
+        self.brushes = brushes
+        self.cell_size = cell_size
+        self.mins = np.full((len(brushes), 3), -np.inf, dtype='float64')
+        self.maxs = np.full((len(brushes), 3), np.inf, dtype='float64')
+        cells: Dict[Tuple[int, int, int], List[int]] = {}
+        unbounded = []
+        for idx, brush in enumerate(brushes):
+            bounds = brush.get_bounds()
+            if bounds is None:
+                # degenerate brush, can't place it so always test it
+                unbounded.append(idx)
+                continue
+            self.mins[idx] = bounds.min_extent - BOUNDS_EPSILON
+            self.maxs[idx] = bounds.max_extent + BOUNDS_EPSILON
+            lo, hi = self._cell_range(self.mins[idx], self.maxs[idx])
+            for cell in _cells_in_range(lo, hi):
+                cells.setdefault(cell, []).append(idx)
+        self.cells = {cell: np.array(idxs, dtype='int32') for cell, idxs in cells.items()}
+        self.unbounded = np.array(unbounded, dtype='int32')
+        # dense occupancy of the grid, lets many boxes be tested against the world at once
+        if len(self.cells) > 0:
+            keys = np.array(list(self.cells.keys()), dtype='int64')
+            self.occupancy_origin = keys.min(axis=0)
+            self.occupancy = np.zeros(keys.max(axis=0) - self.occupancy_origin + 1, dtype='bool')
+            self.occupancy[tuple((keys - self.occupancy_origin).T)] = True
+        else:
+            self.occupancy_origin = np.zeros(3, dtype='int64')
+            self.occupancy = np.zeros((1, 1, 1), dtype='bool')
+
+    def _cell_range(self, mins, maxs):
+        lo = np.floor(np.asarray(mins) / self.cell_size).astype('int64')
+        hi = np.floor(np.asarray(maxs) / self.cell_size).astype('int64')
+        return lo, hi
+
+    def query_indices(self, mins: np.ndarray, maxs: np.ndarray) -> np.ndarray:
+        lo, hi = self._cell_range(mins, maxs)
+        cell_count = np.prod(hi - lo + 1)
+        if cell_count > len(self.cells):
+            # huge query box, cheaper to test every brush
+            candidates = np.arange(len(self.brushes))
+        else:
+            found = [self.unbounded]
+            for cell in _cells_in_range(lo, hi):
+                if cell in self.cells:
+                    found.append(self.cells[cell])
+            candidates = np.unique(np.concatenate(found))
+        overlap = np.all(self.mins[candidates] <= maxs, axis=1) & np.all(self.maxs[candidates] >= mins, axis=1)
+        return candidates[overlap]
+
+    def touches_any(self, mins: np.ndarray, maxs: np.ndarray) -> np.ndarray:
+        # (M, 3) boxes -> (M,) bools, true when a box is in an occupied cell (conservative)
+        if len(self.unbounded) > 0:
+            return np.ones(len(mins), dtype='bool')
+        lo, hi = self._cell_range(mins, maxs)
+        lo = lo - self.occupancy_origin
+        hi = hi - self.occupancy_origin
+        shape = np.array(self.occupancy.shape)
+        # boxes spanning more than two cells on an axis are rare (fast movers), just let them trace
+        touching = np.any(hi - lo > 1, axis=1)
+        for offset in _cells_in_range((0, 0, 0), (1, 1, 1)):
+            cell = np.minimum(lo + offset, hi)
+            inside = np.all((cell >= 0) & (cell < shape), axis=1)
+            cell = np.clip(cell, 0, shape - 1)
+            touching |= inside & self.occupancy[cell[:, 0], cell[:, 1], cell[:, 2]]
+        return touching
+
+    def query(self, mins: np.ndarray, maxs: np.ndarray) -> List[Brush]:
+        return [self.brushes[idx] for idx in self.query_indices(mins, maxs).tolist()]
+
+    def query_swept(self, start: np.ndarray, end: np.ndarray, box_mins: np.ndarray, box_maxs: np.ndarray,
+                    margin=0.0) -> Tuple[np.ndarray, np.ndarray]:
+        # brushes a box (box_mins/box_maxs relative to its center) can touch moving from start to end
+        # returns brush indices sorted by the path fraction where the box first reaches their bounds
+        idxs = self.query_indices(np.minimum(start, end) + box_mins - margin,
+                                  np.maximum(start, end) + box_maxs + margin)
+        fracs = sweep_entry_fractions(self.mins[idxs] - box_maxs - margin, self.maxs[idxs] - box_mins + margin,
+                                      start, end - start)
+        hit = fracs <= 1.0
+        idxs = idxs[hit]
+        fracs = fracs[hit]
+        order = np.argsort(fracs, kind='stable')
+        return idxs[order], fracs[order]
+
+
+def sweep_entry_fractions(mins: np.ndarray, maxs: np.ndarray, start: np.ndarray, diff: np.ndarray) -> np.ndarray:
+    # slab test of the segment start + t * diff, t in [0, 1] against (N, 3) boxes, inf where it misses
+    # broadcasts on the leading axes, (M, 1, 3) segments against (1, N, 3) boxes gives (M, N)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (mins - start) / diff
+        t2 = (maxs - start) / diff
+    still = diff == 0
+    inside = (mins <= start) & (start <= maxs)
+    near = np.where(still, np.where(inside, -np.inf, np.inf), np.minimum(t1, t2)).max(axis=-1)
+    far = np.where(still, np.where(inside, np.inf, -np.inf), np.maximum(t1, t2)).min(axis=-1)
+    return np.where((near <= far) & (far >= 0) & (near <= 1), np.maximum(near, 0), np.inf)
+
+
+def _cells_in_range(lo, hi):
+    for x in range(int(lo[0]), int(hi[0]) + 1):
+        for y in range(int(lo[1]), int(hi[1]) + 1):
+            for z in range(int(lo[2]), int(hi[2]) + 1):
+                yield x, y, z
@@ -1,12 +1,36 @@
-from typing import List
+import itertools
+from typing import List, Optional, Tuple
 
 import numpy as np
 
 from tremor.core.scene_geometry import Brush
+from tremor.math.broadphase import BrushGrid
 from tremor.math.geometry import Plane, AABB
-from tremor.math.vertex_math import norm_vec3, magnitude_vec3
+from tremor.math.vertex_math import magnitude_vec3
 
 world: List[Brush] = []
+world_index: BrushGrid = None
+
+
+def set_world(brushes: List[Brush], build_index=True):
+    global world, world_index
+    world = brushes
+    world_index = BrushGrid(brushes) if build_index else None
+
+
+def world_bounds() -> Optional[AABB]:
+    # box around every bounded world brush
+    bounds = [bounds for bounds in (brush.get_bounds() for brush in world) if bounds is not None]
+    if len(bounds) == 0:
+        return None
+    return AABB(np.min([b.min_extent for b in bounds], axis=0), np.max([b.max_extent for b in bounds], axis=0))
+
+
+def sweeps_touch_world(mins: np.ndarray, maxs: np.ndarray) -> np.ndarray:
+    # (M, 3) swept boxes -> (M,) bools, false only when a box can't possibly hit any brush
+    if world_index is None:
+        return np.full(len(mins), len(world) > 0, dtype='bool')
+    return world_index.touches_any(mins, maxs)
 
 
 class TraceResult:
@@ -24,53 +48,67 @@ class TraceResult:
             self.path_frac) + "}"
 
 
-# todo don't let large traces pass through objects
+# how far a trace stops short of the plane it hits, keeps the box from starting the next move inside the brush
+DIST_EPSILON = 0.03125
+
+
+def clip_box_to_brush(brush: Brush, start: np.ndarray, end: np.ndarray, box_mins: np.ndarray,
+                      box_maxs: np.ndarray) -> Optional[Tuple[float, Plane]]:
+    # quake style: push each plane out by the box's extent along its normal and clip the center line against it
+    # returns (path fraction, plane) of the first contact, or None
+    planes, normals, dists = brush.get_clip_planes()
+    offsets = np.where(normals < 0, box_maxs, box_mins)
+    dists = dists - np.einsum('ij,ij->i', offsets, normals)
+    d1 = normals.dot(start) - dists
+    d2 = normals.dot(end) - dists
+    if np.any((d1 > 0) & ((d2 >= DIST_EPSILON) | (d2 >= d1))):
+        # completely in front of one plane for the whole move
+        return None
+    if not np.any(d1 > 0):
+        # started inside, let it move out instead of pinning it in place
+        return None
+    crossing = ~((d1 <= 0) & (d2 <= 0))
+    entering = crossing & (d1 > d2)
+    leaving = crossing & (d1 <= d2)
+    if not np.any(entering):
+        return None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        enter_fracs = np.where(entering, (d1 - DIST_EPSILON) / (d1 - d2), -np.inf)
+        leave_fracs = np.where(leaving, (d1 + DIST_EPSILON) / (d1 - d2), np.inf)
+    plane_idx = int(np.argmax(enter_fracs))
+    enter_frac = max(enter_fracs[plane_idx], 0.0)
+    leave_frac = min(leave_fracs.min(), 1.0)
+    if enter_frac >= leave_frac:
+        return None
+    return enter_frac, planes[plane_idx]
+
+
 def trace(start_point: np.ndarray, end_point: np.ndarray, aabb: AABB):
-    og_aabb = aabb
-    aabb = aabb.translate_new_aabb(start_point - aabb.center)
-    diff = end_point - start_point
-    direction = norm_vec3(diff)
-    end_aabb = aabb.translate_new_aabb(diff)
-    intersected_brushes = []
-    for brush in world:
-        if brush.point_in_brush(end_aabb.min_extent):
-            intersected_brushes.append(brush)
-            continue
-        if brush.point_in_brush(end_aabb.max_extent):
-            intersected_brushes.append(brush)
-            continue
-        for point in end_aabb.other_verts:
-            if brush.point_in_brush(point):
-                if brush not in intersected_brushes:
-                    intersected_brushes.append(brush)
-    new_aabbs = []
-    for brush in intersected_brushes:
-        for plane in brush.planes:
-            t = end_aabb.sit_against_plane(plane)
-            if t is not None:
-                new_aabbs.append((t, plane, brush))
-    min_move = 1E9
-    min_aabb = None
+    start_point = np.asarray(start_point, dtype='float64')
+    end_point = np.asarray(end_point, dtype='float64')
+    box_mins = aabb.min_extent - aabb.center
+    box_maxs = aabb.max_extent - aabb.center
+    if world_index is None:
+        candidates = zip(world, itertools.repeat(0.0))
+    else:
+        idxs, entry_fracs = world_index.query_swept(start_point, end_point, box_mins, box_maxs, DIST_EPSILON)
+        candidates = zip([world_index.brushes[idx] for idx in idxs.tolist()], entry_fracs.tolist())
+    min_frac = 1.0
     min_plane = None
     min_brush = None
-    for bb, plane, brush in new_aabbs:
-        center_move = bb.aabb_center_distance(aabb)
-        if min_move > center_move:
-            min_move = center_move
-            min_aabb = bb
-            min_plane = plane
+    for brush, entry_frac in candidates:
+        if entry_frac >= min_frac:
+            # candidates are sorted by when the box reaches them, nothing left can be hit sooner
+            break
+        hit = clip_box_to_brush(brush, start_point, end_point, box_mins, box_maxs)
+        if hit is not None and hit[0] < min_frac:
+            min_frac = hit[0]
+            min_plane = hit[1]
             min_brush = brush
-    if min_aabb is None:
-        return TraceResult(False, end_aabb.center, 1.0, None, None, None)
-    else:
-        r_e = magnitude_vec3(min_aabb.center - start_point)
-        w_e = magnitude_vec3(end_point - start_point)
-        if r_e / w_e > 1:
-            print("WTF! %f %f %f" % (r_e / w_e, r_e, w_e))
-            print(start_point)
-            print(end_point)
-            print(start_point + (r_e / w_e) * (end_point - start_point))
-        return TraceResult(True, min_aabb.center, (r_e / w_e), min_plane, min_brush, min_plane.normal)
+    if min_brush is None:
+        return TraceResult(False, end_point, 1.0, None, None, None)
+    return TraceResult(True, start_point + min_frac * (end_point - start_point), min_frac, min_plane, min_brush,
+                       min_plane.normal)
 
 
 def clamp_velocity(velocity: np.ndarray, trace_res: TraceResult, bouncy: int):
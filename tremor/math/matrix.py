@@ -97,4 +97,23 @@ def flatten(mat4):
 
 
 def quat_from_viewangles(viewangles):
-    return quaternion_from_angles(np.array([0, viewangles[0], viewangles[1]]), True)
\ No newline at end of file
+    return quaternion_from_angles(np.array([0, viewangles[0], viewangles[1]]), True)
+
+
+def slerp_quats(a: np.ndarray, b: np.ndarray, t: np.ndarray) -> np.ndarray:
+    # (N, 4) unit quaternions a to b, (N,) fractions -> (N, 4), along the shorter arc
+    a = np.asarray(a, dtype='float64')
+    b = np.asarray(b, dtype='float64')
+    t = np.asarray(t, dtype='float64')[:, None]
+    dot = np.einsum('ij,ij->i', a, b)[:, None]
+    b = np.where(dot < 0, -b, b)
+    dot = np.abs(dot)
+    theta = np.arccos(np.minimum(dot, 1.0))
+    sin_theta = np.sin(theta)
+    # nearly the same rotation, a normalized lerp is as good and doesn't divide by ~0
+    close = sin_theta < 1e-6
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wa = np.where(close, 1 - t, np.sin((1 - t) * theta) / sin_theta)
+        wb = np.where(close, t, np.sin(t * theta) / sin_theta)
+    out = wa * a + wb * b
+    return out / np.linalg.norm(out, axis=1, keepdims=True)
@@ -12,11 +12,37 @@ class Transform:
         self._scale = np.array([1, 1, 1])  # x y z
         self._mv_needs_rebuild = True
         self._mv: np.ndarray = None
+        self._mv_state = None
+        self._bound = False
         self._elem = scene_elem
 
+    def bind_state(self, translation: np.ndarray, rotation: np.ndarray, scale: np.ndarray):
+        # translation/rotation/scale live in external arrays (e.g. PhysicsState rows), writes go into them in place
+        translation[:] = self._translation
+        rotation[:] = self._rotation
+        scale[:] = self._scale
+        self._translation = translation
+        self._rotation = rotation
+        self._scale = scale
+        self._bound = True
+        self._mv_needs_rebuild = True
+
+    def unbind_state(self):
+        if self._bound:
+            self._translation = self._translation.copy()
+            self._rotation = self._rotation.copy()
+            self._scale = self._scale.copy()
+            self._bound = False
+
+    def _state_changed(self):
+        return not (np.array_equal(self._mv_state[0], self._translation) and
+                    np.array_equal(self._mv_state[1], self._rotation) and
+                    np.array_equal(self._mv_state[2], self._scale))
+
     def to_model_view_matrix(self):
-        # cache mv matrix
-        if self._mv_needs_rebuild:
+        # cache mv matrix, bound state can change underneath us so compare against the cached state too
+        if self._mv_needs_rebuild or (self._bound and self._state_changed()):
+            self._mv_state = (self._translation.copy(), self._rotation.copy(), self._scale.copy())
             self._mv = self._get_translation_matrix().dot(  # apply translation
                 self._get_rotation_matrix().dot(  # apply rotation
                     self._get_scale_matrix()  # apply scaling
@@ -54,19 +80,28 @@ class Transform:
         if not len(trans_vec) == 3:
             raise Exception("Invalid translation vector!")
         self._mv_needs_rebuild = True
-        self._translation = trans_vec
+        if self._bound:
+            self._translation[:] = trans_vec
+        else:
+            self._translation = trans_vec
 
     def set_rotation(self, rot_quat: np.ndarray):
         if not len(rot_quat) == 4:
             raise Exception("Invalid rotation quaternion!")
         self._mv_needs_rebuild = True
-        self._rotation = rot_quat
+        if self._bound:
+            self._rotation[:] = rot_quat
+        else:
+            self._rotation = rot_quat
 
     def set_scale(self, scale_vec: np.ndarray):
         if not len(scale_vec) == 3:
             raise Exception("Invalid scale vector!")
         self._mv_needs_rebuild = True
-        self._scale = scale_vec
+        if self._bound:
+            self._scale[:] = scale_vec
+        else:
+            self._scale = scale_vec
 
     def get_translation(self):
         return self._translation
@@ -0,0 +1,127 @@
+from typing import List, Optional
+
+import numpy as np
+
+from tremor.core.scene_geometry import Brush
+
+VIS_CELL_SIZE = 256.0
+# cells are grown past VIS_CELL_SIZE until the map fits in this many, the matrix is cells^2 bits
+MAX_VIS_CELLS = 4096
+# solid space is sampled on a grid this many times finer than the cells
+VOXELS_PER_CELL = 4
+
+
+# coarse potentially visible set: the map bounds cut into cells, with a bit per pair of cells
+# that could see each other, precomputed from the brushes by the map compiler
+# conservative, when in doubt a pair is visible
+class CellVisibility:
+    def __init__(self, origin: np.ndarray, cell_size: float, dims: np.ndarray, bits: np.ndarray):
+        self.origin = np.asarray(origin, dtype='float64')
+        self.cell_size = float(cell_size)
+        self.dims = np.asarray(dims, dtype='int64')
+        self.cell_count = int(np.prod(self.dims))
+        # (cells, ceil(cells / 8)) packed rows of the cells x cells matrix, cells numbered x major
+        # loaded maps keep them as a view of the file, a row is only unpacked when it's looked up
+        self.bits = bits
+
+    def cells(self, positions: np.ndarray) -> np.ndarray:
+        # (N, 3) -> (N,) cell numbers, outside the map counts as the nearest edge cell
+        coords = np.floor((np.asarray(positions, dtype='float64') - self.origin) / self.cell_size).astype('int64')
+        coords = np.clip(coords, 0, self.dims - 1)
+        return np.ravel_multi_index(tuple(coords.T), tuple(self.dims))
+
+    def visible_from(self, position: np.ndarray) -> np.ndarray:
+        # -> (cells,) bools, index with cells()
+        row = self.bits[self.cells(np.asarray(position).reshape(1, 3))[0]]
+        return np.unpackbits(row, count=self.cell_count).view('bool')
+
+    def packed(self) -> np.ndarray:
+        return self.bits
+
+    @staticmethod
+    def from_packed(origin, cell_size, dims, bits: np.ndarray) -> "CellVisibility":
+        # bits as stored in the VISI chunk, reshaped in place
+        return CellVisibility(origin, cell_size, dims, np.asarray(bits, dtype='uint8').reshape(int(np.prod(dims)), -1))
+
+
+def compute_visibility(brushes: List[Brush], cell_size: float = VIS_CELL_SIZE) -> Optional[CellVisibility]:
+    bounds = [bounds for bounds in (brush.get_bounds() for brush in brushes) if bounds is not None]
+    if len(bounds) == 0:
+        return None
+    mins = np.min([b.min_extent for b in bounds], axis=0) - cell_size
+    maxs = np.max([b.max_extent for b in bounds], axis=0) + cell_size
+    while np.prod(np.ceil((maxs - mins) / cell_size)) > MAX_VIS_CELLS:
+        cell_size *= 1.25
+    dims = np.ceil((maxs - mins) / cell_size).astype('int64')
+    solid = _solid_voxels(brushes, mins, cell_size / VOXELS_PER_CELL, dims * VOXELS_PER_CELL)
+    # a cell with nothing but solid voxels can't hold a viewer, everything else traces from one of its open voxels
+    per_cell = solid.reshape(dims[0], VOXELS_PER_CELL, dims[1], VOXELS_PER_CELL, dims[2], VOXELS_PER_CELL)
+    per_cell = per_cell.transpose(0, 2, 4, 1, 3, 5).reshape(int(np.prod(dims)), VOXELS_PER_CELL ** 3)
+    open_cells = np.flatnonzero(~np.all(per_cell, axis=1))
+    points = _cell_points(per_cell[open_cells], open_cells, dims, mins, cell_size)
+    visible = np.ones((len(per_cell), len(per_cell)), dtype='bool')
+    open_visible = np.ones((len(open_cells), len(open_cells)), dtype='bool')
+    voxel_size = cell_size / VOXELS_PER_CELL
+    for i in range(0, len(open_cells)):
+        # only the pairs after i, the other half is the transpose
+        blocked = _segments_blocked(points[i], points[i + 1:], solid, mins, voxel_size)
+        open_visible[i, i + 1:] = ~blocked
+        open_visible[i + 1:, i] = ~blocked
+    visible[np.ix_(open_cells, open_cells)] = open_visible
+    return CellVisibility(mins, cell_size, dims, np.packbits(_dilate(visible, dims), axis=1))
+
+
+def _solid_voxels(brushes: List[Brush], origin, voxel_size, voxel_dims) -> np.ndarray:
+    # a voxel is solid when its center is inside a brush, thin walls can slip between centers (stays conservative)
+    solid = np.zeros(tuple(voxel_dims), dtype='bool')
+    for brush in brushes:
+        bounds = brush.get_bounds()
+        if bounds is None:
+            continue
+        lo = np.maximum(np.floor((bounds.min_extent - origin) / voxel_size - 0.5).astype('int64'), 0)
+        hi = np.minimum(np.ceil((bounds.max_extent - origin) / voxel_size - 0.5).astype('int64'), voxel_dims - 1)
+        if np.any(hi < lo):
+            continue
+        idx = np.stack(np.meshgrid(*[np.arange(lo[a], hi[a] + 1) for a in range(0, 3)], indexing='ij'),
+                       axis=-1).reshape(-1, 3)
+        inside = brush.points_in_brush(origin + (idx + 0.5) * voxel_size)
+        solid[tuple(idx[inside].T)] = True
+    return solid
+
+
+def _cell_points(cell_voxels: np.ndarray, cells: np.ndarray, dims, origin, cell_size) -> np.ndarray:
+    # the open voxel nearest each cell's center, so traces don't start inside a wall
+    local = np.stack(np.unravel_index(np.arange(VOXELS_PER_CELL ** 3), (VOXELS_PER_CELL,) * 3), axis=1)
+    local_centers = (local + 0.5) / VOXELS_PER_CELL
+    dist = np.sum((local_centers - 0.5) ** 2, axis=1)
+    nearest = np.argmin(np.where(cell_voxels, np.inf, dist), axis=1)
+    coords = np.stack(np.unravel_index(cells, tuple(dims)), axis=1)
+    return origin + (coords + local_centers[nearest]) * cell_size
+
+
+def _segments_blocked(start: np.ndarray, ends: np.ndarray, solid: np.ndarray, origin, voxel_size) -> np.ndarray:
+    # (M, 3) segments from start -> (M,) bools, sampled at half voxel steps
+    if len(ends) == 0:
+        return np.zeros(0, dtype='bool')
+    start = ((start - origin) / voxel_size).astype('float32')
+    diff = ((ends - origin) / voxel_size).astype('float32') - start
+    steps = int(np.ceil(np.max(np.linalg.norm(diff, axis=1)) * 2)) + 1
+    t = np.linspace(0, 1, steps, dtype='float32')[1:-1]
+    # endpoints are open voxel centers inside the grid, so every sample is too and truncating floors
+    voxels = (start + t[None, :, None] * diff[:, None, :]).astype('int32')
+    flat = (voxels[..., 0] * solid.shape[1] + voxels[..., 1]) * solid.shape[2] + voxels[..., 2]
+    return np.any(solid.ravel()[flat], axis=1)
+
+
+def _dilate(visible: np.ndarray, dims) -> np.ndarray:
+    # one trace per pair of cells misses partial views (doorways, corners), so a cell also sees
+    # everything its neighbours see
+    grid = visible.reshape((len(visible),) + tuple(dims))
+    dilated = grid.copy()
+    for axis in range(1, 4):
+        shifted = dilated.copy()
+        shifted[(slice(None),) * axis + (slice(1, None),)] |= dilated[(slice(None),) * axis + (slice(0, -1),)]
+        shifted[(slice(None),) * axis + (slice(0, -1),)] |= dilated[(slice(None),) * axis + (slice(1, None),)]
+        dilated = shifted
+    dilated = dilated.reshape(visible.shape)
+    return dilated | dilated.T
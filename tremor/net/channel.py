@@ -2,99 +2,319 @@ import random
 import struct
 import time
 
-from tremor.net.command import generate_commands, ResponseCommand
+from tremor.net.command import generate_commands, split_commands, ResponseCommand, MalformedPacketError
+
+MAX_DATAGRAM = 8192
+HEADER = struct.Struct(">IIIHB")
+# stream offset and length of the reliable fragment following the header of an R packet
+FRAGMENT_HEADER = struct.Struct(">IH")
+RELIABLE_BIT = 1 << 31
+SEQUENCE_MASK = 0x7FFFFFFF
+ACK_BITS = 32
+MAX_FRAGMENT = MAX_DATAGRAM - HEADER.size - FRAGMENT_HEADER.size
+# unacked reliable fragments in flight, no more than the ack bitfield can cover in one burst
+RELIABLE_WINDOW = 32
+# unacked reliable bytes before we give up on the other side
+MAX_RELIABLE_BACKLOG = 1 << 20
+INITIAL_RTO = 1.0
+MIN_RTO = 0.1
+MAX_RTO = 2.0
+# what a datagram costs on the wire past its payload, IPv4 and UDP headers
+UDP_OVERHEAD = 28
+# a rate limited channel saves up at most this many seconds of its rate while idle
+RATE_BURST = 0.1
+_NO_ACKS = ()
+
+
+class _Fragment:
+    def __init__(self, offset: int, data: bytes):
+        self.offset = offset
+        self.data = data
+        self.sent_time = 0.0
+        self.retries = 0
+
+
+# one reusable datagram buffer, commands pack themselves straight into it
+# packet() is a view of the used prefix, only good until the writer is reused
+class PacketWriter:
+    def __init__(self, size=MAX_DATAGRAM):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.size = size
+        self.pos = 0
+
+    def write_command(self, cmd) -> bool:
+        if self.pos + cmd.get_packet_length() + 1 > self.size:
+            return False
+        self.pos = cmd.pack_into(self.buffer, self.pos)
+        return True
+
+    def write_bytes(self, data):
+        self.buffer[self.pos:self.pos + len(data)] = data
+        self.pos += len(data)
+
+    def packet(self) -> memoryview:
+        return self.view[0:self.pos]
 
 
 class Channel:
     def __init__(self, maximum_cmd_buf=256):
         self._id = random.randint(0x0, 0xFFFF)
-        self._sequence = 0
-        self._last_received_sequence = 0
-        self._reliable_buffer = []
-        self._reliable_waiting = []
-        self._command_buffer = []
         self.maximum_cmd_buf = maximum_cmd_buf
+        self.dropped_commands = 0  # unreliable commands pushed out of a full buffer
         self._last_received_time = 0
+        # bytes per second the other side takes, 0 for no limit
+        # packets go out while _allowance is positive, each one takes its size off it
+        self.rate = 0
+        self._allowance = 0.0
+        self._allowance_time = None
+        self._writer = PacketWriter()
+        # set when the other side's reliable stream stopped making sense, nothing after it can be trusted
+        self.corrupt = False
+        self.reset()
+
+    def reset(self):
+        self._command_buffer = []
+        # 0 is what an ack says before anything arrived, so sequences start at 1
+        self._sequence = 1
+        self._last_received_sequence = 0
+        self._received_bits = 0  # bit i set = got _last_received_sequence - 1 - i
+        # sequence -> (send time, reliable fragment offset or None, unreliable commands wanting an ack)
+        self._sent = {}
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self._reset_reliable()
+
+    def _reset_reliable(self):
+        # outgoing reliable commands are serialized into one stream and cut into fragments as the window allows
+        self._reliable_stream = bytearray()
+        self._reliable_offset = 0  # stream offset of _reliable_stream[0]
+        self._unacked = {}  # offset -> _Fragment, in stream order
+        # incoming reliable stream, reassembled in order
+        self._received_offset = 0
+        self._reassembly = bytearray()
+        self._early_fragments = {}  # offset -> bytes that arrived ahead of _received_offset
 
     def queue_command(self, cmd, reliable=False):
         if reliable:
-            self._reliable_waiting.append(cmd)
+            self._reliable_stream += cmd.serialize()
         else:
             self._command_buffer.append(cmd)
+            if len(self._command_buffer) > self.maximum_cmd_buf:
+                # the other side isn't keeping up, the oldest is the most out of date
+                del self._command_buffer[0]
+                self.dropped_commands += 1
+
+    def reliable_backlog(self):
+        return len(self._reliable_stream) + sum(len(frag.data) for frag in self._unacked.values())
+
+    def _refill_allowance(self, now):
+        if self._allowance_time is not None:
+            self._allowance = min(self._allowance + (now - self._allowance_time) * self.rate, self.rate * RATE_BURST)
+        self._allowance_time = now
+
+    def allowance(self):
+        # bytes the rate lets out right now on top of what's already queued, None when there's no limit
+        if self.rate == 0:
+            return None
+        self._refill_allowance(time.time())
+        queued = sum(cmd.get_packet_length() + 1 for cmd in self._command_buffer) + len(self._reliable_stream)
+        return self._allowance - queued - HEADER.size - UDP_OVERHEAD
 
     def should_disconnect(self):
-        return (len(self._reliable_waiting) + len(self._command_buffer) > self.maximum_cmd_buf) or \
+        return self.corrupt or (self.reliable_backlog() > MAX_RELIABLE_BACKLOG) or \
                (time.time() - self._last_received_time > 10.0 and self._last_received_time > 0)
 
     @staticmethod
     def get_identifier(dgram):
-        return struct.unpack(">H", dgram[8:10])[0]
+        return struct.unpack(">H", dgram[12:14])[0]
 
     @staticmethod
     def get_cmd_count(dgram):
-        return struct.unpack(">B", dgram[10:11])[0]
+        return struct.unpack(">B", dgram[14:15])[0]
 
-    def reset(self):
-        self._command_buffer = []
-        self._reliable_buffer = []
-        self._reliable_waiting = []
-        self._sequence = 0
-        self._last_received_sequence = 0
+    def _update_rto(self, sample):
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def _acknowledge(self, ack, ack_bits):
+        now = time.time()
+        for seq in list(self._sent.keys()):
+            behind = (ack - seq) & SEQUENCE_MASK
+            if behind >= (1 << 30):
+                # sent after this ack was written
+                continue
+            if behind == 0 or (behind <= ACK_BITS and ack_bits & (1 << (behind - 1))):
+                sent_time, fragment, cmds = self._sent.pop(seq)
+                if behind == 0:
+                    self._update_rto(now - sent_time)
+                if fragment is not None:
+                    self._unacked.pop(fragment, None)
+                for cmd in cmds:
+                    cmd.acknowledged()
+            elif behind > ACK_BITS:
+                # fell out of the ack bitfield, lost, reliable fragments come back through their timeout
+                del self._sent[seq]
+
+    def _record_received(self, seq):
+        ahead = (seq - self._last_received_sequence) & SEQUENCE_MASK
+        if ahead == 0:
+            return
+        if ahead < (1 << 30):
+            if self._last_received_sequence == 0 or ahead > ACK_BITS:
+                self._received_bits = 0
+            else:
+                # the previous newest one becomes bit ahead - 1
+                self._received_bits = ((self._received_bits << 1 | 1) << (ahead - 1)) & 0xFFFFFFFF
+            self._last_received_sequence = seq
+        else:
+            behind = (self._last_received_sequence - seq) & SEQUENCE_MASK
+            if behind <= ACK_BITS:
+                self._received_bits |= 1 << (behind - 1)
+
+    def _receive_fragment(self, offset, fragment):
+        ahead = (offset - self._received_offset) & 0xFFFFFFFF
+        if 0 < ahead < (1 << 31):
+            # a gap before it, hold on to it until the gap is filled
+            if len(self._early_fragments) < 2 * RELIABLE_WINDOW:
+                self._early_fragments[offset] = bytes(fragment)
+            return []
+        self._append_fragment(offset, fragment)
+        while self._received_offset in self._early_fragments:
+            self._append_fragment(self._received_offset, self._early_fragments.pop(self._received_offset))
+        try:
+            commands, used = split_commands(self._reassembly)
+        except MalformedPacketError:
+            self.corrupt = True
+            raise
+        del self._reassembly[0:used]
+        return commands
+
+    def _append_fragment(self, offset, fragment):
+        # duplicates and resends overlap what we have, only take the part past _received_offset
+        skip = (self._received_offset - offset) & 0xFFFFFFFF
+        if skip >= len(fragment):
+            return
+        self._reassembly += fragment[skip:]
+        self._received_offset = (self._received_offset + len(fragment) - skip) & 0xFFFFFFFF
 
     def receive_packet(self, dgram):
-        seqnum, ackd, id, cmdcount = struct.unpack(">IIHB", dgram[0:11])
-        self._last_received_sequence = seqnum
+        # raises MalformedPacketError if the commands in dgram don't decode
+        if len(dgram) < HEADER.size:
+            raise MalformedPacketError("Packet shorter than header")
+        seqnum, ackd, ack_bits, id, cmdcount = HEADER.unpack_from(dgram)
+        self._record_received(seqnum & SEQUENCE_MASK)
         self._last_received_time = time.time()
-        if ackd & (1 << 31):
-            self._reliable_buffer = []
-        return generate_commands(cmdcount, dgram[11:len(dgram)])
-
-    def _shuffle_bufs(self):
-        if len(self._reliable_buffer) == 0:
-            self._reliable_buffer = self._reliable_waiting
-            self._reliable_waiting = []
-
-    def _write_header(self, reliable, cnt):
-        if self._sequence > 0x7FFFFFFF:
-            self._sequence = 0
-        out = struct.pack(">IIHB", self._sequence | (1 << 31 if reliable else 0), self._last_received_sequence,
-                          self._id, cnt)
+        self._acknowledge(ackd & SEQUENCE_MASK, ack_bits)
+        pos = HEADER.size
+        commands = []
+        if seqnum & RELIABLE_BIT:
+            if pos + FRAGMENT_HEADER.size > len(dgram):
+                raise MalformedPacketError("Packet shorter than fragment header")
+            offset, length = FRAGMENT_HEADER.unpack_from(dgram, pos)
+            pos += FRAGMENT_HEADER.size
+            if pos + length > len(dgram):
+                raise MalformedPacketError("Packet shorter than its reliable fragment")
+            commands = self._receive_fragment(offset, memoryview(dgram)[pos:pos + length])
+            pos += length
+        commands.extend(generate_commands(cmdcount, dgram, pos))
+        return commands
+
+    def _write_header(self, buf, reliable, cnt):
+        if self._sequence > SEQUENCE_MASK:
+            self._sequence = 1
+        HEADER.pack_into(buf, 0, self._sequence | (RELIABLE_BIT if reliable else 0), self._last_received_sequence,
+                         self._received_bits, self._id, cnt)
         self._sequence += 1
-        return out
+
+    def _timed_out(self, fragment, now):
+        # current rto, so fragments sent before the first rtt sample don't sit on INITIAL_RTO, doubled per resend
+        return now - fragment.sent_time >= min(self.rto * (1 << fragment.retries), MAX_RTO)
+
+    def _next_fragment(self, now):
+        # oldest timed out fragment first, otherwise new data if the window has room
+        for fragment in self._unacked.values():
+            if self._timed_out(fragment, now):
+                fragment.retries += 1
+                return fragment
+        if len(self._reliable_stream) == 0 or len(self._unacked) >= RELIABLE_WINDOW:
+            return None
+        length = min(len(self._reliable_stream), MAX_FRAGMENT)
+        fragment = _Fragment(self._reliable_offset, bytes(self._reliable_stream[0:length]))
+        del self._reliable_stream[0:length]
+        self._reliable_offset = (self._reliable_offset + length) & 0xFFFFFFFF
+        self._unacked[fragment.offset] = fragment
+        return fragment
+
+    def has_reliable_to_send(self):
+        now = time.time()
+        if len(self._reliable_stream) > 0 and len(self._unacked) < RELIABLE_WINDOW:
+            return True
+        return any(self._timed_out(fragment, now) for fragment in self._unacked.values())
 
     def generate_outbound_packet(self):
-        self._shuffle_bufs()
-        if len(self._reliable_buffer) + len(self._command_buffer) == 0:
+        # returns a view into the channel's writer, send it before generating the next packet
+        now = time.time()
+        if self.rate > 0:
+            self._refill_allowance(now)
+            if self._allowance <= 0:
+                return None
+        fragment = self._next_fragment(now)
+        if fragment is None and len(self._command_buffer) == 0:
             return None
-        remaining = 8192 - 11
-        test_rm = remaining
+        writer = self._writer
+        writer.pos = HEADER.size
+        if fragment is not None:
+            fragment.sent_time = now
+            FRAGMENT_HEADER.pack_into(writer.buffer, writer.pos, fragment.offset, len(fragment.data))
+            writer.pos += FRAGMENT_HEADER.size
+            writer.write_bytes(fragment.data)
         commands = 0
-        for reliable in self._reliable_buffer:
-            test_rm -= 1 + reliable.get_packet_length()
-        if test_rm < 0:
-            raise Exception("Uh oh, guess it's time to implement reliable packet fragmentation")
-        buffer = bytearray(8192)
-        pos = 11
-        for reliable in self._reliable_buffer:
-            buffer[pos:reliable.get_packet_length() + pos + 1] = reliable.serialize()
-            pos += reliable.get_packet_length() + 1
-            commands += 1
-        written_unreliable = []
-        for unreliable in self._command_buffer:
-            if pos + unreliable.get_packet_length() > 8192:
+        wants_ack = _NO_ACKS
+        # a rate limited packet stops at what's left of the allowance, after at least one command
+        limit = self._allowance - UDP_OVERHEAD if self.rate > 0 else writer.size
+        for cmd in self._command_buffer:
+            if commands == 255 or (commands > 0 and writer.pos + cmd.get_packet_length() + 1 > limit) or \
+                    not writer.write_command(cmd):
                 break
-            written_unreliable.append(unreliable)
-            buffer[pos:unreliable.get_packet_length() + pos + 1] = unreliable.serialize()
-            pos += unreliable.get_packet_length() + 1
             commands += 1
-        for unreliable in written_unreliable:
-            self._command_buffer.remove(unreliable)
-        buffer[0:11] = self._write_header(len(self._reliable_buffer) > 0, commands)
-        return buffer
+            if hasattr(cmd, "acknowledged"):
+                if wants_ack is _NO_ACKS:
+                    wants_ack = []
+                wants_ack.append(cmd)
+        del self._command_buffer[0:commands]
+        self._write_header(writer.buffer, fragment is not None, commands)
+        self._sent[self._sequence - 1] = (now, fragment.offset if fragment is not None else None, wants_ack)
+        if self.rate > 0:
+            self._allowance -= writer.pos + UDP_OVERHEAD
+        return writer.packet()
+
+    def generate_outbound_packets(self):
+        # one packet as usual, then keep going while there's reliable data the window lets out
+        # or unreliable commands that didn't fit, as long as the last packet managed to take some
+        # every packet reuses the same buffer, so send each one before asking for the next
+        queued = len(self._command_buffer)
+        packet = self.generate_outbound_packet()
+        while packet is not None:
+            yield packet
+            progress = len(self._command_buffer) < queued
+            queued = len(self._command_buffer)
+            if self.has_reliable_to_send() or (queued > 0 and progress):
+                packet = self.generate_outbound_packet()
+            else:
+                packet = None
 
     def generate_disconnect(self):
+        # goes out whatever the rate says, it's the last one
+        self.rate = 0
         self._command_buffer = []
-        self._reliable_buffer = []
-        self._reliable_waiting = []
+        self._reset_reliable()
         self.queue_command(ResponseCommand(ResponseCommand.CONNECTION_TERMINATED))
         return self.generate_outbound_packet()
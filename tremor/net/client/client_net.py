@@ -1,32 +1,19 @@
-import queue
+import asyncio
 import time
-from queue import Queue
 from threading import Thread
 
-from tremor import client_main
 from tremor.net.client.client_socket import ClientSocket
 from tremor.net.command import *
 from tremor.net.common import ConnectionState
 
-
-def _listener():
-    while True:
-        if _shutdown:
-            return
-        try:
-            b, a = _socket.read()
-            if a is None and b is None:
-                time.sleep(0.1)
-                continue
-            _inbound_queue.put((a, b), True, 0.25)
-        except Exception as e:
-            print(e)
-
-
-_thread = Thread(name="cnet", target=_listener)
-_inbound_queue = Queue(64)
-_socket = ClientSocket()
-_shutdown = False
+# the network thread only runs the event loop, datagrams reach the game loop through _socket.ring
+_loop = asyncio.new_event_loop()
+_thread = Thread(name="cnet", target=_loop.run_forever, daemon=True)
+_socket = ClientSocket(_loop)
+# kept to log in again when a launcher redirects us to one of its servers
+_username = ""
+_map_name = ""
+_rate = 0  # sent with every login, 0 leaves it to the server
 
 
 def init():
@@ -34,48 +21,61 @@ def init():
 
 
 def shutdown():
-    global _shutdown
-    _socket.destroy()
-    _shutdown = True
-
-
-def connect_to_server(address, username):
-    _socket.dest_addr = address
+    disconnect()
+    _loop.call_soon_threadsafe(_loop.stop)
+    _thread.join()
+    _loop.close()
+
+
+def connect_to_server(address, username, map_name=""):
+    # map_name is only looked at by a launcher, empty lets it pick any server
+    global _username, _map_name
+    _username = username
+    _map_name = map_name
+    _socket.reset()
+    _socket.open(address)
     set_connection_state(ConnectionState.CONNECTING)
-    _socket.chan.queue_command(LoginCommand(0xBEEF, bytes(username, 'utf-8')))
+    _socket.chan.queue_command(MatchRequestCommand(map_name))
+    _socket.chan.queue_command(LoginCommand(LoginCommand.PROTOCOL_VERSION, bytes(username, 'utf-8')))
+    if _rate > 0:
+        # in the same packet as the login, a launcher or a server that doesn't know us yet only reads those
+        _socket.chan.queue_command(RateCommand(_rate))
     _socket._connect_time = time.time()
 
 
+def set_rate(rate: int):
+    # bytes per second, for this connection and every one after it
+    global _rate
+    _rate = rate
+    if _socket.connection_state == ConnectionState.CONNECTED:
+        _socket.chan.queue_command(RateCommand(rate), True)
+
+
+def disconnect():
+    _socket.reset()
+
+
 def set_connection_state(state):
     _socket.connection_state = state
 
 
 def poll_commands():
+    # every command received since the last poll, in order
     commands = []
-    while True:
-        try:
-            task = _inbound_queue.get_nowait()
-            cmds = _socket.parse_packet(*task)
-            if cmds is not None:
-                commands.append(cmds)
-        except queue.Empty:
-            break
-        except Exception as e:
-            raise e
-        _inbound_queue.task_done()
+    for cmds in _socket.receive():
+        for cmd in cmds:
+            if type(cmd) is ServerRedirectCommand:
+                # anything else from the launcher is meaningless, start over at the server it picked
+                connect_to_server((_socket.dest_addr[0], cmd.port), _username, _map_name)
+                return commands
+        commands.extend(cmds)
     return commands
 
 
-def handle_events():
-    cmds = poll_commands()
-    for cmd_group in cmds:
-        for cmd in cmd_group:
-            client_main.handle(cmd)
-
-
 def write_outbound():
     if _socket.dest_addr is not None:
-        _socket.send_datagram(_socket.chan.generate_outbound_packet())
+        # the channel reuses its packet buffer, copies go to the network thread
+        _socket.send_datagrams([bytes(dgram) for dgram in _socket.chan.generate_outbound_packets()])
 
 
 def send_message(message: str):
@@ -84,5 +84,5 @@ def send_message(message: str):
     _socket.chan.queue_command(MessageCommand("", message), False)
 
 
-def queue_update_cmd(viewangles):
-    _socket.chan.queue_command(PlayerUpdateCommand(0, 0, viewangles, 0, 0, 0))
\ No newline at end of file
+def queue_input(cmd: PlayerInputCommand):
+    _socket.chan.queue_command(cmd)
@@ -1,44 +1,127 @@
 # client socket sends to a dest, receives from that dest
-import socket
+import asyncio
+from typing import List, Optional
 
-from tremor.net.channel import Channel
+from tremor.net.channel import Channel, HEADER
+from tremor.net.command import MalformedPacketError
 from tremor.net.common import ConnectionState
 
+RING_CAPACITY = 1024
+CONNECT_TIMEOUT = 5.0
+
+
+# datagrams from the network thread to the game loop
+# one producer and one consumer that each only move their own index, so neither side takes a lock
+# when full, new datagrams are dropped and counted in overflows
+class PacketRing:
+    def __init__(self, capacity: int = RING_CAPACITY):
+        self._slots = [None] * capacity
+        self._capacity = capacity
+        self._head = 0  # next slot to read, consumer only
+        self._tail = 0  # next slot to write, producer only
+        self.overflows = 0  # producer only
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def push(self, item) -> bool:
+        if self._tail - self._head >= self._capacity:
+            self.overflows += 1
+            return False
+        self._slots[self._tail % self._capacity] = item
+        self._tail += 1
+        return True
+
+    def pop(self):
+        if self._head == self._tail:
+            return None
+        idx = self._head % self._capacity
+        item = self._slots[idx]
+        self._slots[idx] = None
+        self._head += 1
+        return item
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, ring: PacketRing):
+        self.ring = ring
+
+    def datagram_received(self, data, addr):
+        self.ring.push(data)
+
+    def error_received(self, exc):
+        # ICMP errors for earlier sends (server not up yet, port closed), the channel times out on its own
+        pass
+
 
 class ClientSocket:
-    def __init__(self, dest_addr=None):
-        self.dest_addr = dest_addr
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.dest_addr = None
         self.connection_state = ConnectionState.DISCONNECTED
-        self._socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self.chan = Channel()
-        self._incoming = False
+        self.ring = PacketRing()
+        self._loop = loop
+        self._transport: Optional[asyncio.DatagramTransport] = None
         self._connect_time = 0
+        self._reported_overflows = 0
+        self.packets_sent = 0
 
-    def send_datagram(self, dgram):
-        if dgram is not None:
-            self._socket.sendto(dgram, self.dest_addr)
+    def open(self, dest_addr):
+        # called from the game loop, the endpoint lives on the network thread's event loop
+        self.close()
+        # a fresh ring, so nothing the old endpoint still delivers lands in the new connection
+        ring = PacketRing()
+        future = asyncio.run_coroutine_threadsafe(
+            self._loop.create_datagram_endpoint(lambda: _ClientProtocol(ring), remote_addr=dest_addr), self._loop)
+        self._transport = future.result(CONNECT_TIMEOUT)[0]
+        self.ring = ring
+        self._reported_overflows = 0
+        self.dest_addr = dest_addr
 
-    def read(self):
-        if self.connection_state != ConnectionState.DISCONNECTED and self.dest_addr is not None:
-            b, a = self._socket.recvfrom(8192)
-            return (bytearray(b), a)
-        else:
-            return None, None
+    def close(self):
+        if self._transport is not None:
+            self._loop.call_soon_threadsafe(self._transport.close)
+            self._transport = None
+        self.dest_addr = None
 
-    def destroy(self):
-        self._socket.close()
-        self.chan = None
-        pass
+    def send_datagrams(self, dgrams: List[bytes]):
+        # transports aren't thread safe, hand the frame's datagrams over in one go
+        if self._transport is not None and len(dgrams) > 0:
+            self.packets_sent += len(dgrams)
+            self._loop.call_soon_threadsafe(self._send_all, self._transport, dgrams)
+
+    @staticmethod
+    def _send_all(transport, dgrams):
+        if transport.is_closing():
+            return
+        for dgram in dgrams:
+            transport.sendto(dgram)
+
+    def receive(self) -> List[list]:
+        # parses everything waiting in the ring, one command list per datagram
+        received = []
+        data = self.ring.pop()
+        while data is not None:
+            cmds = self.parse_packet(None, data)
+            if cmds is not None:
+                received.append(cmds)
+            data = self.ring.pop()
+        if self.ring.overflows != self._reported_overflows:
+            print("Dropped " + str(self.ring.overflows - self._reported_overflows) + " packets, receive ring full")
+            self._reported_overflows = self.ring.overflows
+        return received
 
     def reset(self):
-        self.connection_state = 0
-        self.dest_addr = None
-        self.chan.reset()
+        self.close()
+        self.connection_state = ConnectionState.DISCONNECTED
+        # new channel id too, the server keys connections on it and may still hold the old one
+        self.chan = Channel()
 
     def parse_packet(self, addr, data):
-        if len(data) < 11:
+        if len(data) < HEADER.size:
             return None
         try:
             return self.chan.receive_packet(data)
-        except:
+        except MalformedPacketError as e:
+            print("Dropped malformed packet: " + str(e))
             return None
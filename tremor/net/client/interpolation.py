@@ -0,0 +1,111 @@
+import numpy as np
+
+from tremor.math.matrix import slerp_quats
+
+# states kept per entity, has to reach back past the playback delay
+INTERPOLATION_STATES = 16
+# until the snapshot spacing says otherwise
+DEFAULT_TICK_INTERVAL = 1 / 20
+# how much of each new spacing sample goes into the tick interval estimate
+INTERVAL_SMOOTHING = 0.05
+# playback runs at most this much faster or slower to drift back to the delay
+MAX_TIME_SCALE = 0.05
+# further off than this many ticks and playback jumps straight to where it should be
+MAX_DRIFT_TICKS = 4.0
+# an entity missing from more snapshots in a row than this was sitting still, not unlucky with loss
+HOLD_GAP_TICKS = 2
+_NO_TICK = np.iinfo('int64').max
+
+
+# client side, where remote entities are drawn in server ticks: a fixed delay behind the newest snapshot
+# so there's almost always a snapshot on each side to interpolate between
+class SnapshotClock:
+    def __init__(self):
+        self.tick_interval = DEFAULT_TICK_INTERVAL  # seconds per server tick, learned from arrivals
+        self.newest_tick = 0
+        self._newest_time = 0.0  # when newest_tick arrived
+        self.render_tick = None
+
+    def received(self, tick: int, now: float):
+        if tick <= self.newest_tick:
+            return
+        if self.newest_tick > 0:
+            sample = (now - self._newest_time) / (tick - self.newest_tick)
+            self.tick_interval += INTERVAL_SMOOTHING * (sample - self.tick_interval)
+        self.newest_tick = tick
+        self._newest_time = now
+
+    def advance(self, frame_time: float, delay: float, now: float) -> float:
+        # moves playback on by a frame, returns the (fractional) tick to draw
+        target = self.newest_tick + (now - self._newest_time - delay) / self.tick_interval
+        if self.render_tick is None or abs(target - self.render_tick) > MAX_DRIFT_TICKS:
+            self.render_tick = target
+        else:
+            # speed up or slow down a little rather than jumping, arrival jitter would show as stutter
+            scale = 1 + np.clip((target - self.render_tick) * 0.1, -MAX_TIME_SCALE, MAX_TIME_SCALE)
+            self.render_tick = min(self.render_tick + frame_time / self.tick_interval * scale, target + 1)
+        return self.render_tick
+
+
+# the last few snapshot states of every slot, by tick, in one ring per slot
+class InterpolationBuffer:
+    def __init__(self, size: int, capacity: int = INTERPOLATION_STATES):
+        self.capacity = capacity
+        self.ticks = np.full((size, capacity), -1, dtype='int64')  # -1 = empty
+        self.positions = np.zeros((size, capacity, 3), dtype='float32')
+        self.rotations = np.zeros((size, capacity, 4), dtype='float32')
+        self.latest = np.zeros(size, dtype='int64')  # tick of the newest state in each ring, 0 for none
+        self._next = np.zeros(size, dtype='int64')  # ring index the next state goes in
+
+    def clear(self, slot: int):
+        self.ticks[slot] = -1
+        self.latest[slot] = 0
+        self._next[slot] = 0
+
+    def _append(self, tick, slots, positions, rotations):
+        idx = self._next[slots]
+        self.ticks[slots, idx] = tick
+        self.positions[slots, idx] = positions
+        self.rotations[slots, idx] = rotations
+        self.latest[slots] = tick
+        self._next[slots] = (idx + 1) % self.capacity
+
+    def push(self, tick: int, slots: np.ndarray, positions: np.ndarray, rotations: np.ndarray, hold_tick: int = 0):
+        # states of slots at tick, newer than anything they have
+        # snapshots skip entities that didn't change, so an entity that sat still gets its old state repeated
+        # for the tick before it moved again, instead of sliding all the way from when it stopped
+        # that's hold_tick (the last tick we got any snapshot for) or, when the world was quiet and nothing came
+        # at all, tick - 1 for a gap too long to be one lost snapshot
+        latest = self.latest[slots]
+        holds = np.where(tick - latest > HOLD_GAP_TICKS, tick - 1, hold_tick)
+        held = (latest > 0) & (latest < holds) & (holds < tick)
+        if np.any(held):
+            last = (self._next[slots[held]] - 1) % self.capacity
+            self._append(holds[held], slots[held], self.positions[slots[held], last],
+                         self.rotations[slots[held], last])
+        self._append(tick, slots, positions, rotations)
+
+    def sample(self, render_tick: float):
+        # (slots, positions, rotations) at render_tick for every slot with states
+        # before a slot's oldest state it shows that one, past its newest it holds the newest
+        slots = np.flatnonzero(self.latest)
+        if len(slots) == 0:
+            return slots, np.zeros((0, 3), dtype='float32'), np.zeros((0, 4), dtype='float32')
+        rows = np.arange(len(slots))
+        ticks = self.ticks[slots]
+        before = np.where((ticks >= 0) & (ticks <= render_tick), ticks, -1)
+        after = np.where(ticks > render_tick, ticks, _NO_TICK)
+        a = before.argmax(axis=1)
+        b = after.argmin(axis=1)
+        tick_a = before[rows, a]
+        tick_b = after[rows, b]
+        has_a = tick_a >= 0
+        has_b = tick_b != _NO_TICK
+        a = np.where(has_a, a, b)
+        b = np.where(has_b, b, a)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(has_a & has_b, (render_tick - tick_a) / (tick_b - tick_a), 0.0)
+        pos_a = self.positions[slots, a]
+        positions = pos_a + t[:, None].astype('float32') * (self.positions[slots, b] - pos_a)
+        rotations = slerp_quats(self.rotations[slots, a], self.rotations[slots, b], t).astype('float32')
+        return slots, positions, rotations
@@ -0,0 +1,122 @@
+from typing import List, Optional
+
+import numpy as np
+
+from tremor.core.player_move import player_move, MAX_FRAME_TIME
+from tremor.math.geometry import AABB
+from tremor.net.command import PlayerInputCommand, PlayerStateCommand
+
+# inputs kept for replaying, needs to cover a round trip worth of frames
+INPUT_HISTORY = 256
+
+
+# the local player's inputs by sequence, the newest INPUT_HISTORY of them
+class InputHistory:
+    def __init__(self, capacity: int = INPUT_HISTORY):
+        self.capacity = capacity
+        self.frame_times = np.zeros(capacity, dtype='float32')
+        self.actions = np.zeros(capacity, dtype='uint32')
+        self.look_angles = np.zeros((capacity, 2), dtype='float32')
+        self.moves = np.zeros((capacity, 3), dtype='int8')
+        self.view_ticks = np.zeros(capacity, dtype='float64')
+        self.newest = 0  # sequence of the newest input, they start at 1
+
+    def add(self, frame_time: float, actions: int, look_angles: np.ndarray, forward_move: int, side_move: int,
+            up_move: int, view_tick: float = 0.0) -> PlayerInputCommand:
+        cmd = PlayerInputCommand(self.newest + 1, frame_time, actions, np.array(look_angles, dtype='float32'),
+                                 forward_move, side_move, up_move, view_tick)
+        self.newest = cmd.sequence
+        idx = cmd.sequence % self.capacity
+        self.frame_times[idx] = cmd.frame_time
+        self.actions[idx] = cmd.actions
+        self.look_angles[idx] = cmd.look_angles
+        self.moves[idx] = (cmd.forward_move, cmd.side_move, cmd.up_move)
+        self.view_ticks[idx] = cmd.view_tick
+        return cmd
+
+    def command(self, sequence: int) -> PlayerInputCommand:
+        idx = sequence % self.capacity
+        return PlayerInputCommand(sequence, float(self.frame_times[idx]), int(self.actions[idx]),
+                                  self.look_angles[idx].copy(), *self.moves[idx].tolist(),
+                                  float(self.view_ticks[idx]))
+
+    def after(self, sequence: int, until: int = None) -> range:
+        # sequences of the stored inputs after sequence, up to until (the newest by default)
+        until = self.newest if until is None else until
+        return range(max(sequence + 1, self.newest - self.capacity + 1, 1), until + 1)
+
+    def apply(self, sequence: int, position, velocity, box: AABB):
+        idx = sequence % self.capacity
+        return player_move(position, velocity, self.look_angles[idx], int(self.actions[idx]),
+                           int(self.moves[idx, 0]), int(self.moves[idx, 1]), self.frame_times[idx], box)
+
+
+# predicts the local player from its inputs instead of waiting for the server to move it
+# a PlayerStateCommand says where the server had the player after some input, the player is put there and
+# every newer input is replayed on top of it
+class Prediction:
+    def __init__(self):
+        self.inputs = InputHistory()
+        self.acked = 0  # newest input the server has moved the player with
+        self.applied = 0  # newest input in the predicted state
+        self._server_state: PlayerStateCommand = None
+        self.corrections = 0  # replays that ended up somewhere else than the prediction had
+        self.last_error = 0.0
+        # frames since the last input, coalesced into the next one
+        self._pending_time = 0.0
+        self._pending_actions = 0
+
+    def sample(self, frame_time: float, actions: int, look_angles: np.ndarray, forward_move: int,
+               side_move: int, cmd_rate: float, up_move: int = 0,
+               view_tick: float = 0.0) -> Optional[PlayerInputCommand]:
+        # called every frame, makes an input once 1 / cmd_rate seconds of frames came together so the input
+        # and packet rates don't follow the frame rate
+        # buttons pressed in any of the frames count, moves, look angles and the view tick are the newest frame's
+        self._pending_time += frame_time
+        self._pending_actions |= actions
+        if self._pending_time < 1 / cmd_rate:
+            return None
+        cmd = self.inputs.add(min(self._pending_time, MAX_FRAME_TIME), self._pending_actions, look_angles,
+                              forward_move, side_move, up_move, view_tick)
+        self._pending_time = 0.0
+        self._pending_actions = 0
+        return cmd
+
+    def pending(self, position: np.ndarray, velocity: np.ndarray, look_angles: np.ndarray, forward_move: int,
+                side_move: int, box: AABB):
+        # predict's position and velocity moved on by the frames not in an input yet, so the view doesn't only
+        # move at cmd_rate, for drawing only, the input they end up in gets predicted once it's made
+        if self._pending_time <= 0:
+            return position, velocity
+        return player_move(position, velocity, look_angles, self._pending_actions, forward_move, side_move,
+                           self._pending_time, box)
+
+    def unacked(self, count: int) -> List[PlayerInputCommand]:
+        # the newest count inputs the server hasn't acked yet, oldest first
+        # every packet carries them, so a lost one is covered by the next as long as count reaches past it
+        return [self.inputs.command(sequence) for sequence in self.inputs.after(max(self.acked,
+                                                                                   self.inputs.newest - count))]
+
+    def server_state(self, cmd: PlayerStateCommand):
+        # unreliable, so an older one can show up after a newer one
+        if cmd.sequence >= self.acked:
+            self.acked = cmd.sequence
+            self._server_state = cmd
+
+    def predict(self, position: np.ndarray, velocity: np.ndarray, box: AABB):
+        # position and velocity are the current prediction, returns them with every new input applied
+        if self._server_state is not None:
+            state = self._server_state
+            self._server_state = None
+            predicted = position
+            position, velocity = state.pos, state.velocity
+            for sequence in self.inputs.after(state.sequence, self.applied):
+                position, velocity = self.inputs.apply(sequence, position, velocity, box)
+            self.last_error = float(np.linalg.norm(position - predicted))
+            if self.last_error > 0.001:
+                self.corrections += 1
+            self.applied = max(self.applied, state.sequence)
+        for sequence in self.inputs.after(self.applied):
+            position, velocity = self.inputs.apply(sequence, position, velocity, box)
+        self.applied = self.inputs.newest
+        return position, velocity
@@ -1,161 +1,308 @@
 import struct
+from functools import lru_cache
 
 import numpy as np
 
+from tremor.net import quantize
+
+
+class MalformedPacketError(Exception):
+    pass
+
+
+class Command:
+    # type byte on the wire, COMMAND_TABLE key
+    TYPE = None
+    # precompiled payload layout, everything after the type byte
+    STRUCT: struct.Struct = None
+
+    @classmethod
+    def get_packet_length(cls):
+        return cls.STRUCT.size
+
+    @classmethod
+    def from_values(cls, values: tuple):
+        # builds the command from STRUCT's unpacked fields
+        raise NotImplementedError
+
+    @classmethod
+    def unpack_from(cls, buf, offset: int):
+        # decodes the payload at offset, returns the command and the offset right after it
+        return cls.from_values(cls.STRUCT.unpack_from(buf, offset)), offset + cls.STRUCT.size
+
+    @classmethod
+    def deserialize(cls, buf):
+        return cls.unpack_from(buf, 0)[0]
+
+    def pack_into(self, buf, offset: int) -> int:
+        # writes type byte and payload at offset, returns the offset right after
+        raise NotImplementedError
+
+    def serialize(self):
+        buf = bytearray(self.get_packet_length() + 1)
+        self.pack_into(buf, 0)
+        return buf
+
+
+class PlayerEntityAssignCommand(Command):
+    TYPE = 0x08
+    STRUCT = struct.Struct(">H")
 
-class PlayerEntityAssignCommand:
     def __init__(self, entity_id: int):
         self.entity_id = entity_id
 
     @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">H")
+    def from_values(values):
+        return PlayerEntityAssignCommand(values[0])
 
-    @staticmethod
-    def deserialize(buf):
-        return PlayerEntityAssignCommand(struct.unpack(">H", buf)[0])
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.entity_id)
+        return offset + 1 + self.STRUCT.size
 
-    def serialize(self):
-        return struct.pack(">BH", 0x08, self.entity_id)
 
+class EntityDeleteCommand(Command):
+    TYPE = 0x07
+    STRUCT = struct.Struct(">H")
 
-class EntityDeleteCommand:
     def __init__(self, entity_id: int):
         self.entity_id = entity_id
 
     @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">H")
+    def from_values(values):
+        return EntityDeleteCommand(values[0])
 
-    @staticmethod
-    def deserialize(buf):
-        return EntityDeleteCommand(struct.unpack(">H", buf)[0])
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.entity_id)
+        return offset + 1 + self.STRUCT.size
 
-    def serialize(self):
-        return struct.pack(">BH", 0x07, self.entity_id)
 
+class CompactEntityCreateCommand(Command):
+    # pos/rotation/velocity/scale encoded by net.quantize, mins/maxs as floats
+    TYPE = 0x0A
+    STRUCT = struct.Struct(">HHHHIhhhhhhffffff32sB")
 
-class EntityCreateCommand:
-    def __init__(self, entity_id: int, pos: np.ndarray, scale: np.ndarray, rotation: np.ndarray, velocity: np.ndarray,
+    def __init__(self, entity_id: int, pos: tuple, rotation: int, velocity: tuple, scale: tuple,
                  mins: np.ndarray, maxs: np.ndarray, classname: str, flags: int):
         self.entity_id = entity_id
         self.pos = pos
-        self.scale = scale
         self.rotation = rotation
         self.velocity = velocity
+        self.scale = scale
         self.mins = mins
         self.maxs = maxs
         self.classname = classname.strip("\0")
         self.flags = flags
-        pass
 
     @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">Hfffffffffffffffffff32sB")
+    def from_values(stuf):
+        bounds = np.array(stuf[11:17], dtype='float32')
+        return CompactEntityCreateCommand(stuf[0], stuf[1:4], stuf[4], stuf[5:8], stuf[8:11], bounds[0:3], bounds[3:6],
+                                          str(stuf[17], 'utf-8').strip('\0'), stuf[18])
 
-    @staticmethod
-    def deserialize(buf):
-        stuf = struct.unpack(">Hfffffffffffffffffff32sB", buf)
-        return EntityCreateCommand(stuf[0],
-                                   np.array(stuf[1:4], dtype='float32'),
-                                   np.array(stuf[4:7], dtype='float32'),
-                                   np.array(stuf[7:11], dtype='float32'),
-                                   np.array(stuf[11:14], dtype='float32'),
-                                   np.array(stuf[14:17], dtype='float32'),
-                                   np.array(stuf[17:20], dtype='float32'),
-                                   str(stuf[20], 'utf-8').strip('\0'),
-                                   stuf[21])
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.entity_id, *self.pos, self.rotation, *self.velocity, *self.scale,
+                              *self.mins, *self.maxs, bytes(self.classname, 'utf-8'), self.flags)
+        return offset + 1 + self.STRUCT.size
 
-    def serialize(self):
-        return struct.pack(">BHfffffffffffffffffff32sB",
-                           0x06,
-                           self.entity_id,
-                           *self.pos,
-                           *self.scale,
-                           *self.rotation,
-                           *self.velocity,
-                           *self.mins,
-                           *self.maxs,
-                           bytes(self.classname, 'utf-8'),
-                           self.flags)
+    @staticmethod
+    def from_ent(id, ent, quantizer):
+        return CompactEntityCreateCommand(id, tuple(quantizer.encode(ent.transform.get_translation()).tolist()),
+                                          int(quantize.encode_rotations(ent.transform.get_rotation())[0]),
+                                          tuple(quantize.encode_velocities(ent.velocity).tolist()),
+                                          tuple(quantize.encode_scales(ent.transform.get_scale()).tolist()),
+                                          ent.boundingbox.min_extent, ent.boundingbox.max_extent, ent.classname,
+                                          ent.flags & 0xFF)
+
+
+# quantized entity state fields (see net.quantize), in mask bit order:
+# position xyz, packed rotation, velocity xyz, scale xyz
+SNAPSHOT_FIELD_FORMATS = "HHH" + "I" + "hhh" + "hhh"
+SNAPSHOT_FIELD_COUNT = len(SNAPSHOT_FIELD_FORMATS)
+SNAPSHOT_FIELD_DTYPES = tuple(np.dtype(">" + f) for f in SNAPSHOT_FIELD_FORMATS)
+_BATCH_ID_DTYPE = np.dtype(">u2")
+
+
+@lru_cache(maxsize=1024)
+def _batch_layout(mask: int):
+    # fields in mask and the bytes one entity takes in an EntitySnapshotBatchCommand
+    fields = tuple(i for i in range(0, SNAPSHOT_FIELD_COUNT) if mask & (1 << i))
+    return fields, _BATCH_ID_DTYPE.itemsize + sum(SNAPSHOT_FIELD_DTYPES[i].itemsize for i in fields)
+
+
+class EntitySnapshotBatchCommand(Command):
+    # fields of many entities' quantized states that differ from their states at baseline_tick (0 = all zeros)
+    # after the header: count entity ids, then a column of count values per field in mask, all big endian
+    # values is (count, fields in mask), an entity that didn't change one of the fields resends its baseline value
+    TYPE = 0x0B
+    STRUCT = struct.Struct(">IIHH")
+
+    def __init__(self, tick: int, baseline_tick: int, mask: int, entity_ids: np.ndarray, values: np.ndarray,
+                 on_ack=None):
+        self.tick = tick
+        self.baseline_tick = baseline_tick
+        self.mask = mask
+        self.entity_ids = entity_ids
+        self.values = values
+        self.on_ack = on_ack
+        self._fields, self._row_size = _batch_layout(mask)
+
+    def get_packet_length(self):
+        return self.STRUCT.size + len(self.entity_ids) * self._row_size
+
+    @classmethod
+    def unpack_from(cls, buf, offset):
+        tick, baseline_tick, mask, count = cls.STRUCT.unpack_from(buf, offset)
+        if mask >> SNAPSHOT_FIELD_COUNT:
+            raise MalformedPacketError("Snapshot batch mask has unknown fields " + hex(mask))
+        fields, row_size = _batch_layout(mask)
+        offset += cls.STRUCT.size
+        end = offset + count * row_size
+        if end > len(buf):
+            # same as a short struct, lets split_commands wait for the rest
+            raise struct.error("Snapshot batch of " + str(count) + " needs " + str(end - offset) + " bytes")
+        entity_ids = np.frombuffer(buf, dtype=_BATCH_ID_DTYPE, count=count, offset=offset).astype('int64')
+        offset += count * _BATCH_ID_DTYPE.itemsize
+        values = np.empty((count, len(fields)), dtype='int64')
+        for column, field in enumerate(fields):
+            dtype = SNAPSHOT_FIELD_DTYPES[field]
+            values[:, column] = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+            offset += count * dtype.itemsize
+        return EntitySnapshotBatchCommand(tick, baseline_tick, mask, entity_ids, values), end
+
+    def pack_into(self, buf, offset):
+        count = len(self.entity_ids)
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.tick, self.baseline_tick, self.mask, count)
+        offset += 1 + self.STRUCT.size
+        # columns are written straight into buf through numpy views
+        np.ndarray(count, dtype=_BATCH_ID_DTYPE, buffer=buf, offset=offset)[:] = self.entity_ids
+        offset += count * _BATCH_ID_DTYPE.itemsize
+        for column, field in enumerate(self._fields):
+            dtype = SNAPSHOT_FIELD_DTYPES[field]
+            np.ndarray(count, dtype=dtype, buffer=buf, offset=offset)[:] = self.values[:, column]
+            offset += count * dtype.itemsize
+        return offset
+
+    def acknowledged(self):
+        if self.on_ack is not None:
+            self.on_ack(self)
+
+
+class ServerRedirectCommand(Command):
+    # connectionless answer from a launcher front end to a login: log in again at port, same host
+    TYPE = 0x0C
+    STRUCT = struct.Struct(">H")
+
+    def __init__(self, port: int):
+        self.port = port
 
     @staticmethod
-    def from_ent(id, ent):
-        return EntityCreateCommand(id, ent.transform.get_translation(), ent.transform.get_scale(), ent.transform.get_rotation(),
-                                   ent.velocity, ent.boundingbox.min_extent, ent.boundingbox.max_extent, ent.classname,
-                                   ent.flags)
+    def from_values(values):
+        return ServerRedirectCommand(values[0])
 
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.port)
+        return offset + 1 + self.STRUCT.size
 
-class EntityUpdateCommand:
-    def __init__(self, entity_id: int, pos: np.ndarray, scale: np.ndarray, rotation: np.ndarray, velocity: np.ndarray):
-        self.entity_id = entity_id
-        self.pos = pos
-        self.scale = scale
-        self.rotation = rotation
-        self.velocity = velocity
 
-    @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">Hfffffffffffff")
-
-    @staticmethod
-    def deserialize(buf):
-        stuf = struct.unpack(">Hfffffffffffff", buf)
-        return EntityUpdateCommand(stuf[0], np.array(stuf[1:4], dtype='float32'),
-                                   np.array(stuf[4:7], dtype='float32'),
-                                   np.array(stuf[7:11], dtype='float32'),
-                                   np.array(stuf[11:14], dtype='float32'))
+class MatchRequestCommand(Command):
+    # goes along with a LoginCommand, the map a launcher front end should find a server for, empty for any
+    TYPE = 0x0D
+    STRUCT = struct.Struct(">16s")
 
-    def serialize(self):
-        return struct.pack(">BHfffffffffffff", 0x05, self.entity_id, *self.pos, *self.scale, *self.rotation,
-                           *self.velocity)
+    def __init__(self, map: str):
+        self.map = map
 
     @staticmethod
-    def from_ent(id, ent):
-        return EntityUpdateCommand(id, ent.transform.get_translation(), ent.transform.get_scale(), ent.transform.get_rotation(),
-                                   ent.velocity)
-
-
-class PlayerUpdateCommand:
-    def __init__(self, last_frame_time: float, actions: int, look_angles: np.ndarray,
-                 forward_move: int, side_move: int, up_move: int):
-        self.forward_move = forward_move
-        self.side_move = side_move
-        self.up_move = up_move
-        self._clamp_values()
-        self.last_frame_time = last_frame_time
+    def from_values(values):
+        return MatchRequestCommand(str(values[0], 'utf-8').strip("\0"))
+
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, bytes(self.map, 'utf-8'))
+        return offset + 1 + self.STRUCT.size
+
+
+class PlayerInputCommand(Command):
+    # one frame of the player's input
+    # sequence goes up by one per frame, frame_time is how long the frame it was sampled for took
+    # view_tick is the server tick remote entities were drawn at, interpolation delay included, 0 before any
+    # snapshot, on the wire as whole ticks and 1/256ths
+    TYPE = 0x0E
+    STRUCT = struct.Struct(">IfIffbbbIB")
+
+    def __init__(self, sequence: int, frame_time: float, actions: int, look_angles: np.ndarray,
+                 forward_move: int, side_move: int, up_move: int, view_tick: float = 0.0):
+        self.sequence = sequence
+        self.frame_time = frame_time
         self.actions = actions
         self.look_angles = look_angles
+        self.forward_move = min(max(forward_move, -127), 127)
+        self.side_move = min(max(side_move, -127), 127)
+        self.up_move = min(max(up_move, -127), 127)
+        self.view_tick = max(view_tick, 0.0)
 
-    def _clamp_values(self):
-        if self.forward_move > 127:
-            self.forward_move = 127
-        if self.forward_move < -127:
-            self.forward_move = -127  # this is correct, don't change to -128!
-        if self.side_move > 127:
-            self.side_move = 127
-        if self.side_move < -127:
-            self.side_move = -127
-        if self.up_move > 127:
-            self.up_move = 127
-        if self.up_move < -127:
-            self.up_move = -127
+    @staticmethod
+    def from_values(values):
+        return PlayerInputCommand(values[0], values[1], values[2], np.array(values[3:5], dtype='float32'),
+                                  values[5], values[6], values[7], values[8] + values[9] / 256)
+
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        fixed = int(self.view_tick * 256)
+        self.STRUCT.pack_into(buf, offset + 1, self.sequence, self.frame_time, self.actions, *self.look_angles,
+                              self.forward_move, self.side_move, self.up_move, fixed >> 8, fixed & 0xFF)
+        return offset + 1 + self.STRUCT.size
+
+
+class PlayerStateCommand(Command):
+    # the server's state of the client's own player after its inputs up to sequence, full precision
+    # so the client can replay the rest of its inputs on top of it
+    TYPE = 0x0F
+    STRUCT = struct.Struct(">I3f3f")
+
+    def __init__(self, sequence: int, pos: np.ndarray, velocity: np.ndarray):
+        self.sequence = sequence
+        self.pos = pos
+        self.velocity = velocity
 
     @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">fIffbbb")
+    def from_values(values):
+        return PlayerStateCommand(values[0], np.array(values[1:4], dtype='float32'),
+                                  np.array(values[4:7], dtype='float32'))
+
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.sequence, *self.pos, *self.velocity)
+        return offset + 1 + self.STRUCT.size
+
+
+class RateCommand(Command):
+    # the most bytes per second the client wants to be sent, the server clamps it to its own limits
+    TYPE = 0x10
+    STRUCT = struct.Struct(">I")
+
+    def __init__(self, rate: int):
+        self.rate = rate
 
     @staticmethod
-    def deserialize(buf):
-        stuf = struct.unpack(">fIffbbb", buf)
-        return PlayerUpdateCommand(stuf[0], stuf[1], np.array(stuf[2:4], dtype='float32'), stuf[4], stuf[5], stuf[6])
+    def from_values(values):
+        return RateCommand(values[0])
+
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.rate)
+        return offset + 1 + self.STRUCT.size
 
-    def serialize(self):
-        return struct.pack(">BfIffbbb", 0x04, self.last_frame_time, self.actions, *self.look_angles, self.forward_move,
-                           self.side_move, self.up_move)
 
+class ChangeMapCommand(Command):
+    TYPE = 0x03
+    STRUCT = struct.Struct(">16s")
 
-class ChangeMapCommand:
     def __init__(self, map: str):
         self.map = map
 
@@ -163,58 +310,61 @@ class ChangeMapCommand:
         return self.map
 
     @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">16s")
+    def from_values(values):
+        return ChangeMapCommand(str(values[0], 'utf-8').strip("\0"))
 
-    @staticmethod
-    def deserialize(buf):
-        return ChangeMapCommand(str(struct.unpack(">16s", buf[0:32])[0], 'utf-8').strip("\0"))
-
-    def serialize(self):
-        return struct.pack(">B16s", 0x03, bytes(self.map, 'utf-8'))
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, bytes(self.map, 'utf-8'))
+        return offset + 1 + self.STRUCT.size
 
 
-class LoginCommand:
-    PROTOCOL_VERSION_1 = 0xBEEF
+class LoginCommand(Command):
+    # bumped on any change to what goes over the wire, the packet header included, so every other version is
+    # rejected rather than misread
+    PROTOCOL_VERSION = 0xBEF5
+    TYPE = 0x02
+    STRUCT = struct.Struct(">I16s")
 
     def __init__(self, protocol: int, name: bytes):
         self.protocol = protocol
         self.name = name
 
     @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">I16s")
+    def from_values(values):
+        return LoginCommand(*values)
 
-    @staticmethod
-    def deserialize(buf):
-        return LoginCommand(*struct.unpack(">I16s", buf))
-
-    def serialize(self):
-        return struct.pack(">BI16s", 0x02, self.protocol, self.name)
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.protocol, self.name)
+        return offset + 1 + self.STRUCT.size
 
 
-class ResponseCommand:
+class ResponseCommand(Command):
     CONNECTION_ESTABLISHED = 1
     CONNECTION_REJECTED = 2
     CONNECTION_TERMINATED = 3
     WTF = 4
+    TYPE = 0x01
+    STRUCT = struct.Struct(">I")
 
     def __init__(self, response_code: int):
         self.response_code = response_code
 
     @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">I")
+    def from_values(values):
+        return ResponseCommand(values[0])
 
-    @staticmethod
-    def deserialize(buf):
-        return ResponseCommand(struct.unpack(">I", buf[0:4])[0])
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, self.response_code)
+        return offset + 1 + self.STRUCT.size
 
-    def serialize(self):
-        return struct.pack(">BI", 0x01, self.response_code)
 
+class MessageCommand(Command):
+    TYPE = 0x00
+    STRUCT = struct.Struct(">16s64s")
 
-class MessageCommand:
     def __init__(self, sender_name: str, text: str):
         self.sender_name = sender_name
         self.text = text
@@ -223,17 +373,14 @@ class MessageCommand:
         return self.text
 
     @staticmethod
-    def get_packet_length():
-        return struct.calcsize(">16s64s")
-
-    @staticmethod
-    def deserialize(buf):
-        stuf = struct.unpack(">16s64s", buf)
+    def from_values(stuf):
         return MessageCommand(str(stuf[0], 'utf-8').strip("\0"),
                               str(stuf[1], 'utf-8').strip("\0"))
 
-    def serialize(self):
-        return struct.pack(">B16s64s", 0x00, bytes(self.sender_name, 'utf-8'), bytes(self.text, 'utf-8'))
+    def pack_into(self, buf, offset):
+        buf[offset] = self.TYPE
+        self.STRUCT.pack_into(buf, offset + 1, bytes(self.sender_name, 'utf-8'), bytes(self.text, 'utf-8'))
+        return offset + 1 + self.STRUCT.size
 
 
 COMMAND_TABLE = {
@@ -241,23 +388,52 @@ COMMAND_TABLE = {
     0x01: ResponseCommand,  # C <-> S
     0x02: LoginCommand,  # C -> S
     0x03: ChangeMapCommand,  # C <- S
-    0x04: PlayerUpdateCommand,  # C -> S
-    0x05: EntityUpdateCommand,  # C <- S
-    0x06: EntityCreateCommand,  # C <- S
     0x07: EntityDeleteCommand,  # C <- S
-    0x08: PlayerEntityAssignCommand  # C <- S
+    0x08: PlayerEntityAssignCommand,  # C <- S
+    0x0A: CompactEntityCreateCommand,  # C <- S
+    0x0B: EntitySnapshotBatchCommand,  # C <- S
+    0x0C: ServerRedirectCommand,  # C <- S
+    0x0D: MatchRequestCommand,  # C -> S
+    0x0E: PlayerInputCommand,  # C -> S
+    0x0F: PlayerStateCommand,  # C <- S
+    0x10: RateCommand  # C -> S
 }
 
 
-def generate_commands(c, buf):
-    commands = []
+def _unpack_command(buf, offset):
+    cmd_type = COMMAND_TABLE.get(buf[offset])
+    if cmd_type is None:
+        raise MalformedPacketError("Unknown command type " + str(buf[offset]) + " at " + str(offset))
     try:
-        idx = 0
-        for i in range(0, c):
-            cmd_type = COMMAND_TABLE[struct.unpack(">B", buf[idx:idx + 1])[0]]
-            idx += 1
-            commands.append(cmd_type.deserialize(buf[idx:idx + cmd_type.get_packet_length()]))
-            idx += cmd_type.get_packet_length()
-    except Exception:
-        print("bruhhh")
+        return cmd_type.unpack_from(buf, offset + 1)
+    except UnicodeDecodeError as e:
+        raise MalformedPacketError("Bad string in " + cmd_type.__name__) from e
+
+
+def generate_commands(c, buf, offset=0):
+    # decodes c commands from buf starting at offset
+    commands = []
+    for i in range(0, c):
+        if offset >= len(buf):
+            raise MalformedPacketError("Packet ends after " + str(i) + " of " + str(c) + " commands")
+        try:
+            cmd, offset = _unpack_command(buf, offset)
+        except struct.error as e:
+            raise MalformedPacketError("Packet ends inside command " + str(i) + " of " + str(c)) from e
+        commands.append(cmd)
     return commands
+
+
+def split_commands(buf):
+    # decodes every complete command off the front of buf, returns them and how many bytes they used
+    commands = []
+    offset = 0
+    while offset < len(buf):
+        try:
+            cmd, end = _unpack_command(buf, offset)
+        except struct.error:
+            # rest of the command hasn't arrived yet
+            break
+        commands.append(cmd)
+        offset = end
+    return commands, offset
@@ -0,0 +1,84 @@
+import numpy as np
+
+from tremor.math.geometry import AABB
+
+# room around the world brushes for things flying out of the map
+POSITION_MARGIN = 256.0
+POSITION_BITS = 16
+# used when a map has no bounded brushes
+DEFAULT_WORLD_EXTENT = 8192.0
+ROTATION_BITS = 10
+VELOCITY_SCALE = 8.0  # 1/8 unit/s, +-4096 unit/s
+SCALE_SCALE = 256.0
+
+_ROTATION_MASK = (1 << ROTATION_BITS) - 1
+_ROTATION_HALF = (1 << (ROTATION_BITS - 1)) - 1  # odd number of levels so 0 is exact
+_ROTATION_RANGE = 1 / np.sqrt(2)  # the three smallest components of a unit quaternion are within +-1/sqrt(2)
+_INT16_MAX = 32767
+# components kept by smallest three, indexed by the dropped one
+_OTHER_COMPONENTS = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+
+
+# fixed point positions relative to the map bounds, both sides load the same map so agree on them
+class PositionQuantizer:
+    def __init__(self, bounds: AABB = None, bits: int = POSITION_BITS):
+        if bounds is None:
+            mins = np.full(3, -DEFAULT_WORLD_EXTENT)
+            maxs = np.full(3, DEFAULT_WORLD_EXTENT)
+        else:
+            mins = np.asarray(bounds.min_extent, dtype='float64') - POSITION_MARGIN
+            maxs = np.asarray(bounds.max_extent, dtype='float64') + POSITION_MARGIN
+        self.max_value = (1 << bits) - 1
+        self.origin = mins
+        self.step = (maxs - mins) / self.max_value
+
+    def encode(self, positions: np.ndarray) -> np.ndarray:
+        # (..., 3) floats -> (..., 3) ints in [0, max_value], outside the bounds gets clamped
+        return np.clip(np.round((positions - self.origin) / self.step), 0, self.max_value).astype('int64')
+
+    def decode(self, values: np.ndarray) -> np.ndarray:
+        return (values * self.step + self.origin).astype('float32')
+
+
+def encode_rotations(rotations: np.ndarray) -> np.ndarray:
+    # (N, 4) quaternions -> (N,) smallest three packed as 2 bit index of the dropped component + 3 * ROTATION_BITS
+    q = np.asarray(rotations, dtype='float64').reshape(-1, 4)
+    norm = np.linalg.norm(q, axis=1)
+    q = np.where(norm[:, None] > 0, q / np.where(norm > 0, norm, 1)[:, None], [0, 0, 0, 1])
+    largest = np.argmax(np.abs(q), axis=1)
+    rows = np.arange(len(q))
+    # q and -q are the same rotation, flip so the dropped component is positive and can be rebuilt
+    q *= np.where(q[rows, largest] < 0, -1, 1)[:, None]
+    others = q[rows[:, None], _OTHER_COMPONENTS[largest]]
+    values = np.clip(np.round(others / _ROTATION_RANGE * _ROTATION_HALF), -_ROTATION_HALF, _ROTATION_HALF)
+    values = values.astype('int64') + _ROTATION_HALF
+    return (largest << (3 * ROTATION_BITS)) | (values[:, 0] << (2 * ROTATION_BITS)) | \
+           (values[:, 1] << ROTATION_BITS) | values[:, 2]
+
+
+def decode_rotations(packed: np.ndarray) -> np.ndarray:
+    packed = np.asarray(packed, dtype='int64').reshape(-1)
+    largest = packed >> (3 * ROTATION_BITS)
+    values = np.stack((packed >> (2 * ROTATION_BITS), packed >> ROTATION_BITS, packed), axis=1) & _ROTATION_MASK
+    others = (values - _ROTATION_HALF) / _ROTATION_HALF * _ROTATION_RANGE
+    q = np.empty((len(packed), 4), dtype='float64')
+    rows = np.arange(len(packed))
+    q[rows[:, None], _OTHER_COMPONENTS[largest]] = others
+    q[rows, largest] = np.sqrt(np.maximum(0, 1 - np.sum(others * others, axis=1)))
+    return q.astype('float32')
+
+
+def encode_velocities(velocities: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(velocities * VELOCITY_SCALE), -_INT16_MAX, _INT16_MAX).astype('int64')
+
+
+def decode_velocities(values: np.ndarray) -> np.ndarray:
+    return (values / VELOCITY_SCALE).astype('float32')
+
+
+def encode_scales(scales: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(scales * SCALE_SCALE), -_INT16_MAX, _INT16_MAX).astype('int64')
+
+
+def decode_scales(values: np.ndarray) -> np.ndarray:
+    return (values / SCALE_SCALE).astype('float32')
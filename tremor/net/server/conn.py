@@ -1,4 +1,7 @@
+from tremor.core.scene import Scene
 from tremor.net.common import ConnectionState
+from tremor.net.server.relevancy import InterestSet
+from tremor.net.snapshot import SnapshotBaselines
 
 
 class Connection:
@@ -9,5 +12,14 @@ class Connection:
         self.state = ConnectionState.DISCONNECTED
         self.channel = channel
         self.entity = None
+        self.slot = -1  # of entity
+        self.input_sequence = 0  # newest PlayerInputCommand the entity was moved with
+        self.input_tick = 0  # tick the inputs_applied count is for
+        self.inputs_applied = 0
+        self.input_time = 0.0  # seconds of movement the client's inputs can still use up
+        self.input_clock = 0.0  # time.monotonic() input_time was last topped up at
+        self.view_tick = 0.0  # what the client drew when it made the newest input applied, 0 = unknown
         self.connection_time = 0
-        self.name = name
\ No newline at end of file
+        self.name = name
+        self.snapshots = SnapshotBaselines(Scene.MAX_ENTS)
+        self.interest = InterestSet(Scene.MAX_ENTS)
@@ -0,0 +1,113 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from tremor.core.physics import PhysicsState
+from tremor.math import collision_testing
+from tremor.math.broadphase import sweep_entry_fractions
+from tremor.math.geometry import AABB
+
+# furthest back a client's view is honoured, anyone lagging more than this sees their shots land late
+MAX_REWIND_SECONDS = 1.0
+# traces x entities bounds tests done in one go, bounds the temporaries of trace_entities
+_CHUNK_TESTS = 1 << 18
+
+
+# server side, where every entity's box was over the last few ticks
+# one row per tick in a ring, so a trace can be run against the world as a lagged client saw it
+class RewindBuffer:
+    def __init__(self, size: int, history_ticks: int):
+        self.history_ticks = history_ticks
+        self.ticks = np.full(history_ticks, -1, dtype='int64')
+        self.mins = np.zeros((history_ticks, size, 3), dtype='float32')  # world space boxes
+        self.maxs = np.zeros((history_ticks, size, 3), dtype='float32')
+        self.active = np.zeros((history_ticks, size), dtype='bool')
+        self.newest = -1
+
+    def record(self, tick: int, physics: PhysicsState):
+        # after the tick's movement, entity boxes are centered on their positions like in traces
+        row = tick % self.history_ticks
+        live = physics.live_slots()
+        box_mins, box_maxs = physics.box_offsets(live)
+        self.active[row] = physics.active
+        self.mins[row, live] = physics.positions[live] + box_mins
+        self.maxs[row, live] = physics.positions[live] + box_maxs
+        self.ticks[row] = tick
+        self.newest = tick
+
+    def oldest(self) -> int:
+        return max(self.newest - self.history_ticks + 1, int(self.ticks[self.ticks >= 0].min()))
+
+    def clamp(self, tick: float) -> float:
+        return min(max(tick, self.oldest()), self.newest)
+
+    def boxes_at(self, tick: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (slots, mins, maxs) of the entities present at tick, fractional ticks lerp between the two around it
+        if self.newest < 0:
+            raise Exception("Nothing recorded to rewind to")
+        tick = self.clamp(tick)
+        before = int(np.floor(tick))
+        after = min(before + 1, self.newest)
+        t = np.float32(tick - before)
+        row_a = before % self.history_ticks
+        row_b = after % self.history_ticks
+        if t == 0 or row_a == row_b:
+            slots = np.flatnonzero(self.active[row_a])
+            return slots, self.mins[row_a, slots], self.maxs[row_a, slots]
+        # an entity that came or went in between is only there on ticks it was recorded
+        slots = np.flatnonzero(self.active[row_a] & self.active[row_b])
+        mins = self.mins[row_a, slots] + t * (self.mins[row_b, slots] - self.mins[row_a, slots])
+        maxs = self.maxs[row_a, slots] + t * (self.maxs[row_b, slots] - self.maxs[row_a, slots])
+        return slots, mins, maxs
+
+    def trace_entities(self, tick: float, starts: np.ndarray, ends: np.ndarray, box: Optional[AABB] = None,
+                       ignore: Optional[np.ndarray] = None, limits: Optional[np.ndarray] = None):
+        # (M, 3) segments against the entity boxes at tick, a box makes them swept boxes centered on the segment
+        # ignore is (M,) slots each trace passes through (its shooter, -1 for none), limits (M,) path fractions
+        # traces stop at (a world hit, 1 for none)
+        # returns (M,) slots hit (-1 for none) and (M,) path fractions
+        starts = np.asarray(starts, dtype='float32').reshape(-1, 3)
+        ends = np.asarray(ends, dtype='float32').reshape(-1, 3)
+        count = len(starts)
+        hit_slots = np.full(count, -1, dtype='int64')
+        hit_fracs = np.ones(count, dtype='float32') if limits is None else np.array(limits, dtype='float32')
+        slots, mins, maxs = self.boxes_at(tick)
+        if len(slots) == 0 or count == 0:
+            return hit_slots, hit_fracs
+        if box is not None:
+            # grow the targets by the tracer's box instead of sweeping it
+            mins = mins - (box.max_extent - box.center).astype('float32')
+            maxs = maxs - (box.min_extent - box.center).astype('float32')
+        diffs = ends - starts
+        seg_mins = np.minimum(starts, ends)
+        seg_maxs = np.maximum(starts, ends)
+        chunk = max(_CHUNK_TESTS // len(slots), 1)
+        for lo in range(0, count, chunk):
+            hi = min(lo + chunk, count)
+            # segment bounds against boxes first, only the pairs that overlap get the slab test
+            overlap = (mins[None, :, 0] <= seg_maxs[lo:hi, None, 0]) & (maxs[None, :, 0] >= seg_mins[lo:hi, None, 0])
+            for axis in (1, 2):
+                overlap &= (mins[None, :, axis] <= seg_maxs[lo:hi, None, axis]) & \
+                           (maxs[None, :, axis] >= seg_mins[lo:hi, None, axis])
+            if ignore is not None:
+                overlap &= slots[None, :] != np.asarray(ignore[lo:hi])[:, None]
+            traces, boxes = np.nonzero(overlap)
+            if len(traces) == 0:
+                continue
+            traces += lo
+            fracs = sweep_entry_fractions(mins[boxes], maxs[boxes], starts[traces], diffs[traces])
+            hit = fracs < hit_fracs[traces]
+            traces, boxes, fracs = traces[hit], boxes[hit], fracs[hit]
+            # nearest box per trace
+            np.minimum.at(hit_fracs, traces, fracs)
+            nearest = fracs == hit_fracs[traces]
+            hit_slots[traces[nearest]] = slots[boxes[nearest]]
+        return hit_slots, hit_fracs
+
+    def trace(self, tick: float, start: np.ndarray, end: np.ndarray, box: AABB, ignore: int = -1):
+        # one trace against the world and the entities as they were at tick
+        # returns the world's TraceResult, the entity slot hit first (-1 when the world or nothing was hit first)
+        # and the path fraction of whatever was hit
+        world = collision_testing.trace(start, end, box)
+        slots, fracs = self.trace_entities(tick, start, end, box, np.array([ignore]), np.array([world.path_frac]))
+        return world, int(slots[0]), float(fracs[0])
@@ -0,0 +1,49 @@
+import numpy as np
+
+from tremor.core.scene import Scene
+
+# entities this close to a player are always sent, visible or not (sounds, things around corners)
+ALWAYS_RELEVANT_RADIUS = 512.0
+# visible entities further than this aren't sent
+RELEVANCY_RADIUS = 4096.0
+# ticks an entity stays in the interest set after it stopped being relevant
+# keeps things on a radius or visibility cell edge from being deleted and created over and over
+LINGER_TICKS = 20
+
+
+def entity_cells(scene: Scene):
+    # visibility cell of every slot, shared by all the clients' updates in a tick
+    if scene.visibility is None:
+        return None
+    return scene.visibility.cells(scene.physics.positions)
+
+
+def relevant(scene: Scene, cells, viewer: np.ndarray, transmit: np.ndarray) -> np.ndarray:
+    # per slot bools, entities worth sending to a player at viewer
+    dist_sq = np.sum((scene.physics.positions - viewer) ** 2, axis=1)
+    in_range = dist_sq <= RELEVANCY_RADIUS ** 2
+    if cells is not None:
+        in_range &= scene.visibility.visible_from(viewer)[cells]
+    return transmit & (in_range | (dist_sq <= ALWAYS_RELEVANT_RADIUS ** 2))
+
+
+# server side, one per client
+# the entity slots the client has been sent creates for
+class InterestSet:
+    def __init__(self, size: int):
+        self.slots = np.zeros(size, dtype='bool')
+        self.last_relevant = np.zeros(size, dtype='int64')
+
+    def remove(self, slot: int):
+        self.slots[slot] = False
+        self.last_relevant[slot] = 0
+
+    def update(self, scene: Scene, cells, viewer: np.ndarray, transmit: np.ndarray, tick: int):
+        # returns the slots that entered and the ones that left the set
+        now = relevant(scene, cells, viewer, transmit)
+        self.last_relevant[now] = tick
+        updated = now | (self.slots & transmit & (tick - self.last_relevant < LINGER_TICKS))
+        entered = np.flatnonzero(updated & ~self.slots)
+        left = np.flatnonzero(self.slots & ~updated)
+        self.slots[:] = updated
+        return entered, left
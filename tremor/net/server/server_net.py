@@ -1,50 +1,46 @@
-import queue
-import threading
+import selectors
+import time
 
 from tremor import server_main
 from tremor.net.server.server_socket import ServerSocket
 
-inbound_server_queue = queue.Queue(128)
+DEFAULT_PORT = 27070
+# most datagrams handled in one poll, so a flood can't hold up the tick
+MAX_PACKETS_PER_POLL = 4096
 
-server_sock = ServerSocket(27070)
+server_sock: ServerSocket = None
 
-event_queue = queue.Queue(128)
+_selector = selectors.DefaultSelector()
 
-def server_net_loop(sock):
-    def loop():
-        while True:
-            try:
-                b, a = sock.recv()
-                inbound_server_queue.put((a, b), True, 0.25)
-            except Exception:
-                pass
 
-    return loop
-
-
-server_thread = threading.Thread(name="snet", target=server_net_loop(server_sock))
-
-
-def init():
-    server_thread.start()
+def init(port=DEFAULT_PORT, map_name="out"):
+    global server_sock
+    server_sock = ServerSocket(port, map_name)
+    _selector.register(server_sock, selectors.EVENT_READ)
 
 
 def poll_commands():
-    commands = []
-    while True:
-        try:
-            task = inbound_server_queue.get_nowait()
-            cmds = server_sock.parse_packet(*task)
-            if cmds is not None:
-                for cmd in cmds[1]:
-                    server_main.handle(cmd, cmds[0])
-        except queue.Empty:
-            break
-        except Exception as e:
-            raise e
-        inbound_server_queue.task_done()
-    return commands
+    # reads and handles everything queued on the socket, returns how many datagrams that was
+    for count in range(0, MAX_PACKETS_PER_POLL):
+        data, addr = server_sock.recv()
+        if data is None:
+            return count
+        cmds = server_sock.parse_packet(addr, data)
+        if cmds is not None:
+            for cmd in cmds[1]:
+                server_main.handle(cmd, cmds[0])
+    return MAX_PACKETS_PER_POLL
+
+
+def wait(timeout):
+    # sleeps out the rest of the tick, handling datagrams as they come in rather than all at the next poll
+    deadline = time.perf_counter() + timeout
+    while timeout > 0:
+        if _selector.select(timeout):
+            poll_commands()
+        timeout = deadline - time.perf_counter()
 
 
 def process_outgoing():
-    server_sock.send_outgoing_commands()
+    for cl in server_sock.send_outgoing_commands():
+        server_main.handle_disconnect(cl)
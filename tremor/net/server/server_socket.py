@@ -2,27 +2,54 @@ import socket
 import time
 from typing import Tuple
 
-from tremor.net.channel import Channel
-from tremor.net.command import generate_commands, LoginCommand, ResponseCommand, ChangeMapCommand
+from tremor.net.channel import Channel, HEADER, MAX_DATAGRAM
+from tremor.net.command import generate_commands, LoginCommand, ResponseCommand, ChangeMapCommand, \
+    MalformedPacketError
 from tremor.net.common import ConnectionState
 from tremor.net.server import conn
 
+# kernel side socket buffers, big enough that a long tick doesn't overflow them before the next poll
+RECV_BUFFER_BYTES = 1 << 22
+SEND_BUFFER_BYTES = 1 << 22
+
 
 class ServerSocket:
-    def __init__(self, port):
+    def __init__(self, port, map_name="out"):
         self._sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_BYTES)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+        self._sock.setblocking(False)
         self._sock.bind(("0.0.0.0", port))
+        self._recv_buffer = bytearray(MAX_DATAGRAM)
+        self._recv_view = memoryview(self._recv_buffer)
         self.port = port
+        self.map_name = map_name  # sent to clients as they connect
         self.client_table = {}
 
+    def fileno(self):
+        return self._sock.fileno()
+
     def send_to(self, dgram, addr):
         if dgram is None:
             return
-        self._sock.sendto(dgram, addr)
+        try:
+            self._sock.sendto(dgram, addr)
+        except BlockingIOError:
+            # send buffer is full, as good as lost on the way
+            pass
 
     def recv(self):
-        b, a = self._sock.recvfrom(8192)
-        return (bytearray(b), a)
+        # next queued datagram and its address, (None, None) when there's nothing left
+        # the datagram is a view of a buffer the next recv overwrites, finish with it first
+        while True:
+            try:
+                n, a = self._sock.recvfrom_into(self._recv_buffer)
+                return self._recv_view[0:n], a
+            except BlockingIOError:
+                return None, None
+            except ConnectionResetError:
+                # windows reports an earlier send's ICMP port unreachable here, nothing to do with this read
+                continue
 
     def register_connection(self, addr_id: Tuple[str, int], udp_port: int, name: str):
         chan = Channel()
@@ -39,41 +66,46 @@ class ServerSocket:
             raise Exception("No client")
 
     def parse_packet(self, addr, data):
-        if len(data) < 11:
+        if len(data) < HEADER.size:
             return None
         id = Channel.get_identifier(data)
         tup = (addr[0], id)
         if tup in self.client_table.keys():
             self.client_table[tup].port = addr[1]
-            return self.client_table[tup], self.client_table[tup].channel.receive_packet(data)
+            try:
+                return self.client_table[tup], self.client_table[tup].channel.receive_packet(data)
+            except MalformedPacketError as e:
+                print("Dropped malformed packet from " + self.client_table[tup].name + ": " + str(e))
+                return None
         else:
             # be careful here
             try:
                 cmd_count = Channel.get_cmd_count(data)
-                cmds = generate_commands(cmd_count, data[11:len(data)])
+                cmds = generate_commands(cmd_count, data, HEADER.size)
                 for cmd in cmds:
                     if type(cmd) == LoginCommand:
                         con = self.register_connection(tup, addr[1], str(cmd.name, 'utf-8'))
                         con.channel.queue_command(ResponseCommand(ResponseCommand.CONNECTION_ESTABLISHED), True)
-                        con.channel.queue_command(ChangeMapCommand("out"), True)
+                        con.channel.queue_command(ChangeMapCommand(self.map_name), True)
                         return con, self.client_table[tup].channel.receive_packet(data)
             except:
                 return None
         return None
 
     def send_outgoing_commands(self):
+        # returns the connections dropped from client_table
         remove = []
         for k, cl in self.client_table.items():
             try:
                 if cl.channel.should_disconnect():
                     print("dc'ing")
-                    dgram = cl.channel.generate_disconnect()
+                    dgrams = [cl.channel.generate_disconnect()]
                     remove.append(k)
                 else:
-                    dgram = cl.channel.generate_outbound_packet()
-                self.send_to(dgram, (cl.ip, cl.port))
+                    dgrams = cl.channel.generate_outbound_packets()
+                for dgram in dgrams:
+                    self.send_to(dgram, (cl.ip, cl.port))
             except Exception as e:
                 remove.append(k)
                 print(e)
-        for c in remove:
-            self.client_table.pop(c)
+        return [self.client_table.pop(c) for c in remove]
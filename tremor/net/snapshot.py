@@ -0,0 +1,189 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from tremor.net.channel import MAX_DATAGRAM, HEADER
+from tremor.net.command import EntitySnapshotBatchCommand, SNAPSHOT_FIELD_COUNT, SNAPSHOT_FIELD_DTYPES
+from tremor.net.quantize import PositionQuantizer, encode_rotations, encode_velocities, encode_scales, \
+    decode_rotations, decode_velocities, decode_scales
+
+# how many ticks of entity states the client keeps around to decode deltas against
+HISTORY_TICKS = 32
+# as many full entity states as fit in one datagram
+BATCH_MAX_ENTITIES = (MAX_DATAGRAM - HEADER.size - 1 - EntitySnapshotBatchCommand.STRUCT.size) // \
+                     (2 + sum(dtype.itemsize for dtype in SNAPSHOT_FIELD_DTYPES))
+
+# an entity this far from the viewer gains priority half as fast as one right next to it
+PRIORITY_DISTANCE = 1024.0
+# an entity whose velocity changed this much (units/s) since it was last sent gains priority twice as fast
+PRIORITY_VELOCITY_CHANGE = 64.0
+
+_FIELD_BITS = 1 << np.arange(SNAPSHOT_FIELD_COUNT, dtype='int64')
+_FIELD_SIZES = np.array([dtype.itemsize for dtype in SNAPSHOT_FIELD_DTYPES], dtype='int64')
+
+
+def quantize_states(quantizer: PositionQuantizer, positions: np.ndarray, rotations: np.ndarray,
+                    velocities: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    # (N, 3), (N, 4), (N, 3), (N, 3) -> (N, SNAPSHOT_FIELD_COUNT) int64
+    states = np.empty((len(positions), SNAPSHOT_FIELD_COUNT), dtype='int64')
+    states[:, 0:3] = quantizer.encode(positions)
+    states[:, 3] = encode_rotations(rotations)
+    states[:, 4:7] = encode_velocities(velocities)
+    states[:, 7:10] = encode_scales(scales)
+    return states
+
+
+def dequantize_states(quantizer: PositionQuantizer, states: np.ndarray):
+    # (N, SNAPSHOT_FIELD_COUNT) -> (N, 3) positions, (N, 4) rotations, (N, 3) velocities, (N, 3) scales
+    return quantizer.decode(states[:, 0:3]), decode_rotations(states[:, 3]), decode_velocities(states[:, 4:7]), \
+           decode_scales(states[:, 7:10])
+
+
+# server side, one per client
+# tracks the last state of every entity slot the client acknowledged, and encodes against it
+class SnapshotBaselines:
+    def __init__(self, size: int):
+        self.acked = np.zeros((size, SNAPSHOT_FIELD_COUNT), dtype='int64')
+        self.acked_tick = np.zeros(size, dtype='int64')  # 0 = no baseline, deltas are against zeros
+        self.sent = np.zeros((size, SNAPSHOT_FIELD_COUNT), dtype='int64')
+        # acks for snapshots older than this belong to whatever used the slot before
+        self.valid_from = np.zeros(size, dtype='int64')
+        # tick of the newest snapshot the client is known to have, acks ride on its packets so this is what
+        # it was looking at when it sent whatever came with them
+        self.newest_acked = 0
+        # grows every tick an entity has changes the client wasn't sent, the highest go first when the
+        # client's rate doesn't fit them all
+        self.priority = np.zeros(size, dtype='float32')
+
+    def reset(self, slot: int, tick: int):
+        # a new entity took the slot, old baselines mean nothing to the client anymore
+        self.acked[slot] = 0
+        self.acked_tick[slot] = 0
+        self.sent[slot] = 0
+        self.valid_from[slot] = tick
+        self.priority[slot] = 0
+
+    def _changes(self, tick: int, transmit: np.ndarray, dirty: np.ndarray, states: np.ndarray,
+                 budget: Optional[float] = None, distances: Optional[np.ndarray] = None):
+        # transmit/dirty are per slot bools, states are every slot's quantized state
+        # picks what changed this tick, plus whatever the client hasn't confirmed yet or wasn't sent before
+        # with a budget (bytes) only the highest priority entities that fit it, distances are every slot's
+        # distance from the viewer
+        # -> slots, their baseline ticks, their current states, which fields differ from the baseline
+        unconfirmed = np.any(self.sent != self.acked, axis=1)
+        slots = np.flatnonzero(transmit & (dirty | unconfirmed | (self.priority > 0)))
+        baseline_ticks = self.acked_tick[slots].copy()
+        baselines = self.acked[slots].copy()
+        # client only remembers HISTORY_TICKS ticks back, past that start over from zeros
+        stale = tick - baseline_ticks >= HISTORY_TICKS
+        baseline_ticks[stale] = 0
+        baselines[stale] = 0
+        current = states[slots]
+        changed = current != baselines
+        send = np.any(changed, axis=1) | np.any(self.sent[slots] != baselines, axis=1)
+        # back where the client has it, nothing owed anymore
+        self.priority[slots[~send]] = 0
+        slots = slots[send]
+        current = current[send]
+        changed = changed[send]
+        baseline_ticks = baseline_ticks[send]
+        self.priority[slots] += self._priority_gain(slots, current, distances)
+        if budget is not None:
+            picked = self._fit_budget(slots, baseline_ticks, changed, budget)
+            slots = slots[picked]
+            current = current[picked]
+            changed = changed[picked]
+            baseline_ticks = baseline_ticks[picked]
+        self.priority[slots] = 0
+        self.sent[slots] = current
+        return slots, baseline_ticks, current, changed
+
+    def _priority_gain(self, slots: np.ndarray, current: np.ndarray, distances: Optional[np.ndarray]):
+        # one per tick, faster for entities close by and ones whose velocity changed since the client last
+        # heard, a stale entity gets picked eventually however far it is
+        velocity_change = np.linalg.norm(decode_velocities(current[:, 4:7] - self.sent[slots, 4:7]), axis=1)
+        gain = 1 + velocity_change / PRIORITY_VELOCITY_CHANGE
+        if distances is not None:
+            gain /= 1 + distances[slots] / PRIORITY_DISTANCE
+        return gain
+
+    def _fit_budget(self, slots: np.ndarray, baseline_ticks: np.ndarray, changed: np.ndarray, budget: float):
+        # indices into slots of the highest priority entities whose batches fit in budget bytes
+        # a batch carries every field any of its entities changed, so each entity is costed with all the
+        # fields changed in its baseline tick's group, and the first one of a group pays for the batch header
+        groups, group_idx = np.unique(baseline_ticks, return_inverse=True)
+        group_fields = np.zeros((len(groups), SNAPSHOT_FIELD_COUNT), dtype='bool')
+        np.logical_or.at(group_fields, group_idx, changed)
+        order = np.argsort(-self.priority[slots], kind='stable')
+        sizes = 2 + group_fields[group_idx[order]] @ _FIELD_SIZES
+        firsts = np.unique(group_idx[order], return_index=True)[1]
+        sizes[firsts] += 1 + EntitySnapshotBatchCommand.STRUCT.size
+        return np.sort(order[np.cumsum(sizes) <= budget])
+
+    def encode_batches(self, tick: int, transmit: np.ndarray, dirty: np.ndarray, states: np.ndarray,
+                       budget: Optional[float] = None,
+                       distances: Optional[np.ndarray] = None) -> List[EntitySnapshotBatchCommand]:
+        # deltas of what changed against what the client acked, entities sharing a baseline tick go out together
+        # with a budget, the entities that don't fit it wait for a later tick with their priority growing
+        slots, baseline_ticks, current, changed = self._changes(tick, transmit, dirty, states, budget, distances)
+        commands = []
+        for baseline_tick in np.unique(baseline_ticks).tolist():
+            group = np.flatnonzero(baseline_ticks == baseline_tick)
+            for start in range(0, len(group), BATCH_MAX_ENTITIES):
+                rows = group[start:start + BATCH_MAX_ENTITIES]
+                fields = np.any(changed[rows], axis=0)
+                commands.append(EntitySnapshotBatchCommand(tick, baseline_tick, int((fields * _FIELD_BITS).sum()),
+                                                           slots[rows], current[rows][:, fields],
+                                                           self._on_batch_ack))
+        return commands
+
+    def _on_batch_ack(self, cmd: EntitySnapshotBatchCommand):
+        # the batch's states become the baselines of its entities, unless the slot was reused or moved past it
+        slots = cmd.entity_ids
+        self.newest_acked = max(self.newest_acked, cmd.tick)
+        acked_ticks = self.acked_tick[slots]
+        ok = (cmd.tick > acked_ticks) & (cmd.tick >= self.valid_from[slots])
+        if cmd.baseline_tick == 0:
+            states = np.zeros((len(slots), SNAPSHOT_FIELD_COUNT), dtype='int64')
+        else:
+            ok &= acked_ticks == cmd.baseline_tick
+            states = self.acked[slots]
+        states[:, _mask_fields(cmd.mask)] = cmd.values
+        self.acked[slots[ok]] = states[ok]
+        self.acked_tick[slots[ok]] = cmd.tick
+
+
+# client side, reconstructs entity states from deltas
+# a slot's history outlives the entity in it, the server only ever deltas a new entity against ticks from
+# after it was (re)created, and those never match the old entity's entries
+class SnapshotHistory:
+    def __init__(self, size: int):
+        self.states = np.zeros((size, HISTORY_TICKS, SNAPSHOT_FIELD_COUNT), dtype='int64')
+        self.ticks = np.full((size, HISTORY_TICKS), -1, dtype='int64')
+        self.latest = np.zeros(size, dtype='int64')
+
+    def decode_batch(self, cmd: EntitySnapshotBatchCommand) -> Tuple[np.ndarray, np.ndarray]:
+        # rebuilds the full quantized states of the entities whose baselines we still have
+        # returns the slots that got states newer than anything seen for them, and those states
+        slots = cmd.entity_ids
+        values = cmd.values
+        if cmd.baseline_tick == 0:
+            states = np.zeros((len(slots), SNAPSHOT_FIELD_COUNT), dtype='int64')
+        else:
+            h = cmd.baseline_tick % HISTORY_TICKS
+            known = self.ticks[slots, h] == cmd.baseline_tick
+            slots = slots[known]
+            values = values[known]
+            states = self.states[slots, h]
+        states[:, _mask_fields(cmd.mask)] = values
+        h = cmd.tick % HISTORY_TICKS
+        self.states[slots, h] = states
+        self.ticks[slots, h] = cmd.tick
+        newer = cmd.tick > self.latest[slots]
+        slots = slots[newer]
+        self.latest[slots] = cmd.tick
+        return slots, states[newer]
+
+
+def _mask_fields(mask: int) -> np.ndarray:
+    return (mask & _FIELD_BITS) != 0
@@ -0,0 +1,164 @@
+import multiprocessing
+import selectors
+import time
+
+from tremor.net.channel import Channel, HEADER
+from tremor.net.command import generate_commands, LoginCommand, MatchRequestCommand, ResponseCommand, \
+    ServerRedirectCommand
+from tremor.net.server.server_socket import ServerSocket
+
+# per worker row in the shared stats array
+STAT_SESSIONS = 0
+STAT_TICKS = 1
+STAT_TICK_TIME = 2  # moving average, seconds
+STAT_LAST_TICK = 3  # wall clock time of the last finished tick
+STAT_FIELDS = 4
+# how quickly the tick time average follows new ticks
+TICK_TIME_SMOOTHING = 0.1
+# a redirected client counts against its worker for this long, until the worker's own count has it
+REDIRECT_GRACE = 3.0
+STATUS_INTERVAL = 5.0
+
+
+class Worker:
+    def __init__(self, index: int, map_name: str, port: int):
+        self.index = index
+        self.map_name = map_name
+        self.port = port
+        self.process: multiprocessing.Process = None
+        self.redirects = []  # times of redirects the worker may not have seen yet
+
+
+# runs in the worker process, a normal dedicated server that reports to its stats row after every tick
+def _run_worker(index: int, map_name: str, port: int, stats):
+    from tremor import server_main
+    row = index * STAT_FIELDS
+
+    def on_tick(sessions, tick_time):
+        stats[row + STAT_SESSIONS] = sessions
+        if stats[row + STAT_TICKS] == 0:
+            stats[row + STAT_TICK_TIME] = tick_time
+        else:
+            stats[row + STAT_TICK_TIME] += TICK_TIME_SMOOTHING * (tick_time - stats[row + STAT_TICK_TIME])
+        stats[row + STAT_TICKS] += 1
+        stats[row + STAT_LAST_TICK] = time.time()
+
+    server_main.main(map_name, port, on_tick)
+
+
+workers = []
+stats = None
+capacity = 0
+front_sock: ServerSocket = None
+
+
+def stat(worker: Worker, field: int):
+    return stats[worker.index * STAT_FIELDS + field]
+
+
+def sessions(worker: Worker):
+    now = time.time()
+    worker.redirects = [t for t in worker.redirects if now - t < REDIRECT_GRACE]
+    return int(stat(worker, STAT_SESSIONS)) + len(worker.redirects)
+
+
+def ready(worker: Worker):
+    # alive and ticking, a worker still loading its map can't take anyone
+    return worker.process.is_alive() and stat(worker, STAT_TICKS) > 0
+
+
+def pick_worker(map_name: str):
+    best = None
+    for worker in workers:
+        if not ready(worker) or (map_name != "" and worker.map_name != map_name):
+            continue
+        load = sessions(worker)
+        if load < capacity and (best is None or load < sessions(best)):
+            best = worker
+    return best
+
+
+def reply(cmd, addr):
+    # connectionless, the client drops this channel as soon as it gets the answer
+    chan = Channel()
+    chan.queue_command(cmd)
+    front_sock.send_to(chan.generate_outbound_packet(), addr)
+
+
+def handle_packet(data, addr):
+    if len(data) < HEADER.size:
+        return
+    try:
+        cmds = generate_commands(Channel.get_cmd_count(data), data, HEADER.size)
+    except Exception:
+        return
+    login = None
+    map_name = ""
+    for cmd in cmds:
+        if type(cmd) is LoginCommand:
+            login = cmd
+        if type(cmd) is MatchRequestCommand:
+            map_name = cmd.map
+    if login is None:
+        return
+    worker = None
+    if login.protocol == LoginCommand.PROTOCOL_VERSION:
+        worker = pick_worker(map_name)
+    if worker is None:
+        # a worker would reject it anyway, or nowhere to put it
+        reply(ResponseCommand(ResponseCommand.CONNECTION_REJECTED), addr)
+        return
+    worker.redirects.append(time.time())
+    reply(ServerRedirectCommand(worker.port), addr)
+
+
+def print_status():
+    now = time.time()
+    print("worker  map               port   sessions  tick ms  state")
+    for worker in workers:
+        if not worker.process.is_alive():
+            state = "dead (" + str(worker.process.exitcode) + ")"
+        elif stat(worker, STAT_TICKS) == 0:
+            state = "starting"
+        elif now - stat(worker, STAT_LAST_TICK) > 1.0:
+            state = "stalled"
+        else:
+            state = "ok"
+        print("%6d  %-16s  %5d  %4d/%-4d  %7.2f  %s" % (worker.index, worker.map_name, worker.port,
+                                                       int(stat(worker, STAT_SESSIONS)), capacity,
+                                                       stat(worker, STAT_TICK_TIME) * 1000, state))
+
+
+def main(worker_count: int, maps, port: int, worker_capacity: int):
+    # the front end listens on port, worker i on port + 1 + i, maps are handed out to workers in turn
+    global stats, capacity, front_sock
+    capacity = worker_capacity
+    stats = multiprocessing.Array('d', worker_count * STAT_FIELDS, lock=False)
+    for i in range(0, worker_count):
+        worker = Worker(i, maps[i % len(maps)], port + 1 + i)
+        worker.process = multiprocessing.Process(name="worker-" + str(i), target=_run_worker,
+                                                 args=(i, worker.map_name, worker.port, stats), daemon=True)
+        worker.process.start()
+        workers.append(worker)
+    front_sock = ServerSocket(port)
+    selector = selectors.DefaultSelector()
+    selector.register(front_sock, selectors.EVENT_READ)
+    print("Launcher listening on " + str(port) + " with " + str(worker_count) + " workers")
+    next_status = time.time() + STATUS_INTERVAL
+    try:
+        while True:
+            if selector.select(max(next_status - time.time(), 0)):
+                data, addr = front_sock.recv()
+                while data is not None:
+                    handle_packet(data, addr)
+                    data, addr = front_sock.recv()
+            if time.time() >= next_status:
+                print_status()
+                next_status = time.time() + STATUS_INTERVAL
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.process.terminate()
+        for worker in workers:
+            worker.process.join()
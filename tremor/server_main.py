@@ -2,16 +2,37 @@ import random
 import time
 
 from tremor.core.entity import Entity
+from tremor.core.game_clock import TickScheduler
+from tremor.core.player_move import player_move, MAX_FRAME_TIME
 from tremor.loader.scene import binloader
 from tremor.math import matrix
 from tremor.math.geometry import AABB
 from tremor.net.command import *
 from tremor.net.common import ConnectionState
-from tremor.net.server import server_net
+from tremor.net.server import server_net, relevancy
+from tremor.net.server.lag_compensation import RewindBuffer, MAX_REWIND_SECONDS
+from tremor.net.quantize import PositionQuantizer
 from tremor.net.server.conn import Connection
+from tremor.net.snapshot import quantize_states
+from tremor.util import configuration
+
+# seconds between overrun summaries, quiet while the server keeps up
+OVERRUN_REPORT_INTERVAL = 60.0
+# most inputs moving one player per tick, a couple of packets' worth at the highest cl_cmdrate
+MAX_INPUTS_PER_TICK = 32
+# seconds of movement a client can bank ahead of the wall clock, to ride out inputs arriving in a burst
+# after a lag spike, anything past it is cut short (speed hacks)
+MAX_INPUT_TIME_AHEAD = 0.25
+# lowest rate (bytes/s) a client can ask for, below it there's hardly room for its own player's state
+MIN_RATE = 4000
 
 should_exit = False
 current_scene = None
+quantizer: PositionQuantizer = None
+scheduler: TickScheduler = None
+rewind: RewindBuffer = None
+max_rate = 0  # clients that don't send a RateCommand get this
+tick = 1
 
 
 def handle(cmd, cl):
@@ -19,59 +40,196 @@ def handle(cmd, cl):
     if cmd_type is MessageCommand:
         cmd.sender_name = cl.name
         broadcast_packet(cmd)
-    if cmd_type is PlayerUpdateCommand:
-        handle_player_update(cmd, cl)
+    if cmd_type is PlayerInputCommand:
+        handle_player_input(cmd, cl)
+    if cmd_type is RateCommand:
+        cl.channel.rate = min(max(cmd.rate, MIN_RATE), max_rate)
     if cmd_type is LoginCommand:
         handle_login_phase_2(cmd, cl)
 
 
-def handle_player_update(cmd: PlayerUpdateCommand, cl: Connection):
-    if cl.entity is not None:
-        cl.entity.transform.set_rotation(matrix.quat_from_viewangles(cmd.look_angles))
-        cl.entity.needs_update = True
+def handle_player_input(cmd: PlayerInputCommand, cl: Connection):
+    # unreliable, anything at or before the newest input applied is a duplicate or came too late
+    if cl.entity is None or cmd.sequence <= cl.input_sequence:
+        return
+    if not np.isfinite(cmd.frame_time) or not np.all(np.isfinite(cmd.look_angles)):
+        # would poison the entity's transform, and everyone's snapshots with it
+        return
+    if cl.input_tick != tick:
+        cl.input_tick = tick
+        cl.inputs_applied = 0
+    if cl.inputs_applied >= MAX_INPUTS_PER_TICK:
+        # left unacked, the client keeps resending its newest ones
+        return
+    cl.inputs_applied += 1
+    cl.input_sequence = cmd.sequence
+    if cmd.view_tick <= tick:
+        cl.view_tick = cmd.view_tick
+    # the inputs can't add up to more time than has passed since the login, plus what can be banked
+    now = time.monotonic()
+    cl.input_time = min(cl.input_time + now - cl.input_clock, MAX_INPUT_TIME_AHEAD)
+    cl.input_clock = now
+    frame_time = min(max(cmd.frame_time, 0.0), MAX_FRAME_TIME, cl.input_time)
+    cl.input_time -= frame_time
+    ent = cl.entity
+    ent.transform.set_rotation(matrix.quat_from_viewangles(cmd.look_angles))
+    pos, velocity = player_move(ent.transform.get_translation(), ent.velocity, cmd.look_angles, cmd.actions,
+                                cmd.forward_move, cmd.side_move, frame_time, ent.boundingbox)
+    ent.transform.set_translation(pos)
+    ent.velocity = velocity
+    ent.needs_update = True
+
+
+def view_tick(cl: Connection) -> float:
+    # the tick the client was looking at when it made the input being handled, interpolation delay included
+    if cl.view_tick > 0:
+        return rewind.clamp(cl.view_tick)
+    # hasn't drawn a snapshot yet, go back by half a round trip instead
+    rtt = cl.channel.srtt if cl.channel.srtt is not None else 0.0
+    return rewind.clamp(rewind.newest - rtt / 2 / scheduler.dt)
+
+
+def rewind_trace(cl: Connection, start: np.ndarray, end: np.ndarray, box: AABB):
+    # a trace on the client's behalf against the world as it saw it, passes through its own entity
+    return rewind.trace(view_tick(cl), start, end, box, cl.slot)
 
 
 def handle_login_phase_2(cmd: LoginCommand, cl: Connection):
-    idx = 0
-    for ent in current_scene.entities:
-        if ent is not None and not ent.flags & Entity.FLAG_WORLD:
-            cl.channel.queue_command(EntityCreateCommand.from_ent(idx, ent),True)
-        idx += 1
-    id, player_ent = current_scene.allocate_new_ent()
+    if cl.entity is not None:
+        # logged in already, a second login would only take another slot
+        return
+    if cmd.protocol != LoginCommand.PROTOCOL_VERSION:
+        cl.channel.queue_command(ResponseCommand(ResponseCommand.CONNECTION_REJECTED), True)
+        return
+    try:
+        id, player_ent = current_scene.allocate_new_ent()
+    except Exception as e:
+        # scene is full
+        print("Rejected " + cl.name + ": " + str(e))
+        cl.channel.queue_command(ResponseCommand(ResponseCommand.CONNECTION_REJECTED), True)
+        return
+    if cl.channel.rate == 0:
+        # no RateCommand came along with the login
+        cl.channel.rate = max_rate
+    # entities that never send updates are created up front, the rest come and go with the client's interest set
+    for idx, ent in current_scene.live_entities():
+        if not ent.flags & Entity.FLAG_WORLD and ent.flags & Entity.FLAG_NO_TRANSMIT:
+            cl.channel.queue_command(CompactEntityCreateCommand.from_ent(idx, ent, quantizer), True)
     player_ent.classname = "player"
     player_ent.transform.set_translation(np.array([random.random() * 32, 128, random.random() * 32]))
     player_ent.boundingbox = AABB(np.array([-16, -20, -16]), np.array([16, 20, 16]))
-    player_ent.flags = Entity.FLAG_PLAYER | Entity.FLAG_GRAVITY | Entity.FLAG_BOUNCY
-    broadcast_packet(EntityCreateCommand.from_ent(id, player_ent),True)
+    # the client's inputs move it from here on
+    player_ent.flags = Entity.FLAG_PLAYER | Entity.FLAG_PREDICTED
     cl.entity = player_ent
+    cl.slot = id
+    cl.input_clock = time.monotonic()
+    # the player's own entity has to exist on the client before it's assigned
+    send_interest_changes(cl, relevancy.entity_cells(current_scene), transmitted_slots())
     cl.channel.queue_command(PlayerEntityAssignCommand(id), True)
     cl.state = ConnectionState.SPAWNED
 
 
+def handle_disconnect(cl: Connection):
+    # frees the player's slot, everyone who had its entity gets the delete now, before anything else can take
+    # the slot and show up to them as the same entity
+    if cl.slot < 0:
+        return
+    current_scene.remove_ent(cl.slot)
+    for other in server_net.server_sock.client_table.values():
+        if other.interest.slots[cl.slot]:
+            other.interest.remove(cl.slot)
+            other.snapshots.reset(cl.slot, tick)
+            other.channel.queue_command(EntityDeleteCommand(cl.slot), True)
+    cl.slot = -1
+    cl.entity = None
+
+
 def broadcast_packet(cmd, r=False):
     for cl in server_net.server_sock.client_table.values():
         cl.channel.queue_command(cmd, r)
 
 
-def main():
-    global current_scene
+def transmitted_slots():
+    phys = current_scene.physics
+    return phys.active & (phys.flags & (Entity.FLAG_WORLD | Entity.FLAG_NO_TRANSMIT) == 0)
+
+
+def send_interest_changes(cl: Connection, cells, transmit):
+    # creates for entities coming into the client's interest set, deletes for the ones leaving it
+    entered, left = cl.interest.update(current_scene, cells, cl.entity.transform.get_translation(), transmit, tick)
+    for idx in left.tolist():
+        cl.snapshots.reset(idx, tick)
+        cl.channel.queue_command(EntityDeleteCommand(idx), True)
+    for idx in entered.tolist():
+        cl.snapshots.reset(idx, tick)
+        cmd = CompactEntityCreateCommand.from_ent(idx, current_scene.entities[idx], quantizer)
+        cl.channel.queue_command(cmd, True)
+
+
+def broadcast_snapshots():
+    # each client only hears about the entities in its interest set
+    # and gets deltas against the last state it acked, entities nobody touched since then cost nothing
+    # batches only take what's left of the client's rate after everything else this tick, the entities that
+    # matter most to it first
+    phys = current_scene.physics
+    states = quantize_states(quantizer, phys.positions, phys.rotations, phys.velocities, phys.scales)
+    transmit = transmitted_slots()
+    cells = relevancy.entity_cells(current_scene)
+    for cl in server_net.server_sock.client_table.values():
+        if cl.state != ConnectionState.SPAWNED:
+            continue
+        send_interest_changes(cl, cells, transmit)
+        if cl.input_sequence > 0:
+            # every tick, a lost one would leave the client predicting from an old state
+            cl.channel.queue_command(PlayerStateCommand(cl.input_sequence,
+                                                        np.array(cl.entity.transform.get_translation()),
+                                                        np.array(cl.entity.velocity)))
+        distances = np.linalg.norm(phys.positions - cl.entity.transform.get_translation(), axis=1)
+        for cmd in cl.snapshots.encode_batches(tick, cl.interest.slots, phys.dirty, states, cl.channel.allowance(),
+                                               distances):
+            cl.channel.queue_command(cmd)
+    phys.dirty[:] = False
+
+
+def main(map_name="out", port=None, on_tick=None):
+    # on_tick(sessions, tick seconds) is called after every tick, the launcher uses it to watch its workers
+    global current_scene, quantizer, scheduler, rewind, max_rate, tick
     print("Server starting...")
-    server_net.init()
-    current_scene = binloader.load_scene_file("out", "data/scenes/out.tmb", False)
-    dt = 1 / 20
+    server_settings = configuration.get_server_settings()
+    if server_settings is None:
+        print("Bad [server] settings")
+        return
+    max_rate = server_settings.getint("max_rate")
+    server_net.init(server_net.DEFAULT_PORT if port is None else port, map_name)
+    current_scene = binloader.load_scene_file(map_name, "data/scenes/" + map_name + ".tmb", False, use_mmap=True)
+    quantizer = PositionQuantizer(current_scene.bounds)
+    scheduler = TickScheduler(server_settings.getint("tick_rate"), server_settings.getint("max_catchup_ticks"))
+    rewind = RewindBuffer(len(current_scene.entities), int(MAX_REWIND_SECONDS * server_settings.getint("tick_rate")) + 1)
+    next_report = time.monotonic() + OVERRUN_REPORT_INTERVAL
     while not should_exit:
-        start_time = time.time()
-        server_net.poll_commands()
-        current_scene.move_entities(dt)
-        idx = 0
-        for ent in current_scene.entities:
-            if ent is not None and ent.needs_update:
-                broadcast_packet(EntityUpdateCommand.from_ent(idx, ent))
-            idx += 1
-        server_net.process_outgoing()
-        end_time = time.time() - start_time
-        if end_time > 1 / 20:
-            dt = end_time
-        else:
-            time.sleep((1 / 20) - end_time)
-            dt = time.time() - start_time
+        due = scheduler.ticks_due()
+        if due > 0:
+            server_net.poll_commands()
+            # catching up only steps the world, one round of snapshots covers all of it
+            for i in range(0, due):
+                start_time = time.monotonic()
+                current_scene.move_entities(scheduler.dt)
+                rewind.record(tick, current_scene.physics)
+                if i == due - 1:
+                    broadcast_snapshots()
+                    server_net.process_outgoing()
+                tick += 1
+                tick_time = scheduler.tick_done(start_time)
+                if on_tick is not None:
+                    on_tick(len(server_net.server_sock.client_table), tick_time)
+        if time.monotonic() >= next_report:
+            report_overruns(scheduler)
+            next_report += OVERRUN_REPORT_INTERVAL
+        scheduler.wait(server_net.wait)
+
+
+def report_overruns(scheduler: TickScheduler):
+    ticks, overruns, dropped, worst, lateness = scheduler.take_stats()
+    if overruns > 0 or dropped > 0:
+        print("%d of %d ticks overran, %d dropped, worst %.1f ms, %.2f ms late on average" %
+              (overruns, ticks, dropped, worst * 1000, lateness * 1000))
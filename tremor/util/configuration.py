@@ -55,6 +55,12 @@ loading_schema: schema_t = {
     "max_texture_dimension": is_integer_nonzero_positive
 }
 
+server_schema: schema_t = {
+    "tick_rate": lambda x, y: is_integer_nonzero_positive(x, y) and int(x[y]) <= 128,
+    "max_catchup_ticks": is_integer_nonzero_positive,
+    "max_rate": is_integer_nonzero_positive,
+}
+
 
 def get_graphics_settings():
     return get_settings('graphics', graphics_schema)
@@ -64,6 +70,10 @@ def get_loader_settings():
     return get_settings('loader', loading_schema)
 
 
+def get_server_settings():
+    return get_settings('server', server_schema)
+
+
 def get_settings(section: str, schema: schema_t, strict=True):
     settings = configparser.ConfigParser()
     settings.read('settings.ini')
@@ -0,0 +1,103 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from tremor.core.player_move import ACTION_JUMP
+from tremor.loader.scene import binloader
+from tremor.math.geometry import AABB
+from tremor.net import quantize
+from tremor.net.client import client_net
+from tremor.net.client.prediction import Prediction
+from tremor.net.command import ResponseCommand, ChangeMapCommand, CompactEntityCreateCommand, \
+    PlayerEntityAssignCommand, PlayerStateCommand
+from tremor.net.common import ConnectionState
+
+
+# drives the client network stack without a window: logs in, walks in circles (predicted like the real
+# client, against the map's brushes) and counts what comes back
+def run(args):
+    client_net.init()
+    counts = {}
+    connect_time = None
+    start = time.perf_counter()
+    client_net.set_rate(args.bandwidth)
+    client_net.connect_to_server((args.host, args.port), args.name, args.map)
+    viewangles = np.array([0, 0], dtype='float32')
+    frame_time = 1 / args.rate
+    prediction = Prediction()
+    quantizer = None
+    creates = {}
+    player = None  # [position, velocity, box] once the server assigned us an entity
+    errors = []
+    dt = frame_time
+    frames = 0
+    while time.perf_counter() - start < args.seconds:
+        frame_start = time.perf_counter()
+        for cmd in client_net.poll_commands():
+            name = type(cmd).__name__
+            counts[name] = counts.get(name, 0) + 1
+            if type(cmd) is ResponseCommand:
+                if cmd.response_code == ResponseCommand.CONNECTION_ESTABLISHED:
+                    client_net.set_connection_state(ConnectionState.CONNECTED)
+                    connect_time = time.perf_counter() - start
+                elif cmd.response_code in (ResponseCommand.CONNECTION_REJECTED, ResponseCommand.CONNECTION_TERMINATED):
+                    client_net.disconnect()
+            elif type(cmd) is ChangeMapCommand:
+                scene = binloader.load_scene_file(cmd.map, "data/scenes/" + cmd.map + ".tmb", False)
+                quantizer = quantize.PositionQuantizer(scene.bounds)
+            elif type(cmd) is CompactEntityCreateCommand:
+                creates[cmd.entity_id] = cmd
+            elif type(cmd) is PlayerEntityAssignCommand:
+                create = creates[cmd.entity_id]
+                player = [quantizer.decode(np.array(create.pos)), np.zeros(3, dtype='float32'),
+                          AABB(np.array(create.mins), np.array(create.maxs))]
+            elif type(cmd) is PlayerStateCommand:
+                prediction.server_state(cmd)
+        if client_net._socket.connection_state == ConnectionState.CONNECTED and player is not None:
+            # land first, then a slow circle that fits small maps, jumping every other second
+            elapsed = time.perf_counter() - start
+            viewangles[0] = (viewangles[0] + 90 * dt) % 360
+            actions = ACTION_JUMP if int(elapsed) % 2 == 0 else 0
+            if prediction.sample(dt, actions, viewangles, 32 if elapsed > 3 else 0, 0, args.cmdrate) is not None:
+                for cmd in prediction.unacked(args.cmdbackup):
+                    client_net.queue_input(cmd)
+            corrections = prediction.corrections
+            player[0], player[1] = prediction.predict(player[0], player[1], player[2])
+            if prediction.corrections != corrections:
+                errors.append(prediction.last_error)
+        client_net.write_outbound()
+        frames += 1
+        time.sleep(max(0.0, frame_time - (time.perf_counter() - frame_start)))
+        dt = time.perf_counter() - frame_start
+    overflows = client_net._socket.ring.overflows
+    packets = client_net._socket.packets_sent
+    client_net.shutdown()
+    print("==== STATS ====")
+    print("Connected after: " + ("never" if connect_time is None else "%f s" % connect_time))
+    print("Ring overflows: %d" % overflows)
+    for name, count in sorted(counts.items()):
+        print("%s: %d" % (name, count))
+    print("Frames: %d, packets sent: %d" % (frames, packets))
+    print("Inputs: %d, acked: %d" % (prediction.inputs.newest, prediction.acked))
+    print("Corrections: %d, worst %.4f" % (len(errors), max(errors) if len(errors) > 0 else 0))
+    if player is not None:
+        print("Final position: " + str(player[0]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tremor headless client')
+    parser.add_argument('--host', dest='host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', dest='port', type=int, default=27070)
+    parser.add_argument('--name', dest='name', type=str, default="headless")
+    parser.add_argument('--map', dest='map', type=str, default="", help="map to ask a launcher for")
+    parser.add_argument('--seconds', dest='seconds', type=float, default=10)
+    parser.add_argument('--rate', dest='rate', type=float, default=60, help="frames per second")
+    parser.add_argument('--cmdrate', dest='cmdrate', type=float, default=60, help="inputs per second")
+    parser.add_argument('--bandwidth', dest='bandwidth', type=int, default=25000,
+                        help="bytes per second to ask the server for")
+    parser.add_argument('--cmdbackup', dest='cmdbackup', type=int, default=4,
+                        help="unacked inputs repeated in every packet")
+    args = parser.parse_args(sys.argv[1:])
+    run(args)
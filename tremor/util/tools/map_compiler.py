@@ -5,6 +5,7 @@ import time
 
 from tremor.core.scene_geometry import Brush, Plane
 from tremor.loader.scene.scene_types import *
+from tremor.math import visibility
 
 
 def parse_side(string):
@@ -202,16 +203,18 @@ def main(args):
     parse_time = time.time()
     ents = parse_map_file(args.map)
     parse_time = time.time() - parse_time
-    raw_verts = []
-    raw_faces = []
-    raw_mesh_verts = []
-    raw_models = []
-    raw_textures = []
-    raw_planes = []
-    raw_brushes = []
-    raw_brush_sides = []
+    raw_verts = RecordBuilder(RawVertex)
+    raw_faces = RecordBuilder(RawFace)
+    raw_mesh_verts = RecordBuilder(RawModelVertex)
+    raw_models = RecordBuilder(RawModel)
+    raw_textures = RecordBuilder(RawTexture)
+    raw_planes = RecordBuilder(RawPlane)
+    raw_brushes = RecordBuilder(RawBrush)
+    raw_brush_sides = RecordBuilder(RawBrushSide)
+    texture_indices = {}
     generate_time = time.time()
     int_time = 0
+    vis_brushes = []
     for ent in ents:
         if "brushes" in ent:
             face_start = len(raw_faces)
@@ -223,11 +226,12 @@ def main(args):
                 brush_side_count = len(brush.planes)
                 content_flag = 0
                 for plane in brush.planes:
-                    raw_planes.append(RawPlane(plane.point, plane.normal))
+                    raw_planes.append(plane.point, plane.normal)
                     content_flag |= plane.content
-                    raw_brush_sides.append(RawBrushSide(plane_start + plane_count, plane.surface))
+                    raw_brush_sides.append(plane_start + plane_count, plane.surface)
                     plane_count += 1
-                raw_brushes.append(RawBrush(content_flag, brush_side_start, brush_side_count))
+                raw_brushes.append(content_flag, brush_side_start, brush_side_count)
+                vis_brushes.append(brush)
                 temp = time.time()
                 vertices = brush.get_vertices()
                 int_time += time.time() - temp
@@ -241,41 +245,43 @@ def main(args):
                     for i in range(0, len(face)):
                         u, v = calculate_uv(text_cache[brush.planes[j].texture_name], brush.planes[j].normal, face[i],
                                             brush.planes[j].texture_attributes)
-                        raw_verts.append(
-                            RawVertex(face[i], brush.planes[j].normal, np.array([u, v], dtype='float32')))
+                        raw_verts.append(face[i], brush.planes[j].normal, (u, v))
                     for i in range(2, len(face)):
-                        raw_mesh_verts.append(RawModelVertex(raw_vert_start))
-                        raw_mesh_verts.append(RawModelVertex(raw_vert_start + i - 1))
-                        raw_mesh_verts.append(RawModelVertex(raw_vert_start + i))
+                        raw_mesh_verts.append(raw_vert_start)
+                        raw_mesh_verts.append(raw_vert_start + i - 1)
+                        raw_mesh_verts.append(raw_vert_start + i)
                         raw_mesh_count += 3
-                    tex_idx = -1
-                    for p in range(0, len(raw_textures)):
-                        if str(raw_textures[p].name, 'utf-8') == brush.planes[j].texture_name:
-                            tex_idx = p
-                            break
-                    if tex_idx == -1:
-                        tex_idx = len(raw_textures)
-                        raw_textures.append(RawTexture(bytes(brush.planes[j].texture_name, 'utf-8')))
-                    raw_faces.append(
-                        RawFace(tex_idx, raw_vert_start, len(face), raw_mesh_start, raw_mesh_count,
-                                brush.planes[j].normal))
+                    texture_name = brush.planes[j].texture_name
+                    if texture_name not in texture_indices:
+                        texture_indices[texture_name] = raw_textures.append(bytes(texture_name, 'utf-8')[0:64])
+                    tex_idx = texture_indices[texture_name]
+                    raw_faces.append(tex_idx, raw_vert_start, len(face), raw_mesh_start, raw_mesh_count,
+                                     brush.planes[j].normal)
                     face_count += 1
             ent.pop("brushes")
             ent["model"] = "*" + str(len(raw_models))
-            raw_models.append(RawModel(face_start, face_count))
+            raw_models.append(face_start, face_count)
     generate_time = time.time() - generate_time
+    vis_time = time.time()
+    vis = visibility.compute_visibility(vis_brushes)
+    if vis is None:
+        vis_chunk = VisibilityChunk(None, 0, None, None)
+    else:
+        vis_chunk = VisibilityChunk(vis.origin, vis.cell_size, vis.dims, vis.packed())
+    vis_time = time.time() - vis_time
     write_time = time.time()
     file_loc = HEADER_SIZE + RawChunkDirectoryEntry.size() * NUMBER_OF_CHUNKS + 1
     chunks = [
-        (VertexChunk(raw_verts), VERTEX_CHUNK_TYPE),
-        (ModelVertexChunk(raw_mesh_verts), MESH_VERTEX_CHUNK_TYPE),
-        (FaceChunk(raw_faces), FACE_CHUNK_TYPE),
-        (ModelChunk(raw_models), MODEL_CHUNK_TYPE),
+        (VertexChunk(raw_verts.records()), VERTEX_CHUNK_TYPE),
+        (ModelVertexChunk(raw_mesh_verts.records()), MESH_VERTEX_CHUNK_TYPE),
+        (FaceChunk(raw_faces.records()), FACE_CHUNK_TYPE),
+        (ModelChunk(raw_models.records()), MODEL_CHUNK_TYPE),
         (EntityChunk(bytes(format_ents(ents), 'utf-8')), ENTITY_CHUNK_TYPE),
-        (TextureChunk(raw_textures), TEXTURE_CHUNK_TYPE),
-        (PlaneChunk(raw_planes), PLANE_CHUNK_TYPE),
-        (BrushSideChunk(raw_brush_sides), BRUSH_SIDE_CHUNK_TYPE),
-        (BrushChunk(raw_brushes), BRUSH_CHUNK_TYPE)
+        (TextureChunk(raw_textures.records()), TEXTURE_CHUNK_TYPE),
+        (PlaneChunk(raw_planes.records()), PLANE_CHUNK_TYPE),
+        (BrushSideChunk(raw_brush_sides.records()), BRUSH_SIDE_CHUNK_TYPE),
+        (BrushChunk(raw_brushes.records()), BRUSH_CHUNK_TYPE),
+        (vis_chunk, VISIBILITY_CHUNK_TYPE)
     ]
     idx = 0
     for c, t in chunks:
@@ -301,9 +307,11 @@ def main(args):
         "Planes: %d" % (len(raw_planes)),
         "BrushSides: %d" % (len(raw_brush_sides)),
         "Brushes: %d" % (len(raw_brushes)),
+        "Visibility cells: %d" % (0 if vis is None else vis.cell_count),
         "Map parse time: %f s" % (parse_time),
         "Map generate time: %f s" % (generate_time),
         "Gen: Find intersections: %f s" % (int_time),
+        "Visibility time: %f s" % (vis_time),
         "Serialize+write time: %f s" % (write_time)
 
     ]
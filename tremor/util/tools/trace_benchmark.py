@@ -0,0 +1,60 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from tremor.core.entity import Entity
+from tremor.loader.scene import binloader
+from tremor.math import collision_testing
+from tremor.math.geometry import AABB
+
+
+def spawn_entities(scene, count, seed):
+    rng = np.random.default_rng(seed)
+    lo = collision_testing.world_index.mins.min(axis=0)
+    hi = collision_testing.world_index.maxs.max(axis=0)
+    lo = np.where(np.isfinite(lo), lo, -1024)
+    hi = np.where(np.isfinite(hi), hi, 1024)
+    for i in range(0, count):
+        idx, ent = scene.allocate_new_ent()
+        ent.classname = "bench"
+        ent.transform.set_translation(rng.uniform(lo, hi).astype('float32'))
+        ent.velocity = rng.normal(0, 200, 3).astype('float32')
+        ent.boundingbox = AABB(np.array([-16, -20, -16]), np.array([16, 20, 16]))
+        ent.flags = Entity.FLAG_GRAVITY
+
+
+def run_ticks(args, use_index):
+    scene = binloader.load_scene_file("bench", args.map, False)
+    spawn_entities(scene, args.entities, args.seed)
+    if not use_index:
+        collision_testing.world_index = None
+    times = []
+    for i in range(0, args.ticks):
+        start = time.perf_counter()
+        scene.move_entities(1 / 20)
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def main(args):
+    results = [("grid", run_ticks(args, True))]
+    if not args.skip_linear:
+        results.append(("linear", run_ticks(args, False)))
+    print("==== STATS ====")
+    print("Brushes: %d" % len(collision_testing.world))
+    print("Entities: %d" % args.entities)
+    for name, times in results:
+        print("%s: mean tick %f s, max tick %f s" % (name, times.mean(), times.max()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tremor collision tick benchmark')
+    parser.add_argument('--map', dest='map', type=str, required=True)
+    parser.add_argument('--entities', dest='entities', type=int, default=64)
+    parser.add_argument('--ticks', dest='ticks', type=int, default=20)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--skip-linear', dest='skip_linear', action='store_true')
+    args = parser.parse_args(sys.argv[1:])
+    main(args)